@@ -3,19 +3,37 @@
 
 from __future__ import unicode_literals
 
-from collections import Sequence
-import copy
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
 import datetime
+import logging
 
 from remoteecont import xmlutils
-from remoteecont.transfer import CurlTransfer
+from remoteecont.exceptions import (CircuitOpenError, EcontError,
+                                    InvalidLoading, RateLimitExceeded,
+                                    ResponseError, TransferError,
+                                    TransferTimeout)
+from remoteecont.metrics import CallEvent
+from remoteecont.transfer import CurlTransfer, HttpTransfer
 
 __all__ = [
+    'CircuitOpenError',
     'CurlTransfer',
+    'EcontError',
+    'HttpTransfer',
+    'InvalidLoading',
+    'RateLimitExceeded',
     'RemoteEcont',
-    'RemoteEcontXml'
+    'RemoteEcontXml',
+    'ResponseError',
+    'TransferError',
+    'TransferTimeout'
 ]
 
+_log = logging.getLogger(__name__)
+
 class RemoteEcont(object):
     """Simple interface for communication with Econt services."""
 
@@ -105,7 +123,7 @@ class RemoteEcont(object):
         """
         raise NotImplementedError
 
-    def shipments(self, sender_city, receiver_city, _id, full_tracking='ON'):
+    def shipments(self, nums, full_tracking='ON'):
         """Информация за статуса на товарителници."""
         raise NotImplementedError
 
@@ -157,6 +175,8 @@ class RemoteEcontXml(RemoteEcont):
   {{args}}
 </request>'''
 
+    _SHIPMENTS = '<shipments full_tracking="{full_tracking}">{nums}</shipments>'
+
     # TODO: validate=1
     _SHIPPING = '''<?xml version="1.0" encoding="UTF-8"?>
 <parcels>
@@ -169,22 +189,211 @@ class RemoteEcontXml(RemoteEcont):
 </parcels>
 '''
 
+    # sender   --> подател за товарителницата
+    # receiver --> получател
+    # shipment --> информация за товарителницата
+    _LOADING_DEFAULTS = {
+        'sender' : {
+            'city'               : '', # град на изпращача
+            'post_code'          : '', # пощенски код
+            'office_code'        : '', # офис код, ако се пр от офс
+            'name'               : '', # име на фирма подател
+            'name_person'        : '', # име на човек подател
+            'quarter'            : '', # квартал
+            'street'             : '', # улица
+            'street_num'         : '', # уличен №
+            'street_bl'          : '', # блок
+            'street_vh'          : '', # вход
+            'street_et'          : '', # етаж
+            'street_ap'          : '', # № апартамент
+            'street_other'       : '', # доп. информация
+            'phone_num'          : ''  # телефонен номер
+        },
+
+        'receiver': {
+            'city'               : '', # Абсолютно същото като
+            'post_code'          : '', # за подателя
+            'office_code'        : '',
+            'name'               : '',
+            'name_person'        : '',
+            'receiver_email'     : '',
+            'quarter'            : '',
+            'street'             : '',
+            'street_num'         : '',
+            'street_bl'          : '',
+            'street_vh'          : '',
+            'street_et'          : '',
+            'street_ap'          : '',
+            'street_other'       : '',
+            'phone_num'          : ''},
+
+        'shipment': {
+            'envelope_num'       : '', # номер опаковка?!
+
+            # тип пратка, едно от следните:
+            # PACK, DOCUMENT, PALLET, CARGO,
+            # DOCUMENTPALLET
+            'shipment_type'      : '',
+            'description'        : '', # описание
+            'pack_count'         : '', # брой пакети?!
+            'weight'             : '', # тегло (В КИЛОГРАМИ)
+            'tariff_code'        : '', # МИСТИКА!
+            'tariff_sub_code'    : '', # DOOR_OFFICE, D_D, O_D, O_O
+            'pay_after_accept'   : '', # плащане след получаване?
+            'pay_after_test'     : '', # плащане след проба
+            'delivery_day'       : ''  # ЗАГАДКА!
+        },
+
+        'payment': {
+
+            # SENDER, RECEIVER, OTHER
+            'side'               : '', # страна платец
+
+            # CASH, CREDIT, BONUS, VOUCHER
+            'method'             : '',
+
+            # Сума за споделяне с получателя (ако е за
+            # сметка на подателя)
+            'receiver_share_sum' : '',
+
+            # Процент за споделяне с получателя
+            'share_percent'      : '',
+
+            # Клиентски номер на платеца, само при плащане
+            # на кредит
+            'key_word'           : ''
+        },
+
+        'services': {
+            # наложен платеж
+
+            # Малко е безумен тоя начин за представяне на
+            # атрибутите, честно казано... не помня вече какво съм
+            # си мислил тогава и що така съм го оставил; пък и не
+            # е добра абстракция на ХМЛ, FIXME :) По–добре би било
+            # атрибутите да отиват в речници с този синтаксис:
+            # таг__имеНаАтрибута = {...}
+            'cd'                 : {'__content__': '',
+                                    '__attrib__' : {'type': ''}},
+            'cd_agreement_num'   : '', # споразумение за защита НП
+            'cd_curreny'         : '', # валута
+            'dc'                 : '', # обратна разписка
+            'dc_cp'              : '', # стокова разписка
+            'dp'                 : '', # двупосочна пратка
+            'e'                  : '', # доставка същия ден
+            'e1'                 : '', # доставка до  60 мин
+            'e2'                 : '', # доставка до  90 мин
+            'e3'                 : '', # доставка до 120 мин
+            'oc'                 : '', # обявена стойност
+            'oc_currency'        : '', # валута на `oc`
+            'p'                  : '', # преоритет (ON/"")
+            'pack1'              : '', # доп. опаковка (ON/"")
+            'pack2'              : '',
+            'pack3'              : '',
+            'pack4'              : '',
+            'pack5'              : '',
+            'pack6'              : '',
+            'pack7'              : '',
+            'pack8'              : '',
+            'ref'                : '', # хладилна чанта (ON/"")
+        }
+    }
+
+    _LOADING = xmlutils.Serializer('row', _LOADING_DEFAULTS)
+
     def __init__(self, service_url, parcel_url, username, password,
-                 transfer_class):
+                 transfer_class, pool_size=None, pool_idle_timeout=60,
+                 observers=None, connect_timeout=10, timeout=120,
+                 retry=None, circuit_breaker=None, compression=True,
+                 pool=None):
+        """
+        If `pool_size` is given, the client holds a pool of at most
+        `pool_size` reusable connections for its whole lifetime (see
+        `Transfer.create_pool`).  Idle connections are dropped after
+        `pool_idle_timeout` seconds.  Call `close` to release them.
+        Alternatively `pool` is an existing pool of `transfer_class`,
+        shared with other clients, which `close` leaves open.
+
+        `observers` are callables that receive a
+        `remoteecont.metrics.CallEvent` after every call.
+
+        `connect_timeout` and `timeout` (of a whole request) are in
+        seconds; they apply to transfer classes that list them in their
+        `options` (see `Transfer`), other classes keep their own
+        timeouts.  For the `iter_*` streams `timeout` limits only the
+        time without any data received.  `retry` is a `remoteecont.policy.RetryPolicy` applied
+        to the requests to the service URL, which are idempotent, but
+        never to `shipping`.  `circuit_breaker` is a
+        `remoteecont.policy.CircuitBreaker` guarding all requests.
+
+        Failed requests raise `TransferError` (`TransferTimeout` if a
+        timeout expired), unparsable responses raise `ResponseError`.
+
+        `compression` asks for gzip or deflate compressed responses,
+        which are decoded as they arrive: True for all request types,
+        False for none, or a collection of request types, e.g.
+        `('cities_streets', 'offices')`.  The call events report both
+        the received (`wire_bytes`) and the decoded size.  Transfer
+        classes without `accept_encoding` in their `options` are never
+        asked for compressed responses.
+
+        """
         super(RemoteEcontXml, self).__init__(service_url, parcel_url, username,
                                              password, transfer_class)
 
+        self._observers = list(observers or [])
+        self._connect_timeout = connect_timeout
+        self._timeout = timeout
+        self._retry = retry
+        self._circuit_breaker = circuit_breaker
+        self._compression = compression if isinstance(compression, bool) \
+            else frozenset(compression or ())
+
+        self._pool = pool
+        self._own_pool = pool is None and bool(pool_size)
+        if self._own_pool:
+            self._pool = transfer_class.create_pool(pool_size,
+                                                    pool_idle_timeout)
+
         # Prepare request patterns
         client = self._CLIENT.format(username=username, password=password)
         self._GENERIC = self._GENERIC.format(client=client)
         self._SHIPPING = self._SHIPPING.format(client=client)
 
+        # ... and their encoded parts, between which requests are joined
+        self._generic_parts = self._encode_template(
+            self._GENERIC, 'request_type', 'args')
+        self._shipping_parts = self._encode_template(
+            self._SHIPPING, 'system', 'loadings')
+
         # Prepare argument patterns
         tags = ['delivery_days', 'egn', 'ein', 'id', 'updated_time']
         self._arg_patterns = \
             {tag: '<{tag}>{{}}</{tag}>'.format(tag=tag) \
                  for tag in tags}
 
+    @staticmethod
+    def _encode_template(template, *fields):
+        """
+        Split `template` at the `{field}` placeholders and encode the
+        parts to UTF-8, once.
+
+        """
+        parts = []
+        for field in fields:
+            head, template = template.split('{' + field + '}', 1)
+            parts.append(head.encode('utf-8'))
+        parts.append(template.encode('utf-8'))
+        return parts
+
+    def _generic_xml(self, request_type, args=''):
+        """Return the encoded XML request of `request_type`."""
+        head, middle, tail = self._generic_parts
+        if isinstance(args, xmlutils.text_type):
+            args = args.encode('utf-8')
+        return b''.join((head, request_type.encode('utf-8'), middle, args,
+                         tail))
+
     def _args(self, **kwargs):
         args = []
         for k in filter(lambda e: kwargs[e] is not None, kwargs):
@@ -230,42 +439,108 @@ class RemoteEcontXml(RemoteEcont):
     def _convert_xml_to_dict(self, xml):
         try:
             data = xmlutils.xml2dict(xml)
-            return data.get('response', data)
-        except:
-            return {}
+        except Exception as e:
+            raise ResponseError('Invalid response: {!r}'.format(e))
+        return data.get('response', data)
+
+    def _delivery_days_result(self, response):
+        return [{'date': datetime.datetime.strptime(e['date'], '%Y-%m-%d').date()}
+                for e in response if e and 'date' in e]
+
+    def _emit(self, event, error=None):
+        event.finish(error)
+        for observer in self._observers:
+            try:
+                observer(event)
+            except Exception:
+                _log.exception('Observer %r failed', observer)
+
+    _ACCEPT_ENCODING = 'gzip, deflate'
+
+    def _accept_encoding(self, request_type):
+        if 'accept_encoding' not in getattr(self._transfer_class, 'options',
+                                            ()):
+            return None
+        compression = self._compression
+        if compression is True or (compression is not False and
+                                   request_type in compression):
+            return self._ACCEPT_ENCODING
+        return None
+
+    def _create_transfer(self, request_type=None):
+        options = getattr(self._transfer_class, 'options', ())
+        kwargs = {}
+        if self._pool is not None:
+            kwargs['pool'] = self._pool
+        if self._connect_timeout is not None and 'connect_timeout' in options:
+            kwargs['connect_timeout'] = self._connect_timeout
+        if self._timeout is not None and 'timeout' in options:
+            kwargs['timeout'] = self._timeout
+        accept_encoding = self._accept_encoding(request_type)
+        if accept_encoding is not None:
+            kwargs['accept_encoding'] = accept_encoding
+        return self._transfer_class(**kwargs)
+
+    def _record_transfer(self, event, t, url, response):
+        if event is None:
+            return
+        event.url = url
+        event.transfer_info = t.info or {}
+        if 'size_upload' in event.transfer_info:
+            event.request_bytes = int(event.transfer_info['size_upload'])
+        if 'size_download' in event.transfer_info:
+            event.wire_bytes = int(event.transfer_info['size_download'])
+        if isinstance(response, list):
+            event.response_bytes = sum(len(chunk) for chunk in response)
+        else:
+            event.response_bytes = len(response) if response is not None \
+                else None
 
-    def _generic_request(self, request_type, args=''):
-        xml = self._GENERIC.format(request_type=request_type, args=args)
-        return self._send_xml_service(xml)
+    def _send_xml(self, xml, url, event=None, idempotent=False):
+        send = self._send_xml_once
+        if self._circuit_breaker is not None:
+            send = lambda *args: self._circuit_breaker.call(
+                self._send_xml_once, *args)
+        if idempotent and self._retry is not None:
+            return self._retry.call(send, xml, url, event)
+        return send(xml, url, event)
 
-    def _send_xml(self, xml, url):
-        t = self._transfer_class()
+    def _send_xml_once(self, xml, url, event=None):
+        t = self._create_transfer(event.request_type if event else None)
 
         # t.append_data('xml', xml)
         t.append_str_as_file(
             'file', xml, 'application/xml; charset=UTF-8', 'something.xml')
 
-        response = t.perform(url)
-        t.close()
-        return response
+        # the chunks go to the parser as they are; transfers that do
+        # not derive from `Transfer` may only have `perform`
+        perform = getattr(t, 'perform_chunks', t.perform)
+        response = None
+        try:
+            response = perform(url)
+            return response
+        finally:
+            self._record_transfer(event, t, url, response)
+            t.close()
+
+    def _send_xml_parcel(self, xml, event=None):
+        return self._send_xml(xml, self._parcel_url, event)
 
-    def _send_xml_parcel(self, xml):
-        return self._send_xml(xml, self._parcel_url)
+    def _send_xml_service(self, xml, event=None):
+        return self._send_xml(xml, self._service_url, event, idempotent=True)
 
-    def _send_xml_service(self, xml):
-        return self._send_xml(xml, self._service_url)
+    def _extract(self, data, request_type, key=None):
+        """
+        Pick the list of records for `request_type` out of a converted
+        response.
 
-    def _shorthand(self, request_type, args='', key=None):
+        """
         if key is None:
             key = request_type
 
-        xml = self._generic_request(request_type, args)
-        data = self._convert_xml_to_dict(xml)
-
         try:
             if key != '':
-                # TODO: basestring won't work for python 3
-                if isinstance(data[key], basestring):
+                if isinstance(data[key], xmlutils.string_types):
                     ret = data[key]
                 else:
                     ret = data[key].get('e', data[key])
@@ -279,6 +554,126 @@ class RemoteEcontXml(RemoteEcont):
         # we should always return a list for consistency
         return ret if isinstance(ret, list) else [ret]
 
+    def _shipping_result_rows(self, count, response, error=None):
+        """
+        Split a `shipping` response into exactly `count` result rows.
+        Missing rows are replaced by a row with just an `error` key.
+
+        """
+        try:
+            rows = response['result']['e']
+        except (KeyError, TypeError):
+            rows = []
+        if not isinstance(rows, list):
+            rows = [rows]
+
+        error = error or 'Missing result row'
+        rows = rows[:count] + [None] * (count - len(rows))
+        return [row if isinstance(row, dict) else {'error': error}
+                for row in rows]
+
+    def _shorthand(self, request_type, args='', key=None, event=None):
+        if event is None:
+            event = CallEvent(request_type)
+
+        try:
+            with event.phase('build'):
+                xml = self._generic_xml(request_type, args)
+            with event.phase('transfer'):
+                response = self._send_xml_service(xml, event)
+            with event.phase('parse'):
+                data = self._convert_xml_to_dict(response)
+                ret = self._extract(data, request_type, key)
+        except Exception as e:
+            self._emit(event, e)
+            raise
+
+        self._emit(event)
+        return ret
+
+    def _stream_shorthand(self, request_type, args='', tag='e',
+                          record_type=None):
+        """
+        Like `_shorthand`, but return a generator that yields the
+        response records one by one while the response is still being
+        downloaded and parsed.  Only one record is kept in memory at a
+        time.
+
+        Records are dictionaries, or instances of `record_type` (see
+        `remoteecont.records`) if given.
+
+        One `CallEvent` is emitted when the stream ends.  Its `transfer`
+        phase covers the download and parsing of the whole response,
+        including the time spent by the caller between records.
+
+        """
+        if record_type is not None:
+            convert = record_type.from_element
+        else:
+            convert = xmlutils.element_value
+
+        event = CallEvent(request_type)
+        with event.phase('build'):
+            xml = self._generic_xml(request_type, args)
+
+        # Records already yielded cannot be taken back, so a stream is
+        # never retried, but it still counts for the circuit breaker
+        breaker = self._circuit_breaker
+        if breaker is not None:
+            try:
+                breaker.allow()
+            except Exception as e:
+                self._emit(event, e)
+                raise
+
+        t = None
+        parser = xmlutils._RecordParser(tag, convert=convert)
+        response_bytes = 0
+        ok = received = False
+        error = None
+        try:
+            with event.phase('transfer'):
+                t = self._create_transfer(request_type)
+                t.append_str_as_file(
+                    'file', xml, 'application/xml; charset=UTF-8',
+                    'something.xml')
+                for chunk in t.stream(self._service_url):
+                    response_bytes += len(chunk)
+                    for record in parser.feed(chunk):
+                        received = True
+                        yield record
+                for record in parser.close():
+                    received = True
+                    yield record
+            if not received and parser.error:
+                # what `_shorthand` returns as an `error` record
+                raise ResponseError(parser.error)
+            ok = True
+        except xmlutils.etree.ParseError as e:
+            error = ResponseError('Invalid response: {!r}'.format(e))
+            raise error
+        except GeneratorExit:
+            # closed by the caller; the service did answer if records
+            # arrived
+            ok = received
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if t is not None:
+                self._record_transfer(event, t, self._service_url, None)
+                event.response_bytes = response_bytes
+                t.close()
+            if breaker is not None:
+                if ok:
+                    breaker.record()
+                elif error is not None:
+                    breaker.record(error)
+                else:
+                    breaker.record_failure()
+            self._emit(event, error)
+
     def access_clients(self):
         """
         Информация за клиентите на текущия потребител.
@@ -300,6 +695,42 @@ class RemoteEcontXml(RemoteEcont):
         """
         raise NotImplementedError
 
+    def add_observer(self, observer):
+        """Call `observer` with a `CallEvent` after every call."""
+        self._observers.append(observer)
+
+    def batch(self, http2=True, linger=0.01):
+        """
+        Return a `remoteecont.batching.Batch` running the calls made on
+        it concurrently on one curl multi handle::
+
+            with econt.batch() as batch:
+                offices = batch.offices()
+                days = batch.delivery_days()
+            print(offices.result(), days.result())
+
+        See `Batch` for `http2` and `linger`.
+
+        """
+        from remoteecont.batching import Batch
+        return Batch(self, http2, linger)
+
+    def outbox(self, path, **kwargs):
+        """
+        Return a `remoteecont.outbox.ShipmentOutbox` sending the
+        loadings queued in the SQLite database `path` with this client;
+        `kwargs` are passed on to it.
+
+        """
+        from remoteecont.outbox import ShipmentOutbox
+        return ShipmentOutbox(self, path, **kwargs)
+
+    def close(self):
+        """Release the pooled connections, if any."""
+        if self._pool is not None and self._own_pool:
+            self._pool.close()
+        self._pool = None
+
     def cities(self, cities=None, updated_time=None):
         args = self._args(cities=cities, updated_time=updated_time)
         return self._shorthand('cities', args)
@@ -347,17 +778,28 @@ class RemoteEcontXml(RemoteEcont):
             delivery_days = datetime.date.today()
         args = self._args(delivery_days=delivery_days)
         response = self._shorthand('delivery_days', args=args)
-        return map(
-            lambda e: {
-                'date': datetime.datetime.strptime(
-                    e['date'], '%Y-%m-%d'
-                ).date()
-            },
-            filter(lambda e: e and 'date' in e, response)
-        )
+        return self._delivery_days_result(response)
+
+    def iter_cities_quarters(self, cities=None, updated_time=None,
+                             record_type=None):
+        """Streaming version of `cities_quarters`."""
+        args = self._args(cities=cities, updated_time=updated_time)
+        return self._stream_shorthand('cities_quarters', args, record_type=record_type)
+
+    def iter_cities_streets(self, cities=None, updated_time=None,
+                            record_type=None):
+        """Streaming version of `cities_streets`."""
+        args = self._args(cities=cities, updated_time=updated_time)
+        return self._stream_shorthand('cities_streets', args, record_type=record_type)
+
+    def iter_offices(self, updated_time=None, record_type=None):
+        """Streaming version of `offices`."""
+        args = self._args(updated_time=updated_time)
+        return self._stream_shorthand('offices', args, record_type=record_type)
 
     def offices(self, updated_time=None):
-        return self._shorthand('offices', updated_time)
+        args = self._args(updated_time=updated_time)
+        return self._shorthand('offices', args)
 
     def post_boxes(self):
         return self._shorthand('post_boxes')
@@ -374,151 +816,102 @@ class RemoteEcontXml(RemoteEcont):
         """
         raise NotImplementedError
 
-    def shipments(self, sender_city, receiver_city, _id, full_tracking='ON'):
+    def shipments(self, nums, full_tracking='ON'):
         """
         Информация за статуса на товарителници.
+
+        `nums` is a waybill number or a list of them, all asked for in
+        one request; with `full_tracking` 'ON' every shipment comes
+        with its tracking history.  Return one record per shipment.
+
         """
-        raise NotImplementedError
+        if isinstance(nums, xmlutils.string_types + (int,)):
+            nums = [nums]
+        args = self._SHIPMENTS.format(
+            full_tracking=full_tracking,
+            nums=''.join('<num>{}</num>'.format(n) for n in nums))
+        return self._shorthand('shipments', args)
 
     def shipping(self, loadings, system):
         """Генериране на пратка в е-еконт, тарифиране на пощенска пратка.
 
         """
-        # sender   --> подател за товарителницата
-        # receiver --> получател
-        # shipment --> информация за товарителницата
-        default = {
-            'sender' : {
-                'city'               : '', # град на изпращача
-                'post_code'          : '', # пощенски код
-                'office_code'        : '', # офис код, ако се пр от офс
-                'name'               : '', # име на фирма подател
-                'name_person'        : '', # име на човек подател
-                'quarter'            : '', # квартал
-                'street'             : '', # улица
-                'street_num'         : '', # уличен №
-                'street_bl'          : '', # блок
-                'street_vh'          : '', # вход
-                'street_et'          : '', # етаж
-                'street_ap'          : '', # № апартамент
-                'street_other'       : '', # доп. информация
-                'phone_num'          : ''  # телефонен номер
-            },
-
-            'receiver': {
-                'city'               : '', # Абсолютно същото като
-                'post_code'          : '', # за подателя
-                'office_code'        : '',
-                'name'               : '',
-                'name_person'        : '',
-                'receiver_email'     : '',
-                'quarter'            : '',
-                'street'             : '',
-                'street_num'         : '',
-                'street_bl'          : '',
-                'street_vh'          : '',
-                'street_et'          : '',
-                'street_ap'          : '',
-                'street_other'       : '',
-                'phone_num'          : ''},
-
-            'shipment': {
-                'envelope_num'       : '', # номер опаковка?!
-
-                # тип пратка, едно от следните:
-                # PACK, DOCUMENT, PALLET, CARGO,
-                # DOCUMENTPALLET
-                'shipment_type'      : '',
-                'description'        : '', # описание
-                'pack_count'         : '', # брой пакети?!
-                'weight'             : '', # тегло (В КИЛОГРАМИ)
-                'tariff_code'        : '', # МИСТИКА!
-                'tariff_sub_code'    : '', # DOOR_OFFICE, D_D, O_D, O_O
-                'pay_after_accept'   : '', # плащане след получаване?
-                'pay_after_test'     : '', # плащане след проба
-                'delivery_day'       : ''  # ЗАГАДКА!
-            },
-
-            'payment': {
-
-                # SENDER, RECEIVER, OTHER
-                'side'               : '', # страна платец
-
-                # CASH, CREDIT, BONUS, VOUCHER
-                'method'             : '',
-
-                # Сума за споделяне с получателя (ако е за
-                # сметка на подателя)
-                'receiver_share_sum' : '',
-
-                # Процент за споделяне с получателя
-                'share_percent'      : '',
-
-                # Клиентски номер на платеца, само при плащане
-                # на кредит
-                'key_word'           : ''
-            },
-
-            'services': {
-                # наложен платеж
-
-                # Малко е безумен тоя начин за представяне на
-                # атрибутите, честно казано... не помня вече какво съм
-                # си мислил тогава и що така съм го оставил; пък и не
-                # е добра абстракция на ХМЛ, FIXME :) По–добре би било
-                # атрибутите да отиват в речници с този синтаксис:
-                # таг__имеНаАтрибута = {...}
-                'cd'                 : {'__content__': '',
-                                        '__attrib__' : {'type': ''}},
-                'cd_agreement_num'   : '', # споразумение за защита НП
-                'cd_curreny'         : '', # валута
-                'dc'                 : '', # обратна разписка
-                'dc_cp'              : '', # стокова разписка
-                'dp'                 : '', # двупосочна пратка
-                'e'                  : '', # доставка същия ден
-                'e1'                 : '', # доставка до  60 мин
-                'e2'                 : '', # доставка до  90 мин
-                'e3'                 : '', # доставка до 120 мин
-                'oc'                 : '', # обявена стойност
-                'oc_currency'        : '', # валута на `oc`
-                'p'                  : '', # преоритет (ON/"")
-                'pack1'              : '', # доп. опаковка (ON/"")
-                'pack2'              : '',
-                'pack3'              : '',
-                'pack4'              : '',
-                'pack5'              : '',
-                'pack6'              : '',
-                'pack7'              : '',
-                'pack8'              : '',
-                'ref'                : '', # хладилна чанта (ON/"")
-            }
-        }
-
-        # Prepare <loadings>
+        event = CallEvent('shipping')
+        try:
+            with event.phase('build'):
+                xml = self._shipping_xml(loadings, system)
+            with event.phase('transfer'):
+                response_xml = self._send_xml_parcel(xml, event)
+
+            # Parse and return the result
+            with event.phase('parse'):
+                ret = self._convert_xml_to_dict(response_xml)
+        except Exception as e:
+            self._emit(event, e)
+            raise
+
+        self._emit(event)
+        return ret
+
+    def _shipping_xml(self, loadings, system):
+        """Prepare the XML request of `shipping`."""
+        # Prepare <loadings>, merging every row over the defaults
         if not isinstance(loadings, Sequence):
             loadings = [loadings]
 
-        rows = []
+        out = ['<loadings>']
         for row in loadings:
-            fusion = copy.deepcopy(default)
-            fusion.update(row)
-            rows.append(fusion)
-
-        loadings_data = {'loadings': {'row': rows}}
-        loadings_xml = xmlutils.dict2xml(loadings_data)
+            self._LOADING.write(out, row)
+        out.append('</loadings>')
+        loadings_xml = ''.join(out).encode('utf-8')
 
         # Prepare <system>
         system = system or {}
         system = system.get('system', system) # lolwut? :D
-        system_data = {'system': system}
-        system_xml = xmlutils.dict2xml(system_data)
+        system_xml = xmlutils.dumps({'system': system}).encode('utf-8')
 
-        # Prepare and send XML data
-        xml = self._SHIPPING.format(loadings=loadings_xml, system=system_xml)
-        response_xml = self._send_xml_parcel(xml)
+        head, middle, tail = self._shipping_parts
+        return b''.join((head, system_xml, middle, loadings_xml, tail))
 
-        # Parse and return the result
-        return self._convert_xml_to_dict(response_xml)
+    def shipping_bulk(self, loadings, system=None, chunk_size=100,
+                      max_workers=4):
+        """
+        Send many loadings as several `shipping` requests of at most
+        `chunk_size` loadings each, running up to `max_workers` of them
+        at the same time.  Use together with a connection pool of at
+        least `max_workers` connections.
+
+        Return a list with one result row per loading, in the order of
+        `loadings`.  If a whole request fails, each of its loadings
+        gets a row with just an `error` key, so one failed chunk does
+        not affect the rest of the batch.
+
+        """
+        loadings = list(loadings)
+        results = [None] * len(loadings)
+        chunks = [(start, loadings[start:start + chunk_size])
+                  for start in range(0, len(loadings), chunk_size)]
+
+        def send(chunk):
+            start, rows = chunk
+            try:
+                response, error = self.shipping(rows, system), None
+            except Exception as e:
+                response, error = None, '{}: {}'.format(type(e).__name__, e)
+            results[start:start + len(rows)] = \
+                self._shipping_result_rows(len(rows), response, error)
+
+        if chunks:
+            # imported here, multiprocessing is slow to import
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(max_workers, len(chunks)))
+            try:
+                pool.map(send, chunks)
+            finally:
+                pool.close()
+                pool.join()
+
+        return results
 
     def tariff_courier(self):
         return self._shorthand('tariff_courier', key='service_types')
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+One client for many Econt accounts.
+
+All accounts share one pool of connections; each account has its own
+client, with its credentials rendered into the request templates once,
+and its own token bucket rate limit::
+
+    econt = MultiAccountEcont(SERVICE_URL, PARCEL_URL, CurlTransfer,
+                              pool_size=20, rate=5, burst=10)
+    econt.add_account('merchant-1', 'user1', 'pass1')
+    econt.add_account('merchant-2', 'user2', 'pass2', rate=20)
+
+    econt['merchant-1'].shipping(loadings, system)
+
+"""
+
+from __future__ import unicode_literals
+
+import threading
+
+from remoteecont import RemoteEcontXml
+from remoteecont.policy import TokenBucket
+
+__all__ = [
+    'MultiAccountEcont'
+]
+
+
+class _RateLimited(object):
+    """Mixin taking a token of `_bucket` before every transfer."""
+
+    _bucket = None
+    _rate_limit_timeout = None
+
+    def _create_transfer(self, request_type=None):
+        if self._bucket is not None:
+            self._bucket.acquire(timeout=self._rate_limit_timeout)
+        return super(_RateLimited, self)._create_transfer(request_type)
+
+
+class MultiAccountEcont(object):
+    """
+    Clients for many accounts sharing one connection pool.
+
+    `client_class` is the class of the per-account clients, e.g.
+    `remoteecont.cache.CachedRemoteEcontXml`; `kwargs` are passed on to
+    it.  `rate` and `burst` are the default rate limit of an account
+    in requests per second (None for no limit).  A request that would
+    wait more than `rate_limit_timeout` seconds for its account's limit
+    raises `RateLimitExceeded` instead; by default it waits.
+
+    Retries count against the rate limit, since each attempt is a
+    request to Econt.
+
+    """
+
+    def __init__(self, service_url, parcel_url, transfer_class, pool_size=10,
+                 pool_idle_timeout=60, rate=None, burst=None,
+                 rate_limit_timeout=None, client_class=RemoteEcontXml,
+                 **kwargs):
+        self.service_url = service_url
+        self.parcel_url = parcel_url
+        self.transfer_class = transfer_class
+        self.rate = rate
+        self.burst = burst
+        self.rate_limit_timeout = rate_limit_timeout
+
+        self._pool = transfer_class.create_pool(pool_size, pool_idle_timeout)
+        self._class = type(str('RateLimited' + client_class.__name__),
+                           (_RateLimited, client_class), {})
+        self._kwargs = kwargs
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def add_account(self, account, username, password, rate=None,
+                    burst=None):
+        """
+        Add (or replace) `account` with its credentials.  `rate` and
+        `burst` override the default rate limit.
+
+        """
+        client = self._class(self.service_url, self.parcel_url, username,
+                             password, self.transfer_class, pool=self._pool,
+                             **self._kwargs)
+        rate = rate if rate is not None else self.rate
+        if rate is not None:
+            client._bucket = TokenBucket(
+                rate, burst if burst is not None else self.burst)
+        client._rate_limit_timeout = self.rate_limit_timeout
+
+        with self._lock:
+            self._clients[account] = client
+        return client
+
+    def remove_account(self, account):
+        with self._lock:
+            client = self._clients.pop(account, None)
+        if client is not None:
+            client.close()
+
+    def __getitem__(self, account):
+        """The client of `account`; raise `KeyError` for unknown ones."""
+        return self._clients[account]
+
+    def __contains__(self, account):
+        return account in self._clients
+
+    def __len__(self):
+        return len(self._clients)
+
+    def accounts(self):
+        return list(self._clients)
+
+    def close(self):
+        """Close the clients and the shared pool."""
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for client in clients.values():
+            client.close()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
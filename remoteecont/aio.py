@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio flavour of `RemoteEcontXml`.  Requires Python 3.7 or newer.
+
+"""
+
+import asyncio
+import datetime
+from collections import deque
+
+import pycurl
+
+from remoteecont import ResponseError, RemoteEcontXml
+from remoteecont import xmlutils
+from remoteecont.metrics import CallEvent
+from remoteecont.transfer import CurlTransfer
+
+__all__ = [
+    'AsyncCurlTransfer',
+    'AsyncRemoteEcontXml',
+    'CurlMultiLoop'
+]
+
+
+class CurlMultiLoop(object):
+    """
+    Drive a `pycurl.CurlMulti` from an asyncio event loop using the
+    curl socket action interface.
+
+    Any number of transfers may run on the same multi handle; they
+    share its connection cache, of which at most `size` connections
+    are kept.  The object is bound to the event loop that runs its
+    first transfer.
+
+    """
+
+    def __init__(self, size=None, idle_timeout=None):
+        self._loop = None
+        self._timer = None
+        self._futures = {}
+
+        self._multi = pycurl.CurlMulti()
+        self._multi.setopt(pycurl.M_SOCKETFUNCTION, self._on_socket)
+        self._multi.setopt(pycurl.M_TIMERFUNCTION, self._on_timer)
+        if size:
+            self._multi.setopt(pycurl.M_MAXCONNECTS, size)
+
+    def perform(self, curl):
+        """
+        Start the transfer of the `curl` easy handle and return a
+        future that is resolved when it completes.
+
+        """
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+
+        future = self._loop.create_future()
+        self._futures[curl] = future
+        self._multi.add_handle(curl)
+        self._socket_action(pycurl.SOCKET_TIMEOUT, 0)
+        return future
+
+    def discard(self, curl):
+        """
+        Stop the transfer of `curl`, if it is still running, and cancel
+        its future; used when the awaiting task is cancelled.
+
+        """
+        future = self._futures.pop(curl, None)
+        if future is None:
+            return
+        self._multi.remove_handle(curl)
+        future.cancel()
+
+    def _on_socket(self, event, fd, multi, data):
+        if event == pycurl.POLL_REMOVE:
+            self._loop.remove_reader(fd)
+            self._loop.remove_writer(fd)
+            return
+
+        if event in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+            self._loop.add_reader(fd, self._socket_action, fd,
+                                  pycurl.CSELECT_IN)
+        else:
+            self._loop.remove_reader(fd)
+
+        if event in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+            self._loop.add_writer(fd, self._socket_action, fd,
+                                  pycurl.CSELECT_OUT)
+        else:
+            self._loop.remove_writer(fd)
+
+    def _on_timer(self, timeout_ms):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if timeout_ms >= 0:
+            self._timer = self._loop.call_later(
+                timeout_ms / 1000.0, self._socket_action,
+                pycurl.SOCKET_TIMEOUT, 0)
+
+    def _socket_action(self, fd, event):
+        while True:
+            ret, _ = self._multi.socket_action(fd, event)
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        self._collect()
+
+    def _collect(self):
+        while True:
+            queued, ok, failed = self._multi.info_read()
+            for curl in ok:
+                self._finish(curl, None)
+            for curl, errno, message in failed:
+                self._finish(curl, pycurl.error(errno, message))
+            if not queued:
+                break
+
+    def _finish(self, curl, error):
+        self._multi.remove_handle(curl)
+        future = self._futures.pop(curl)
+        if future.done():
+            return
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        for curl, future in list(self._futures.items()):
+            self._multi.remove_handle(curl)
+            future.cancel()
+        self._futures.clear()
+        self._multi.close()
+
+
+class AsyncCurlTransfer(CurlTransfer):
+    """
+    `CurlTransfer` whose `perform` is a coroutine.  Transfers created
+    with the same `pool` (a `CurlMultiLoop`) run concurrently on one
+    multi handle.
+
+    """
+
+    def __init__(self, pool=None, connect_timeout=None, timeout=None,
+                 accept_encoding=None):
+        self._own_multi = pool is None
+        self._multi = CurlMultiLoop() if pool is None else pool
+        super(AsyncCurlTransfer, self).__init__(
+            connect_timeout=connect_timeout, timeout=timeout,
+            accept_encoding=accept_encoding)
+
+    @classmethod
+    def create_pool(cls, size, idle_timeout):
+        return CurlMultiLoop(size, idle_timeout)
+
+    async def perform(self, url):
+        """
+        Perform a request.  Argument `url` should be a byte string.
+        """
+        return b''.join(await self.perform_chunks(url))
+
+    async def perform_chunks(self, url):
+        out = []
+        self._setup(url, out.append)
+
+        try:
+            await self._multi.perform(self._curl)
+        except asyncio.CancelledError:
+            self._multi.discard(self._curl)
+            raise
+        except pycurl.error as e:
+            raise self._error(*e.args)
+        finally:
+            self._collect_info()
+
+        self._check_status()
+        return out
+
+    async def stream(self, url):
+        """
+        Asynchronous generator version of `CurlTransfer.stream`: yield
+        the response body chunk by chunk, as curl receives it.
+
+        """
+        chunks = deque()
+        arrived = asyncio.Event()
+
+        def write(chunk):
+            chunks.append(chunk)
+            arrived.set()
+
+        self._setup(url, write, stream=True)
+        done = self._multi.perform(self._curl)
+        done.add_done_callback(lambda _: arrived.set())
+        try:
+            checked = False
+            while chunks or not done.done():
+                if not chunks:
+                    await arrived.wait()
+                    arrived.clear()
+                    continue
+                if not checked:
+                    self._check_status()
+                    checked = True
+                while chunks:
+                    yield chunks.popleft()
+
+            try:
+                done.result()
+            except pycurl.error as e:
+                raise self._error(*e.args)
+            finally:
+                self._collect_info()
+            self._check_status()
+        finally:
+            # a no-op once the transfer is complete
+            self._multi.discard(self._curl)
+
+    def close(self):
+        self._curl.close()
+        if self._own_multi:
+            self._multi.close()
+
+
+class AsyncRemoteEcontXml(RemoteEcontXml):
+    """
+    `RemoteEcontXml` whose public methods are coroutines.
+
+    Request templates and response conversion are shared with
+    `RemoteEcontXml`; only sending goes through an asynchronous
+    transfer.  All requests of a client run on one `CurlMultiLoop`
+    with at most `pool_size` cached connections, so the client should
+    be used from a single event loop.  `batch` and `outbox` work with
+    synchronous clients only.
+
+    """
+
+    def __init__(self, service_url, parcel_url, username, password,
+                 transfer_class=AsyncCurlTransfer, pool_size=10, **kwargs):
+        super(AsyncRemoteEcontXml, self).__init__(
+            service_url, parcel_url, username, password, transfer_class,
+            pool_size, **kwargs)
+
+    async def _send_xml(self, xml, url, event=None, idempotent=False):
+        retry = self._retry if idempotent else None
+        delays = retry.delays() if retry is not None else iter(())
+        breaker = self._circuit_breaker
+
+        while True:
+            try:
+                if breaker is None:
+                    return await self._send_xml_once(xml, url, event)
+                breaker.allow()
+                try:
+                    response = await self._send_xml_once(xml, url, event)
+                except Exception as e:
+                    breaker.record(e)
+                    raise
+                breaker.record()
+                return response
+            except Exception as e:
+                delay = None
+                if retry is not None and retry.should_retry(e):
+                    delay = next(delays, None)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    async def _send_xml_once(self, xml, url, event=None):
+        t = self._create_transfer(event.request_type if event else None)
+
+        t.append_str_as_file(
+            'file', xml, 'application/xml; charset=UTF-8', 'something.xml')
+
+        response = None
+        try:
+            response = await t.perform_chunks(url)
+            return response
+        finally:
+            self._record_transfer(event, t, url, response)
+            t.close()
+
+    async def _shorthand(self, request_type, args='', key=None, event=None):
+        if event is None:
+            event = CallEvent(request_type)
+
+        try:
+            with event.phase('build'):
+                xml = self._generic_xml(request_type, args)
+            with event.phase('transfer'):
+                response = await self._send_xml_service(xml, event)
+            with event.phase('parse'):
+                data = self._convert_xml_to_dict(response)
+                ret = self._extract(data, request_type, key)
+        except Exception as e:
+            self._emit(event, e)
+            raise
+
+        self._emit(event)
+        return ret
+
+    async def _stream_shorthand(self, request_type, args='', tag='e',
+                                record_type=None):
+        """
+        Asynchronous generator version of
+        `RemoteEcontXml._stream_shorthand`, used with `async for`.
+
+        """
+        if record_type is not None:
+            convert = record_type.from_element
+        else:
+            convert = xmlutils.element_value
+
+        event = CallEvent(request_type)
+        with event.phase('build'):
+            xml = self._generic_xml(request_type, args)
+
+        breaker = self._circuit_breaker
+        if breaker is not None:
+            try:
+                breaker.allow()
+            except Exception as e:
+                self._emit(event, e)
+                raise
+
+        t = None
+        parser = xmlutils._RecordParser(tag, convert=convert)
+        chunks = None
+        response_bytes = 0
+        ok = received = False
+        error = None
+        try:
+            with event.phase('transfer'):
+                t = self._create_transfer(request_type)
+                t.append_str_as_file(
+                    'file', xml, 'application/xml; charset=UTF-8',
+                    'something.xml')
+                chunks = t.stream(self._service_url)
+                async for chunk in chunks:
+                    response_bytes += len(chunk)
+                    for record in parser.feed(chunk):
+                        received = True
+                        yield record
+                for record in parser.close():
+                    received = True
+                    yield record
+            if not received and parser.error:
+                raise ResponseError(parser.error)
+            ok = True
+        except xmlutils.etree.ParseError as e:
+            error = ResponseError('Invalid response: {!r}'.format(e))
+            raise error
+        except (GeneratorExit, asyncio.CancelledError):
+            ok = received
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if chunks is not None:
+                await chunks.aclose()
+            if t is not None:
+                self._record_transfer(event, t, self._service_url, None)
+                event.response_bytes = response_bytes
+                t.close()
+            if breaker is not None:
+                if ok:
+                    breaker.record()
+                elif error is not None:
+                    breaker.record(error)
+                else:
+                    breaker.record_failure()
+            self._emit(event, error)
+
+    async def delivery_days(self, delivery_days=None):
+        if delivery_days is None:
+            delivery_days = datetime.date.today()
+        args = self._args(delivery_days=delivery_days)
+        response = await self._shorthand('delivery_days', args=args)
+        return self._delivery_days_result(response)
+
+    async def shipping(self, loadings, system):
+        event = CallEvent('shipping')
+        try:
+            with event.phase('build'):
+                xml = self._shipping_xml(loadings, system)
+            with event.phase('transfer'):
+                response_xml = await self._send_xml_parcel(xml, event)
+            with event.phase('parse'):
+                ret = self._convert_xml_to_dict(response_xml)
+        except Exception as e:
+            self._emit(event, e)
+            raise
+
+        self._emit(event)
+        return ret
+
+    def batch(self, http2=True, linger=0.01):
+        raise NotImplementedError(
+            'Batches run synchronous calls; with asyncio, gather the '
+            'coroutines instead')
+
+    def outbox(self, path, **kwargs):
+        raise NotImplementedError(
+            'The outbox sends with a synchronous client; pass it a '
+            'RemoteEcontXml')
+
+    async def shipping_bulk(self, loadings, system=None, chunk_size=100,
+                            max_workers=4):
+        """
+        Coroutine version of `RemoteEcontXml.shipping_bulk`; at most
+        `max_workers` chunks are sent at the same time.
+
+        """
+        loadings = list(loadings)
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def send(rows):
+            async with semaphore:
+                try:
+                    response, error = await self.shipping(rows, system), None
+                except Exception as e:
+                    response = None
+                    error = '{}: {}'.format(type(e).__name__, e)
+            return self._shipping_result_rows(len(rows), response, error)
+
+        chunks = await asyncio.gather(
+            *[send(loadings[start:start + chunk_size])
+              for start in range(0, len(loadings), chunk_size)])
+        return [row for rows in chunks for row in rows]
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+Batching of requests.
+
+`Batch` runs the calls made on it concurrently, in one go::
+
+    with econt.batch() as batch:
+        countries = batch.countries()
+        offices = batch.offices()
+        days = batch.delivery_days()
+    print(countries.result(), offices.result(), days.result())
+
+`CityBatcher` collects concurrent callers asking for single cities for
+a short window and sends them as one `cities` request with several
+`<city_name>` elements; the response is split back by name::
+
+    batcher = CityBatcher(econt, window=0.005, max_items=50)
+    batcher.cities('Варна')     # from any number of threads
+
+"""
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import copy
+import functools
+import threading
+import time
+
+from remoteecont.index import normalize
+from remoteecont.transfer import CurlTransfer, _import_pycurl
+
+__all__ = [
+    'Batch',
+    'BatchFuture',
+    'CityBatcher'
+]
+
+
+class BatchFuture(object):
+    """
+    Result of a call made on a `Batch`.  Asking for the result before
+    the batch is finished runs all calls queued so far.
+
+    """
+
+    def __init__(self, batch):
+        self._batch = batch
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        """Return the result of the call, or raise its exception."""
+        if not self._done.is_set():
+            self._batch.flush()
+            self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self):
+        if not self._done.is_set():
+            self._batch.flush()
+            self._done.wait()
+        return self._error
+
+    def _set(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done.set()
+
+
+class _Request(object):
+    """A prepared transfer waiting for its turn on the multi handle."""
+
+    def __init__(self, curl, call):
+        self.curl = curl
+        # queued by the thread of a batch call, which now waits for it
+        self.call = call
+        self.error = None
+        self.done = threading.Event()
+
+
+class Batch(object):
+    """
+    Run the calls of a `RemoteEcontXml` client concurrently.
+
+    Every public method of the client is available on the batch and
+    returns a `BatchFuture`.  The call starts at once on a copy of the
+    client that, instead of sending its request, queues the prepared
+    transfer.  When the batch is flushed, on leaving the `with` block
+    or when a result is asked for, all queued transfers run together on
+    one `pycurl.CurlMulti`, so the calls take as long as the slowest
+    one rather than the sum of all.  The responses are then parsed and
+    the futures resolved.
+
+    With `http2` the requests to an HTTPS endpoint are multiplexed over
+    one HTTP/2 connection when curl and the server support it; HTTP/1.1
+    requests use a connection each.  Retries, circuit breakers, caching
+    and rate limits of the client apply as usual; a retried request
+    runs in the next round of the same flush.
+
+    The queued transfers run as soon as every running call waits for
+    one of them.  Calls may also wait for something else, e.g. for the
+    same request of a concurrent cache miss, or for `shipping_bulk`
+    chunks sent from worker threads; the transfers then run once no new
+    one has been queued for `linger` seconds.
+
+    Clients with a transfer other than `CurlTransfer` are supported as
+    well, their calls running concurrently with a transfer each, as far
+    as the pool of the client allows.
+    Streaming methods (`iter_*`) are not batched.
+
+    """
+
+    def __init__(self, econt, http2=True, linger=0.01):
+        self.econt = econt
+        self.linger = linger
+
+        self._client = copy.copy(econt)
+        self._multi = None
+        if issubclass(econt._transfer_class, CurlTransfer):
+            pycurl = _import_pycurl()
+            # handles on the multi handle share its connection cache, so
+            # the transfers of the batch do not come from the pool
+            self._client._pool = None
+            self._client._send_xml_once = functools.partial(
+                self._send_xml_once, self._client)
+            self._multi = pycurl.CurlMulti()
+            self._http2 = http2 and bool(
+                pycurl.version_info()[4] & getattr(pycurl, 'VERSION_HTTP2', 0))
+            if self._http2 and hasattr(pycurl, 'M_PIPELINING'):
+                self._multi.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+
+        self._closed = False
+        # calls started and not finished, and those of them waiting for
+        # a queued or running transfer
+        self._running = 0
+        self._blocked = 0
+        self._queue = []
+        self._queued_at = None
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(self.econt, name)):
+            raise AttributeError(name)
+        return functools.partial(self.submit, name)
+
+    def submit(self, name, *args, **kwargs):
+        """Start the call of method `name` and return its `BatchFuture`."""
+        method = getattr(self._client, name)
+        future = BatchFuture(self)
+        with self._cond:
+            if self._closed:
+                raise ValueError('Cannot submit to a closed batch')
+            self._running += 1
+
+        thread = threading.Thread(target=self._call,
+                                  args=(future, method, args, kwargs))
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def _call(self, future, method, args, kwargs):
+        self._local.call = True
+        try:
+            future._set(result=method(*args, **kwargs))
+        except Exception as e:
+            future._set(error=e)
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+
+    def _send_xml_once(self, client, xml, url, event=None):
+        """`RemoteEcontXml._send_xml_once` queueing the transfer."""
+        pycurl = _import_pycurl()
+        t = client._create_transfer(event.request_type if event else None)
+        t.append_str_as_file(
+            'file', xml, 'application/xml; charset=UTF-8', 'something.xml')
+
+        out = []
+        response = None
+        try:
+            t._setup(url, out.append)
+            scheme = url[:6].lower()
+            if self._http2 and scheme in (b'https:', 'https:'):
+                # wait for a connection that can be multiplexed rather
+                # than open one more; over plain HTTP/1.1 this would
+                # serialize the requests
+                t._curl.setopt(pycurl.HTTP_VERSION,
+                               pycurl.CURL_HTTP_VERSION_2TLS)
+                t._curl.setopt(pycurl.PIPEWAIT, 1)
+
+            request = _Request(t._curl, getattr(self._local, 'call', False))
+            with self._cond:
+                self._queue.append(request)
+                self._queued_at = time.time()
+                if request.call:
+                    self._blocked += 1
+                self._cond.notify_all()
+            request.done.wait()
+
+            t._collect_info()
+            if request.error is not None:
+                raise t._error(*request.error)
+            t._check_status()
+            response = out
+            return response
+        finally:
+            client._record_transfer(event, t, url, response)
+            t.close()
+
+    def flush(self):
+        """
+        Run the queued transfers until every call made so far has
+        finished.
+
+        """
+        with self._flush_lock:
+            while True:
+                with self._cond:
+                    while True:
+                        if not self._queue:
+                            if not self._running:
+                                return
+                            self._cond.wait()
+                        elif self._blocked >= self._running:
+                            break
+                        else:
+                            idle = time.time() - self._queued_at
+                            if idle >= self.linger:
+                                break
+                            self._cond.wait(self.linger - idle)
+                    requests, self._queue = self._queue, []
+                self._perform(requests)
+
+    def _perform(self, requests):
+        pycurl = _import_pycurl()
+        multi = self._multi
+        by_curl = {}
+        try:
+            for request in requests:
+                multi.add_handle(request.curl)
+                by_curl[request.curl] = request
+
+            active = len(requests)
+            while active:
+                ret, active = multi.perform()
+                if ret == pycurl.E_CALL_MULTI_PERFORM:
+                    continue
+                if active:
+                    multi.select(1.0)
+
+            while True:
+                queued, _, failed = multi.info_read()
+                for curl, errno, message in failed:
+                    by_curl[curl].error = (errno, message)
+                if not queued:
+                    break
+        except Exception as e:
+            for request in requests:
+                if request.error is None:
+                    request.error = (None, '{}: {}'.format(type(e).__name__,
+                                                           e))
+        finally:
+            for curl, request in by_curl.items():
+                multi.remove_handle(curl)
+            with self._cond:
+                self._blocked -= sum(1 for r in requests if r.call)
+            for request in requests:
+                request.done.set()
+
+    def close(self):
+        """Finish all calls and release the multi handle."""
+        with self._cond:
+            self._closed = True
+        self.flush()
+        if self._multi is not None:
+            self._multi.close()
+            self._multi = None
+
+
+class _Batch(object):
+    """Names waiting to be sent in one request."""
+
+    def __init__(self):
+        self.names = OrderedDict()
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class CityBatcher(object):
+    """
+    Send concurrent `cities(name)` lookups as one request.
+
+    The first lookup of a batch waits up to `window` seconds for others
+    to join it, or until `max_items` distinct names are collected, and
+    then sends them all with `econt.cities(names)`; the lookups that
+    joined wait for its result.  Lookups of the same name in one batch
+    are sent once.  Names are matched in Cyrillic or Latin, regardless
+    of case.
+
+    The city dictionaries of a batch are shared by the callers that
+    asked for them and must not be modified.
+
+    `requests` and `lookups` count the upstream requests and the
+    lookups served, so that `lookups / requests` is the batching gain.
+
+    """
+
+    def __init__(self, econt, window=0.005, max_items=50):
+        self.econt = econt
+        self.window = window
+        self.max_items = max_items
+        self.requests = 0
+        self.lookups = 0
+
+        self._batch = None
+        self._lock = threading.Lock()
+
+    def cities(self, name):
+        """Return the list of cities called `name`."""
+        key = normalize(name)
+
+        with self._lock:
+            self.lookups += 1
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            batch.names.setdefault(key, name)
+            if len(batch.names) >= self.max_items:
+                # later lookups start a new batch
+                self._batch = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+                self.requests += 1
+            self._send(batch)
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return list(batch.result.get(key, ()))
+
+    def _send(self, batch):
+        try:
+            cities = self.econt.cities(list(batch.names.values()))
+            result = {}
+            for city in cities:
+                if not hasattr(city, 'get'):
+                    continue
+                keys = {normalize(city.get('name')),
+                        normalize(city.get('name_en'))}
+                for key in keys & set(batch.names):
+                    result.setdefault(key, []).append(city)
+            batch.result = result
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
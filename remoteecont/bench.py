@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of `RemoteEcontXml` against the local stand-in server.
+
+For every benchmarked call the time of each phase (building the
+request, the transfer, parsing the response), the end-to-end latency
+of the public method and the throughput of concurrent calls are
+measured, and the results are written as JSON so that runs of
+different versions can be compared::
+
+    python -m remoteecont.bench --output bench.json --latency 0.02
+
+`--imports` instead measures the time to import the library in a fresh
+interpreter and reports which heavy modules the import loads.
+
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+from remoteecont import RemoteEcontXml
+from remoteecont.standin import StandinServer
+from remoteecont.transfer import CurlTransfer, HttpTransfer
+
+__all__ = [
+    'BENCHMARKS',
+    'import_time',
+    'run'
+]
+
+TRANSFERS = {
+    'curl': CurlTransfer,
+    'http': HttpTransfer,
+}
+
+# modules whose import is expensive and should only happen on use
+HEAVY_MODULES = ('django', 'pycurl', 'lxml', 'http.client', 'socket',
+                 'multiprocessing', 'urllib.request', 'numpy')
+
+_IMPORT_SCRIPT = '''
+import sys, time
+start = time.time()
+import {module}
+elapsed = time.time() - start
+print(elapsed)
+print(' '.join(m for m in {heavy!r} if m in sys.modules))
+'''
+
+_LOADING = {
+    'sender': {'city': 'София', 'post_code': '1000', 'name': 'ИТ Партнър',
+               'phone_num': '0888 888 888'},
+    'receiver': {'city': 'Варна', 'post_code': '9000', 'name': 'Иван Иванов',
+                 'street': 'Шипка', 'street_num': '1'},
+    'shipment': {'shipment_type': 'PACK', 'weight': '2', 'pack_count': '1',
+                 'tariff_sub_code': 'DOOR_DOOR', 'description': 'книги'},
+    'payment': {'side': 'RECEIVER', 'method': 'CASH'},
+    'services': {'cd': {'__content__': '25.50', '__attrib__': {'type': 'GET'}}},
+}
+
+
+class Benchmark(object):
+    """
+    One benchmarked call, split in phases.
+
+    `build(econt)` returns the request XML, `send(econt, xml)` the raw
+    response chunks, `parse(econt, response)` the result, and `call(econt)`
+    runs the whole public method.
+
+    """
+
+    def __init__(self, name, build, send, parse, call):
+        self.name = name
+        self.build = build
+        self.send = send
+        self.parse = parse
+        self.call = call
+
+
+def _generic(name, request_type, key=None, **kwargs):
+    def build(econt):
+        return econt._generic_xml(request_type, econt._args(**kwargs))
+
+    def parse(econt, response):
+        return econt._extract(econt._convert_xml_to_dict(response),
+                              request_type, key)
+
+    return Benchmark(name, build,
+                     lambda econt, xml: econt._send_xml_service(xml),
+                     parse,
+                     lambda econt: getattr(econt, name)(**kwargs))
+
+
+def _shipping(name, rows):
+    loadings = [_LOADING] * rows
+    system = {'only_calculate': 1, 'validate': 0}
+    return Benchmark(name,
+                     lambda econt: econt._shipping_xml(loadings, system),
+                     lambda econt, xml: econt._send_xml_parcel(xml),
+                     lambda econt, response: econt._convert_xml_to_dict(response),
+                     lambda econt: econt.shipping(loadings, system))
+
+
+BENCHMARKS = [
+    _generic('offices', 'offices'),
+    _generic('cities_streets', 'cities_streets', key='cities_street'),
+    _generic('tariff_courier', 'tariff_courier', key='service_types'),
+    _generic('tariff_post', 'tariff_post', key='general_tariff'),
+    _shipping('shipping', 1),
+    _shipping('shipping_100', 100),
+]
+
+
+def _stats(samples):
+    samples = sorted(samples)
+    n = len(samples)
+    return {'n': n,
+            'min': samples[0],
+            'mean': sum(samples) / n,
+            'p50': samples[n // 2],
+            'p99': samples[min(n - 1, int(n * 0.99))],
+            'max': samples[-1]}
+
+
+def _measure(f, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = f()
+        samples.append(time.time() - start)
+    return _stats(samples), result
+
+
+def import_time(module='remoteecont', repeat=10):
+    """
+    Import `module` `repeat` times, each in a fresh interpreter, and
+    return the statistics of the import time and the `HEAVY_MODULES`
+    that the import loaded.
+
+    """
+    script = _IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    samples = []
+    loaded = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', script])
+        lines = output.decode('utf-8').splitlines()
+        samples.append(float(lines[0]))
+        loaded = lines[1].split() if len(lines) > 1 else []
+    return {'module': module,
+            'import': _stats(samples),
+            'loaded': loaded}
+
+
+def _throughput(econt, benchmark, concurrency, duration):
+    counts = [0] * concurrency
+    deadline = time.time() + duration
+
+    def worker(i):
+        while time.time() < deadline:
+            benchmark.call(econt)
+            counts[i] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    return {'concurrency': concurrency,
+            'calls': sum(counts),
+            'calls_per_second': sum(counts) / elapsed}
+
+
+def run(benchmarks=None, repeat=20, latency=0.0, records=None,
+        concurrency=8, duration=2.0, transfer_class=CurlTransfer):
+    """Run the benchmarks and return the results as a dictionary."""
+    server = StandinServer(latency=latency, records=records).start()
+    econt = RemoteEcontXml(server.service_url, server.parcel_url,
+                           'bench', 'bench', transfer_class,
+                           pool_size=concurrency)
+    results = {}
+    try:
+        for benchmark in benchmarks or BENCHMARKS:
+            build, xml = _measure(lambda: benchmark.build(econt), repeat)
+            transfer, response = _measure(
+                lambda: benchmark.send(econt, xml), repeat)
+            parse, _ = _measure(lambda: benchmark.parse(econt, response),
+                                repeat)
+            end_to_end, _ = _measure(lambda: benchmark.call(econt), repeat)
+
+            results[benchmark.name] = {
+                'request_bytes': len(xml),
+                'response_bytes': sum(len(chunk) for chunk in response),
+                'build': build,
+                'transfer': transfer,
+                'parse': parse,
+                'end_to_end': end_to_end,
+                'throughput': _throughput(econt, benchmark, concurrency,
+                                          duration),
+            }
+    finally:
+        econt.close()
+        server.stop()
+
+    return {
+        'meta': {
+            'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'transfer': transfer_class.__name__,
+            'repeat': repeat,
+            'latency': latency,
+            'records': server.records,
+            'concurrency': concurrency,
+        },
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--output', '-o', help='write the JSON results here')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='artificial server latency in seconds')
+    parser.add_argument('--records', type=int,
+                        help='number of records of nomenclature responses')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='seconds to run each throughput test')
+    parser.add_argument('--transfer', choices=sorted(TRANSFERS),
+                        default='curl')
+    parser.add_argument('--imports', action='store_true',
+                        help='measure the import time of the library')
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run (default: all)')
+    args = parser.parse_args(argv)
+
+    benchmarks = [b for b in BENCHMARKS if not args.names or b.name in args.names]
+    records = None
+    if args.records is not None:
+        records = {k: args.records
+                   for k in ('offices', 'cities', 'cities_streets')}
+
+    if args.imports:
+        results = {
+            'meta': {
+                'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'repeat': args.repeat,
+            },
+            'results': {'imports': import_time(repeat=args.repeat)},
+        }
+    else:
+        results = run(benchmarks, args.repeat, args.latency, records,
+                      args.concurrency, args.duration,
+                      TRANSFERS[args.transfer])
+
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
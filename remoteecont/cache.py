@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import threading
+import time
+
+from remoteecont import RemoteEcontXml
+from remoteecont.metrics import CallEvent
+
+__all__ = [
+    'CachedRemoteEcontXml',
+    'LRUCache'
+]
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping with a maximum number of entries and an
+    optional time to live (in seconds) for each entry.  When full, the
+    least recently used entry is evicted.
+
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Return a pair `(found, value)`."""
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return False, None
+
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return False, None
+
+            # re-insert as the most recently used entry
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return True, value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class _Call(object):
+    """An upstream request that other callers may wait for."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class CachedRemoteEcontXml(RemoteEcontXml):
+    """
+    `RemoteEcontXml` that caches the results of read-only calls in
+    memory.
+
+    `cache` maps a request type to a pair `(ttl, maxsize)`; request
+    types that are not in it are never cached.  Entries are keyed on
+    the request type and the rendered arguments XML.  Concurrent
+    misses for the same entry result in a single upstream request,
+    whose result is shared by all waiting callers.
+
+    Cached values are shared between callers and must not be mutated.
+
+    """
+
+    DEFAULT_CACHE = {
+        'client_info': (3600, 256),
+        'countries': (86400, 1),
+        'delivery_days': (3600, 32),
+        'tariff_courier': (3600, 1),
+        'tariff_post': (3600, 1)
+    }
+
+    def __init__(self, *args, **kwargs):
+        cache = kwargs.pop('cache', None)
+        if cache is None:
+            cache = self.DEFAULT_CACHE
+
+        super(CachedRemoteEcontXml, self).__init__(*args, **kwargs)
+
+        self._caches = {request_type: LRUCache(maxsize, ttl)
+                        for request_type, (ttl, maxsize) in cache.items()}
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def cache_info(self):
+        """Return the hit/miss counters and the size of every cache."""
+        return {request_type: {'coalesced': cache.coalesced,
+                               'hits': cache.hits,
+                               'misses': cache.misses,
+                               'size': len(cache)}
+                for request_type, cache in self._caches.items()}
+
+    def cache_clear(self):
+        for cache in self._caches.values():
+            cache.clear()
+
+    def _shorthand(self, request_type, args='', key=None, event=None):
+        cache = self._caches.get(request_type)
+        if cache is None:
+            return super(CachedRemoteEcontXml, self)._shorthand(
+                request_type, args, key, event)
+
+        cache_key = (args, key)
+        found, value = cache.get(cache_key)
+        if found:
+            self._emit(CallEvent(request_type, cache='hit'))
+            return value
+
+        with self._inflight_lock:
+            call = self._inflight.get((request_type, cache_key))
+            leader = call is None
+            if leader:
+                call = self._inflight[(request_type, cache_key)] = _Call()
+            else:
+                cache.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            self._emit(CallEvent(request_type, cache='coalesced'),
+                       call.error)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = super(CachedRemoteEcontXml, self)._shorthand(
+                request_type, args, key, CallEvent(request_type, cache='miss'))
+            cache.set(cache_key, call.result)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[(request_type, cache_key)]
+            call.event.set()
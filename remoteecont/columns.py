@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+Column-oriented export of nomenclature and tariff records for
+vectorised analysis::
+
+    offices = to_columns(econt.offices())
+    offices['latitude']             # float array, NaN where missing
+    offices['city_name']            # DictionaryColumn
+    offices['city_name'].mask('София')
+
+    lat, lon = coordinates(econt.offices())
+    km, i = nearest(customer_lat, customer_lon, lat, lon)
+
+    write_parquet('offices.parquet', offices)
+
+Numeric fields (see `FIELD_TYPES`) become NumPy arrays, or
+`array.array` without NumPy; all other fields are dictionary-encoded
+strings.  Nested dictionaries such as `address_details` are flattened
+to dotted names, e.g. `address_details.quarter`.  The Arrow and Parquet
+writers need pyarrow.
+
+"""
+
+from __future__ import unicode_literals
+
+from array import array
+from collections import OrderedDict
+
+from remoteecont.index import _EARTH_RADIUS, _coordinates
+from remoteecont.xmlutils import string_types, text_type
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = [
+    'DictionaryColumn',
+    'FIELD_TYPES',
+    'coordinates',
+    'nearest',
+    'tariff_columns',
+    'to_arrays',
+    'to_columns',
+    'to_table',
+    'write_arrow',
+    'write_npz',
+    'write_parquet'
+]
+
+# Types of the numeric fields of the nomenclatures and tariff tables;
+# codes such as `post_code` or `office_code` stay strings
+FIELD_TYPES = {
+    'id': int,
+    'city_id': int,
+    'id_city': int,
+    'id_country': int,
+    'id_office': int,
+    'id_zone': int,
+    'latitude': float,
+    'longitude': float,
+    'address_details.latitude': float,
+    'address_details.longitude': float,
+    'weight_from': float,
+    'weight_to': float,
+    'price': float,
+}
+
+# value of missing or invalid integers; floats are NaN
+MISSING_INT = -1
+
+_NAN = float('nan')
+
+
+def _array(typecode, items):
+    if numpy is not None:
+        return numpy.array(items, dtype={'i': numpy.int32, 'l': numpy.int64,
+                                         'd': numpy.float64}[typecode])
+    return array(str(typecode), items)
+
+
+class DictionaryColumn(object):
+    """
+    Dictionary-encoded string column: `values` holds each distinct
+    string once and `codes[i]` is the position in `values` of the i-th
+    string, or -1 if it is missing.
+
+    """
+
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    @classmethod
+    def encode(cls, items):
+        positions = {}
+        values = []
+        codes = []
+        for item in items:
+            if item is None:
+                codes.append(-1)
+                continue
+            code = positions.get(item)
+            if code is None:
+                code = positions[item] = len(values)
+                values.append(item)
+            codes.append(code)
+        return cls(_array('i', codes), values)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        code = self.codes[i]
+        return None if code < 0 else self.values[code]
+
+    def __repr__(self):
+        return 'DictionaryColumn({} rows, {} values)'.format(
+            len(self.codes), len(self.values))
+
+    def decode(self):
+        """Return the column as a list of strings (None if missing)."""
+        values = self.values
+        return [None if code < 0 else values[code] for code in self.codes]
+
+    def code(self, value):
+        """Return the code of `value`, or -1 if it does not occur."""
+        try:
+            return self.values.index(value)
+        except ValueError:
+            return -1
+
+    def mask(self, value):
+        """Rows equal to `value`: a boolean array, or a list without NumPy."""
+        code = self.code(value)
+        if numpy is not None:
+            return self.codes == code if code >= 0 else \
+                numpy.zeros(len(self.codes), dtype=bool)
+        return [c == code and code >= 0 for c in self.codes]
+
+
+def _scalar(value):
+    if isinstance(value, dict):
+        value = value.get('__content__')
+    if isinstance(value, list):
+        value = '; '.join(text_type(_scalar(v)) for v in value)
+    if value is None or value == '':
+        return None
+    return value
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return MISSING_INT
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return _NAN
+
+
+def _text(value):
+    if value is None or isinstance(value, string_types):
+        return value
+    return text_type(value)
+
+
+def _flatten(record):
+    """Yield the `(field, value)` pairs of a record, one level deep."""
+    if hasattr(record, '_asdict'):
+        fields = record._asdict()
+        extra = fields.pop('extra', None)
+        if extra:
+            fields.update(extra)
+        record = fields
+    for field, value in record.items():
+        if isinstance(value, dict) and '__content__' not in value:
+            for inner, inner_value in value.items():
+                yield '{}.{}'.format(field, inner), _scalar(inner_value)
+        else:
+            yield field, _scalar(value)
+
+
+def to_columns(records, fields=None, types=None):
+    """
+    Turn `records` (dictionaries or `remoteecont.records` tuples) into
+    an ordered dictionary of columns.  `fields` selects and orders the
+    columns, by default all fields in the order first seen.  `types`
+    maps fields to `int`, `float` or `str`, overriding `FIELD_TYPES`.
+
+    Integer columns hold `MISSING_INT` and float columns NaN for
+    missing or invalid values; string columns are `DictionaryColumn`.
+
+    """
+    kinds = dict(FIELD_TYPES)
+    kinds.update(types or {})
+
+    rows = [dict(_flatten(record)) for record in records
+            if hasattr(record, 'items') or hasattr(record, '_asdict')]
+    if fields is None:
+        fields = []
+        seen = set()
+        for row in rows:
+            for field in row:
+                if field not in seen:
+                    seen.add(field)
+                    fields.append(field)
+
+    columns = OrderedDict()
+    for field in fields:
+        values = [row.get(field) for row in rows]
+        kind = kinds.get(field)
+        if kind is int:
+            columns[field] = _array('l', [_int(v) for v in values])
+        elif kind is float:
+            columns[field] = _array('d', [_float(v) for v in values])
+        else:
+            columns[field] = DictionaryColumn.encode(
+                [_text(v) for v in values])
+    return columns
+
+
+def _rows_or_columns(data, fields, types):
+    if isinstance(data, dict) and all(
+            isinstance(c, (DictionaryColumn, array)) or hasattr(c, 'dtype')
+            for c in data.values()):
+        return data
+    return to_columns(data, fields, types)
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError('NumPy is required')
+
+
+def to_arrays(data, fields=None, types=None):
+    """
+    Return a dictionary of plain NumPy arrays, e.g. for `numpy.savez`:
+    numeric columns as they are, and for each string column `name` its
+    codes as `name` and its distinct values as `name.values`.  `data`
+    is the result of `to_columns` or records passed to it.
+
+    """
+    _require_numpy()
+    arrays = OrderedDict()
+    for name, column in _rows_or_columns(data, fields, types).items():
+        if isinstance(column, DictionaryColumn):
+            arrays[name] = numpy.asarray(column.codes, dtype=numpy.int32)
+            arrays[name + '.values'] = numpy.array(column.values, dtype=str)
+        else:
+            arrays[name] = numpy.asarray(column)
+    return arrays
+
+
+def tariff_columns(service_types):
+    """
+    Columns of the weight brackets of `tariff_courier()`: one row per
+    `shipment_type`, `tariff_sub_code` and bracket, with its
+    `weight_from`, `weight_to` and `price`.
+
+    """
+    def rows():
+        for service_type in service_types:
+            if not hasattr(service_type, 'get'):
+                continue
+            weights = service_type.get('weights') or {}
+            brackets = weights.get('e', weights) \
+                if isinstance(weights, dict) else weights
+            if isinstance(brackets, dict):
+                brackets = [brackets]
+            for bracket in brackets:
+                yield OrderedDict((
+                    ('shipment_type', service_type.get('shipment_type')),
+                    ('tariff_sub_code', service_type.get('tariff_sub_code')),
+                    ('weight_from', bracket.get('weight_from')),
+                    ('weight_to', bracket.get('weight_to')),
+                    ('price', bracket.get('price'))))
+
+    return to_columns(rows(), ('shipment_type', 'tariff_sub_code',
+                               'weight_from', 'weight_to', 'price'))
+
+
+# spatial
+
+def coordinates(offices):
+    """
+    Return the latitudes and longitudes of `offices` as two float
+    arrays, NaN for offices without coordinates.  Coordinates are
+    taken from the office or from its `address_details`.
+
+    """
+    _require_numpy()
+    points = [_coordinates(o) if hasattr(o, 'get') else None
+              for o in offices]
+    return (numpy.array([p[0] if p else _NAN for p in points]),
+            numpy.array([p[1] if p else _NAN for p in points]))
+
+
+def nearest(latitudes, longitudes, point_latitudes, point_longitudes,
+            chunk_size=1024):
+    """
+    For every location given by `latitudes` and `longitudes`, find the
+    nearest of the points, e.g. the offices from `coordinates`.
+
+    Return the great-circle distances in km and the indexes of the
+    nearest points, as arrays.  The distances are computed with NumPy
+    for `chunk_size` locations at a time, bounding the memory to
+    `chunk_size` times the number of points.  Points with NaN
+    coordinates are ignored.
+
+    """
+    _require_numpy()
+    lat = numpy.radians(numpy.asarray(latitudes, dtype=float))
+    lon = numpy.radians(numpy.asarray(longitudes, dtype=float))
+    valid = ~(numpy.isnan(point_latitudes) | numpy.isnan(point_longitudes))
+    positions = numpy.flatnonzero(valid)
+    plat = numpy.radians(numpy.asarray(point_latitudes, dtype=float)[valid])
+    plon = numpy.radians(numpy.asarray(point_longitudes, dtype=float)[valid])
+    cos_plat = numpy.cos(plat)
+
+    distances = numpy.full(lat.shape[0], numpy.nan)
+    indexes = numpy.full(lat.shape[0], -1, dtype=numpy.int64)
+    if not positions.size:
+        return distances, indexes
+
+    for start in range(0, lat.shape[0], chunk_size):
+        clat = lat[start:start + chunk_size, None]
+        clon = lon[start:start + chunk_size, None]
+        # haversine; the nearest point has the smallest `a`
+        a = numpy.sin((plat - clat) / 2) ** 2 + numpy.cos(clat) * \
+            cos_plat * numpy.sin((plon - clon) / 2) ** 2
+        best = numpy.argmin(a, axis=1)
+        a = a[numpy.arange(best.shape[0]), best]
+        distances[start:start + chunk_size] = \
+            2 * _EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1)))
+        indexes[start:start + chunk_size] = positions[best]
+    return distances, indexes
+
+
+# files
+
+def write_npz(path, data, compressed=True):
+    """Write the `to_arrays` arrays of `data` to a NumPy `.npz` file."""
+    arrays = to_arrays(data)
+    save = numpy.savez_compressed if compressed else numpy.savez
+    save(path, **{str(name): a for name, a in arrays.items()})
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('pyarrow is required for Arrow and Parquet files')
+    return pyarrow
+
+
+def to_table(data):
+    """
+    Return the columns of `data` as a `pyarrow.Table`, with dictionary
+    arrays for the string columns and nulls for missing values.
+
+    """
+    pyarrow = _import_pyarrow()
+    names = []
+    arrays = []
+    for name, column in _rows_or_columns(data, None, None).items():
+        if isinstance(column, DictionaryColumn):
+            codes = numpy.asarray(column.codes, dtype=numpy.int32)
+            arrays.append(pyarrow.DictionaryArray.from_arrays(
+                pyarrow.array(codes, mask=codes < 0),
+                pyarrow.array(column.values, type=pyarrow.string())))
+        else:
+            values = numpy.asarray(column)
+            missing = values == MISSING_INT if values.dtype.kind == 'i' \
+                else numpy.isnan(values)
+            arrays.append(pyarrow.array(values, mask=missing))
+        names.append(name)
+    return pyarrow.Table.from_arrays(arrays, names=names)
+
+
+def write_parquet(path, data, **kwargs):
+    """Write `data` to a Parquet file; `kwargs` go to `write_table`."""
+    _import_pyarrow()
+    from pyarrow import parquet
+    parquet.write_table(to_table(data), path, **kwargs)
+
+
+def write_arrow(path, data, **kwargs):
+    """Write `data` to an Arrow IPC (Feather v2) file."""
+    _import_pyarrow()
+    from pyarrow import feather
+    feather.write_feather(to_table(data), path, **kwargs)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+__all__ = [
+    'CircuitOpenError',
+    'EcontError',
+    'InvalidLoading',
+    'RateLimitExceeded',
+    'ResponseError',
+    'TransferError',
+    'TransferTimeout'
+]
+
+
+class EcontError(Exception):
+    """Base class of the errors raised by this library."""
+
+
+class TransferError(EcontError):
+    """The request could not be sent or the response could not be received."""
+
+    def __init__(self, message, code=None):
+        super(TransferError, self).__init__(message)
+        self.code = code
+
+
+class TransferTimeout(TransferError):
+    """The connect or the total timeout of a request expired."""
+
+
+class ResponseError(EcontError):
+    """The response of the service could not be parsed."""
+
+
+class CircuitOpenError(EcontError):
+    """Requests are not sent because the service failed too many times."""
+
+
+class RateLimitExceeded(EcontError):
+    """A request was not sent because its rate limit was exhausted."""
+
+
+class InvalidLoading(EcontError):
+    """A loading failed local validation; see `problems`."""
+
+    def __init__(self, message, problems=()):
+        super(InvalidLoading, self).__init__(message)
+        self.problems = list(problems)
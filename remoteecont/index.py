@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory indexes over the offices, cities and streets nomenclatures
+for fast local lookups::
+
+    index = NomenclatureIndex(econt.offices(), econt.cities(),
+                              econt.cities_streets())
+    index.office('1000')
+    index.complete_cities('стара з')   # or 'stara z'
+    index.match_cities('Plovidv')      # [Пловдив]
+    index.nearest_offices(42.69, 23.32, count=3)
+
+Records may be the dictionaries returned by `RemoteEcontXml` or the
+record types of `remoteecont.records`.
+
+"""
+
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+from collections import Counter
+import difflib
+import heapq
+import math
+import re
+
+__all__ = [
+    'GridIndex',
+    'NomenclatureIndex',
+    'PrefixIndex',
+    'address_key',
+    'distance',
+    'normalize',
+    'transliterate'
+]
+
+# Official Bulgarian transliteration (Streamlined System)
+_CYRILLIC = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh',
+    'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n',
+    'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f',
+    'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sht', 'ъ': 'a',
+    'ь': 'y', 'ю': 'yu', 'я': 'ya', 'ѝ': 'i', 'ё': 'yo', 'ы': 'y', 'э': 'e',
+}
+
+_TRANSLITERATION = {ord(k): v for k, v in _CYRILLIC.items()}
+
+_NOISE = re.compile(r'[^0-9a-z]+')
+
+
+def transliterate(text):
+    """Transliterate Bulgarian Cyrillic to Latin; other text is kept."""
+    return text.lower().translate(_TRANSLITERATION)
+
+
+def normalize(text):
+    """
+    Return the lookup key of a name: transliterated to Latin, lower
+    case, with punctuation and repeated spaces collapsed to one space.
+    Cyrillic and Latin spellings of a name have the same key.
+
+    """
+    if not text:
+        return ''
+    return _NOISE.sub(' ', transliterate(text)).strip()
+
+
+# leading "ул.", "бул.", "кв.", "ж.к.", "пл." of normalized street and
+# quarter names
+_ADDRESS_PREFIX = re.compile(r'^(?:ul|bul|kv|zh k|zhk|pl) ')
+
+
+def address_key(text):
+    """
+    `normalize` a street or quarter name, dropping the street or
+    quarter abbreviation in front of it, so that 'ул. Шипка' and
+    'shipka' have the same key.
+
+    """
+    return _ADDRESS_PREFIX.sub('', normalize(text))
+
+
+def _get(record, field, default=None):
+    value = record.get(field)
+    return default if value is None or value == '' else value
+
+
+class PrefixIndex(object):
+    """
+    Prefix search over normalized names.
+
+    Keys are kept in sorted arrays, so that all keys starting with a
+    prefix form a contiguous range found with two binary searches and
+    a query costs O(log n + limit).  Every word of a name is indexed,
+    so 'загора' finds 'Стара Загора', but names starting with the
+    prefix come first.
+
+    """
+
+    def __init__(self, items):
+        """
+        `items` is an iterable of `(name, value)` pairs; a value may come
+        with several names, e.g. in Cyrillic and in Latin.
+
+        """
+        names = set()
+        words = set()
+        values = []
+        positions = {}
+        for name, value in items:
+            key = normalize(name)
+            if not key:
+                continue
+            i = positions.get(id(value))
+            if i is None:
+                i = positions[id(value)] = len(values)
+                values.append(value)
+            names.add((key, i))
+            parts = key.split(' ')
+            for n in range(1, len(parts)):
+                words.add((' '.join(parts[n:]), i))
+
+        self._values = values
+        self._ranges = []
+        for entries in (sorted(names), sorted(words)):
+            self._ranges.append(([k for k, _ in entries],
+                                 [i for _, i in entries]))
+
+    def __len__(self):
+        return len(self._values)
+
+    def search(self, prefix, limit=10):
+        """Return up to `limit` values whose name matches `prefix`."""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        result = []
+        seen = set()
+        for keys, positions in self._ranges:
+            i = bisect_left(keys, prefix)
+            end = len(keys)
+            while i < end and len(result) < limit and \
+                    keys[i].startswith(prefix):
+                if positions[i] not in seen:
+                    seen.add(positions[i])
+                    result.append(self._values[positions[i]])
+                i += 1
+        return result
+
+
+_EARTH_RADIUS = 6371.0
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Great circle distance in kilometres."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * _EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+class GridIndex(object):
+    """
+    Nearest neighbour search over points on a grid of `cell_size`
+    degree cells.  A query scans rings of cells around the query point
+    until no unscanned cell can hold a closer point.
+
+    """
+
+    def __init__(self, points, cell_size=0.1):
+        """`points` is an iterable of `(latitude, longitude, value)`."""
+        self.cell_size = cell_size
+        self._cells = {}
+        self._count = 0
+        for lat, lon, value in points:
+            self._cells.setdefault(self._cell(lat, lon), []).append(
+                (lat, lon, value))
+            self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lon / self.cell_size)))
+
+    def _ring(self, ci, cj, r):
+        if r == 0:
+            yield ci, cj
+            return
+        for dj in range(-r, r + 1):
+            yield ci - r, cj + dj
+            yield ci + r, cj + dj
+        for di in range(-r + 1, r):
+            yield ci + di, cj - r
+            yield ci + di, cj + r
+
+    def nearest(self, lat, lon, count=1, max_distance=None):
+        """
+        Return up to `count` pairs `(distance_km, value)` closest to
+        the point, nearest first, within `max_distance` km if given.
+
+        """
+        if not self._count:
+            return []
+
+        ci, cj = self._cell(lat, lon)
+        # shortest extent of a cell in km; longitude degrees shrink
+        # towards the poles
+        cell_km = self.cell_size * math.pi / 180 * _EARTH_RADIUS * \
+            max(0.01, math.cos(math.radians(min(89.0, abs(lat) + self.cell_size))))
+
+        best = []
+        seen = 0
+        r = 0
+        while seen < self._count:
+            for cell in self._ring(ci, cj, r):
+                for p_lat, p_lon, value in self._cells.get(cell, ()):
+                    seen += 1
+                    d = distance(lat, lon, p_lat, p_lon)
+                    if max_distance is not None and d > max_distance:
+                        continue
+                    item = (-d, id(value), value)
+                    if len(best) < count:
+                        heapq.heappush(best, item)
+                    elif item > best[0]:
+                        heapq.heapreplace(best, item)
+
+            # every point outside of the scanned rings is at least
+            # this far away
+            bound = r * cell_km
+            if max_distance is not None and bound > max_distance:
+                break
+            if len(best) == count and -best[0][0] <= bound:
+                break
+            r += 1
+
+        return [(-d, value) for d, _, value in sorted(best, reverse=True)]
+
+
+def _coordinates(office):
+    for source in (office, office.get('address_details') or {}):
+        if not hasattr(source, 'get'):
+            continue
+        lat, lon = source.get('latitude'), source.get('longitude')
+        if lat not in (None, '') and lon not in (None, ''):
+            try:
+                return float(lat), float(lon)
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+def _trigrams(key):
+    padded = ' {} '.format(key)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class _NameMap(object):
+    """
+    Records by the keys of their names, with fuzzy matching.
+
+    `difflib` is slow to rank thousands of names, so with more than
+    `CANDIDATES` keys it only ranks the keys sharing the most trigrams
+    with the name, found through an inverted index built on first use.
+
+    """
+
+    CANDIDATES = 50
+
+    def __init__(self, records, key=normalize):
+        self.key = key
+        self._trigrams = None
+        self.records = {}
+        for record in records:
+            for field in ('name', 'name_en'):
+                name_key = key(_get(record, field))
+                if not name_key:
+                    continue
+                matches = self.records.setdefault(name_key, [])
+                if not any(r is record for r in matches):
+                    matches.append(record)
+
+    def find(self, name):
+        return list(self.records.get(self.key(name), ()))
+
+    def _candidates(self, key):
+        if len(self.records) <= self.CANDIDATES:
+            return self.records
+        if self._trigrams is None:
+            trigrams = {}
+            for name_key in self.records:
+                for trigram in _trigrams(name_key):
+                    trigrams.setdefault(trigram, []).append(name_key)
+            self._trigrams = trigrams
+        counts = Counter()
+        for trigram in _trigrams(key):
+            counts.update(self._trigrams.get(trigram, ()))
+        return [k for k, _ in counts.most_common(self.CANDIDATES)]
+
+    def match(self, name, limit, cutoff):
+        key = self.key(name)
+        if not key:
+            return []
+        result = []
+        for name_key in difflib.get_close_matches(
+                key, self._candidates(key), limit, cutoff):
+            for record in self.records[name_key]:
+                if not any(r is record for r in result):
+                    result.append(record)
+        return result[:limit]
+
+
+class NomenclatureIndex(object):
+    """
+    Hash, prefix, fuzzy and spatial indexes over the offices, cities,
+    streets and quarters nomenclatures.  Build once, then query from
+    any thread.
+
+    """
+
+    def __init__(self, offices=(), cities=(), streets=(), cell_size=0.1,
+                 quarters=()):
+        offices = [o for o in offices if o and _get(o, 'id') is not None]
+        cities = [c for c in cities if c and _get(c, 'id') is not None]
+        streets = [s for s in streets if s and _get(s, 'id') is not None]
+        quarters = [q for q in quarters if q and _get(q, 'id') is not None]
+
+        self._offices_by_id = {'{}'.format(_get(o, 'id')): o for o in offices}
+        self._offices_by_code = {'{}'.format(_get(o, 'office_code')): o
+                                 for o in offices if _get(o, 'office_code')}
+        self._offices_by_city = {}
+        for o in offices:
+            keys = {'{}'.format(_get(o, 'city_id', '')),
+                    normalize(_get(o, 'city_name')),
+                    normalize(_get(o, 'city_name_en'))}
+            for key in keys - {''}:
+                self._offices_by_city.setdefault(key, []).append(o)
+
+        self._cities_by_id = {'{}'.format(_get(c, 'id')): c for c in cities}
+        self._cities_by_post_code = {}
+        for c in cities:
+            if _get(c, 'post_code'):
+                self._cities_by_post_code.setdefault(
+                    '{}'.format(_get(c, 'post_code')), []).append(c)
+
+        self._city_names = _NameMap(cities)
+
+        self._streets_by_city = {}
+        for s in streets:
+            self._streets_by_city.setdefault(
+                '{}'.format(_get(s, 'id_city')), []).append(s)
+        self._quarters_by_city = {}
+        for q in quarters:
+            self._quarters_by_city.setdefault(
+                '{}'.format(_get(q, 'id_city')), []).append(q)
+
+        self.cities = PrefixIndex(self._names(cities))
+        self.streets = PrefixIndex(self._names(streets))
+        self._city_streets = {}
+        # (kind, city id) -> _NameMap, built on first use
+        self._address_names = {}
+
+        self.offices = GridIndex(
+            (point + (o,) for o, point in
+             ((o, _coordinates(o)) for o in offices) if point is not None),
+            cell_size)
+
+    @staticmethod
+    def _names(records):
+        for record in records:
+            for field in ('name', 'name_en'):
+                if _get(record, field):
+                    yield _get(record, field), record
+
+    # hash lookups
+
+    def office(self, office_code):
+        return self._offices_by_code.get('{}'.format(office_code))
+
+    def office_by_id(self, _id):
+        return self._offices_by_id.get('{}'.format(_id))
+
+    def offices_in_city(self, city):
+        """Offices of a city given by id or (Cyrillic or Latin) name."""
+        return list(self._offices_by_city.get('{}'.format(city)) or
+                    self._offices_by_city.get(normalize('{}'.format(city)), ()))
+
+    def city(self, _id):
+        return self._cities_by_id.get('{}'.format(_id))
+
+    def cities_by_post_code(self, post_code):
+        return list(self._cities_by_post_code.get('{}'.format(post_code), ()))
+
+    def streets_in_city(self, city_id):
+        return list(self._streets_by_city.get('{}'.format(city_id), ()))
+
+    def quarters_in_city(self, city_id):
+        return list(self._quarters_by_city.get('{}'.format(city_id), ()))
+
+    def cities_by_name(self, name):
+        """Cities called `name`, in Cyrillic or Latin, regardless of case."""
+        return self._city_names.find(name)
+
+    def _addresses(self, kind, city_id):
+        city_id = '{}'.format(city_id)
+        names = self._address_names.get((kind, city_id))
+        if names is None:
+            records = self._streets_by_city if kind == 'streets' \
+                else self._quarters_by_city
+            names = _NameMap(records.get(city_id, ()), address_key)
+            self._address_names[(kind, city_id)] = names
+        return names
+
+    def find_street(self, name, city_id):
+        """Streets of a city called `name`, with or without 'ул.'."""
+        return self._addresses('streets', city_id).find(name)
+
+    def find_quarter(self, name, city_id):
+        """Quarters of a city called `name`, with or without 'кв.'."""
+        return self._addresses('quarters', city_id).find(name)
+
+    # fuzzy matching
+
+    def match_cities(self, name, limit=3, cutoff=0.75):
+        """
+        Up to `limit` cities whose name is closest to `name`, e.g. with
+        a typo or transliterated differently, best first.  `cutoff` is
+        the minimum `difflib` similarity ratio of the normalized names.
+
+        """
+        return self._city_names.match(name, limit, cutoff)
+
+    def match_streets(self, name, city_id, limit=3, cutoff=0.75):
+        return self._addresses('streets', city_id).match(name, limit, cutoff)
+
+    def match_quarters(self, name, city_id, limit=3, cutoff=0.75):
+        return self._addresses('quarters', city_id).match(name, limit,
+                                                          cutoff)
+
+    # autocomplete
+
+    def complete_cities(self, prefix, limit=10):
+        return self.cities.search(prefix, limit)
+
+    def complete_streets(self, prefix, city_id=None, limit=10):
+        """Street names starting with `prefix`, optionally in one city."""
+        if city_id is None:
+            return self.streets.search(prefix, limit)
+
+        city_id = '{}'.format(city_id)
+        index = self._city_streets.get(city_id)
+        if index is None:
+            index = PrefixIndex(self._names(self.streets_in_city(city_id)))
+            self._city_streets[city_id] = index
+        return index.search(prefix, limit)
+
+    # spatial
+
+    def nearest_offices(self, latitude, longitude, count=1,
+                        max_distance=None):
+        """
+        Return up to `count` pairs `(distance_km, office)`, nearest
+        first.  Offices without coordinates are not indexed.
+
+        """
+        return self.offices.nearest(latitude, longitude, count, max_distance)
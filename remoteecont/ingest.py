@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel conversion of large nomenclature responses.
+
+The response is split at the boundaries of its top-level `<e>`
+records into chunks of `chunk_size` records, the chunks are converted
+in a pool of worker processes and the converted records are handed to
+the sink in their original order, one list per chunk::
+
+    store = NomenclatureStore(econt, 'econt.db')
+    ingest_endpoint(econt, 'cities_streets',
+                    lambda records: store.merge('cities_streets', records))
+
+Splitting only scans for the record tags; the parsing and conversion,
+which hold the GIL, run in the workers.
+
+"""
+
+from __future__ import unicode_literals
+
+from collections import deque
+import re
+
+from remoteecont.exceptions import ResponseError
+from remoteecont.metrics import CallEvent
+from remoteecont import xmlutils
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+
+__all__ = [
+    'ingest',
+    'ingest_endpoint',
+    'split_records'
+]
+
+_DECLARATION = re.compile(br'^\s*<\?xml[^>]*\?>')
+
+_ERROR = re.compile(br'<error>(.*?)</error>', re.S)
+
+
+def _tag_pattern(tag):
+    return re.compile(br'<(/?)' + re.escape(tag.encode('utf-8')) +
+                      br'(?:\s[^>]*?)?(/?)>')
+
+
+def split_records(xml, tag='e', chunk_size=2000):
+    """
+    Yield the top-level `tag` records of `xml` (bytes) in well-formed
+    chunks of up to `chunk_size` records.  Records nested in other
+    records stay in their parent.  Markup in comments or CDATA sections
+    is not recognised.
+
+    """
+    declaration = _DECLARATION.match(xml)
+    declaration = declaration.group(0) if declaration else b''
+
+    depth = 0
+    count = 0
+    start = None
+    end = None
+    for match in _tag_pattern(tag).finditer(xml):
+        closing, empty = match.group(1), match.group(2)
+        if empty:
+            if depth:
+                continue
+            if start is None:
+                start = match.start()
+            end = match.end()
+        elif closing:
+            depth -= 1
+            if depth:
+                continue
+            end = match.end()
+        else:
+            if not depth and start is None:
+                start = match.start()
+            depth += 1
+            continue
+
+        count += 1
+        if count == chunk_size:
+            yield declaration + b'<chunk>' + xml[start:end] + b'</chunk>'
+            count = 0
+            start = None
+
+    if count:
+        yield declaration + b'<chunk>' + xml[start:end] + b'</chunk>'
+
+
+def convert_chunk(chunk, convert=xmlutils.element_value):
+    """Convert the records of one chunk; runs in the worker processes."""
+    return [convert(el) for el in xmlutils.parse(chunk)]
+
+
+def _deliver(sink, records):
+    if hasattr(sink, 'extend'):
+        sink.extend(records)
+    else:
+        sink(records)
+
+
+def ingest(xml, sink, tag='e', chunk_size=2000, max_workers=None,
+           convert=xmlutils.element_value, executor=None):
+    """
+    Convert the `tag` records of the response `xml` in parallel and
+    pass them to `sink` in order.  `sink` is called with the list of
+    records of each chunk, or extended with them if it is a list.
+
+    `convert` turns an element into a record, e.g.
+    `remoteecont.records.Street.from_element`; it must be picklable,
+    i.e. a module-level function or a method of a module-level class.
+    `executor` is an existing `concurrent.futures` executor; otherwise
+    a process pool of `max_workers` processes is created for the call.
+    Without `concurrent.futures` the chunks are converted in this
+    process.
+
+    Return the number of records.
+
+    """
+    if isinstance(xml, xmlutils.text_type):
+        xml = xml.encode('utf-8')
+    elif isinstance(xml, list):
+        # the chunks of `Transfer.perform_chunks`
+        xml = b''.join(xml)
+    chunks = split_records(xml, tag, chunk_size)
+
+    count = 0
+    if executor is None and ProcessPoolExecutor is None:
+        for chunk in chunks:
+            records = convert_chunk(chunk, convert)
+            count += len(records)
+            _deliver(sink, records)
+    else:
+        own = executor is None
+        if own:
+            executor = ProcessPoolExecutor(max_workers)
+        try:
+            # keep a bounded number of chunks in flight, so that memory
+            # does not grow with the size of the response
+            window = 2 * (getattr(executor, '_max_workers', None) or 4)
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(convert_chunk, chunk, convert))
+                if len(pending) >= window:
+                    records = pending.popleft().result()
+                    count += len(records)
+                    _deliver(sink, records)
+            while pending:
+                records = pending.popleft().result()
+                count += len(records)
+                _deliver(sink, records)
+        finally:
+            if own:
+                executor.shutdown()
+
+    if not count:
+        error = _ERROR.search(xml)
+        if error:
+            raise ResponseError(error.group(1).decode('utf-8').strip())
+    return count
+
+
+def ingest_endpoint(econt, request_type, sink, updated_time=None,
+                    **kwargs):
+    """
+    Download the `request_type` nomenclature (e.g. 'cities_streets')
+    with the `RemoteEcontXml` client `econt` and `ingest` it into
+    `sink`.  `kwargs` are passed on to `ingest`.
+
+    """
+    event = CallEvent(request_type)
+    try:
+        with event.phase('build'):
+            xml = econt._generic_xml(request_type,
+                                     econt._args(updated_time=updated_time))
+        with event.phase('transfer'):
+            response = econt._send_xml_service(xml, event)
+        with event.phase('parse'):
+            count = ingest(response, sink, **kwargs)
+    except Exception as e:
+        econt._emit(event, e)
+        raise
+
+    econt._emit(event)
+    return count
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Per-call instrumentation of `RemoteEcontXml`.
+
+Every call emits a `CallEvent` to the observers registered on the
+client.  An observer is any callable taking the event; two are
+provided: `LoggingObserver` and `MetricsObserver`, which feeds a
+Prometheus-style `MetricsRegistry`::
+
+    registry = MetricsRegistry()
+    econt.add_observer(MetricsObserver(registry))
+    ...
+    print(registry.render())
+
+"""
+
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import bisect
+import logging
+import threading
+import time
+
+__all__ = [
+    'CallEvent',
+    'Counter',
+    'Histogram',
+    'LoggingObserver',
+    'MetricsObserver',
+    'MetricsRegistry'
+]
+
+
+class CallEvent(object):
+    """
+    Structured record of one call to the remote service.
+
+    `timings` holds the duration in seconds of the `build`, `transfer`
+    and `parse` phases and the `total` of the call.  `transfer_info`
+    holds whatever the transfer reports in its `info`, for curl the
+    `namelookup_time`, `connect_time`, `appconnect_time`,
+    `pretransfer_time`, `starttransfer_time` and `total_time`, and the
+    `size_upload` and `size_download` in bytes.  `response_bytes` is
+    the size of the decoded response, `wire_bytes` the size received,
+    which is smaller for compressed responses.  `cache` is 'hit',
+    'miss', 'coalesced' for calls that waited for the same request of
+    a concurrent miss, or None for uncached calls; `error` is the
+    exception that ended the call, if any.
+
+    """
+
+    def __init__(self, request_type, cache=None):
+        self.request_type = request_type
+        self.cache = cache
+        self.url = None
+        self.request_bytes = None
+        self.response_bytes = None
+        self.wire_bytes = None
+        self.timings = {}
+        self.transfer_info = {}
+        self.error = None
+        self.started = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        """Measure the duration of the enclosed block as phase `name`."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.time() - start
+
+    def finish(self, error=None):
+        if error is not None:
+            self.error = error
+        self.timings['total'] = time.time() - self.started
+
+    def as_dict(self):
+        return {'request_type': self.request_type,
+                'cache': self.cache,
+                'url': self.url,
+                'request_bytes': self.request_bytes,
+                'response_bytes': self.response_bytes,
+                'wire_bytes': self.wire_bytes,
+                'timings': dict(self.timings),
+                'transfer_info': dict(self.transfer_info),
+                'error': repr(self.error) if self.error is not None else None}
+
+
+class LoggingObserver(object):
+    """Log one line per call; the event is attached as `econt_event`."""
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('remoteecont')
+        self.level = level
+
+    def __call__(self, event):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        timings = ' '.join('{}={:.4f}'.format(k, v)
+                           for k, v in sorted(event.timings.items()))
+        self.logger.log(
+            logging.ERROR if event.error is not None else self.level,
+            'econt %s cache=%s req=%s resp=%s wire=%s %s%s',
+            event.request_type, event.cache, event.request_bytes,
+            event.response_bytes, event.wire_bytes, timings,
+            ' error={!r}'.format(event.error) if event.error else '',
+            extra={'econt_event': event.as_dict()})
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _render_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in pairs) + '}'
+
+
+class Counter(object):
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append('{}{} {}'.format(self.name, _render_labels(key),
+                                              value))
+        return lines
+
+
+class Histogram(object):
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                       0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name, documentation, buckets=None):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(_label_key(labels), ([0], 0.0))
+        return sum(counts)
+
+    def quantile(self, q, **labels):
+        """
+        Estimate the `q` quantile (e.g. 0.99) from the buckets the way
+        Prometheus' `histogram_quantile` does.
+
+        """
+        counts, _ = self._values.get(_label_key(labels), (None, 0.0))
+        if not counts or not sum(counts):
+            return None
+        rank = q * sum(counts)
+        seen = 0
+        for i, n in enumerate(counts):
+            if seen + n >= rank and n:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += n
+                    lines.append('{}_bucket{} {}'.format(
+                        self.name, _render_labels(key, [('le', bound)]),
+                        cumulative))
+                lines.append('{}_sum{} {}'.format(
+                    self.name, _render_labels(key), total))
+                lines.append('{}_count{} {}'.format(
+                    self.name, _render_labels(key), cumulative))
+        return lines
+
+
+class MetricsRegistry(object):
+    """Collection of named metrics, rendered in the Prometheus format."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args)
+            return self._metrics[name]
+
+    def counter(self, name, documentation=''):
+        return self._get(Counter, name, documentation)
+
+    def histogram(self, name, documentation='', buckets=None):
+        return self._get(Histogram, name, documentation, buckets)
+
+    def render(self):
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsObserver(object):
+    """Record call events as counters and histograms of a registry."""
+
+    def __init__(self, registry, prefix='econt'):
+        self.calls = registry.counter(
+            prefix + '_calls_total', 'Calls by request type and outcome')
+        self.request_bytes = registry.counter(
+            prefix + '_request_bytes_total', 'Bytes sent')
+        self.response_bytes = registry.counter(
+            prefix + '_response_bytes_total', 'Bytes of decoded responses')
+        self.wire_bytes = registry.counter(
+            prefix + '_wire_bytes_total',
+            'Bytes received, before decompression')
+        self.phases = registry.histogram(
+            prefix + '_phase_seconds', 'Duration of the phases of a call')
+        self.transfer = registry.histogram(
+            prefix + '_transfer_seconds',
+            'Time from the start of the transfer until each of its stages')
+
+    def __call__(self, event):
+        request_type = event.request_type
+        self.calls.inc(request_type=request_type, cache=event.cache or 'none',
+                       status='error' if event.error is not None else 'ok')
+        if event.request_bytes:
+            self.request_bytes.inc(event.request_bytes,
+                                   request_type=request_type)
+        if event.response_bytes:
+            self.response_bytes.inc(event.response_bytes,
+                                    request_type=request_type)
+        if event.wire_bytes:
+            self.wire_bytes.inc(event.wire_bytes, request_type=request_type)
+        for phase, seconds in event.timings.items():
+            self.phases.observe(seconds, request_type=request_type,
+                                phase=phase)
+        for stage, seconds in event.transfer_info.items():
+            if stage.endswith('time'):
+                self.transfer.observe(seconds, request_type=request_type,
+                                      stage=stage[:-len('_time')])
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Durable queue of outgoing shipments.
+
+Loadings are written to a local SQLite database (in WAL mode) and sent
+to the parcel service by background workers, in batches, so that the
+latency of Econt stays off the caller's path::
+
+    outbox = ShipmentOutbox(econt, 'outbox.db', system={'validate': 1})
+    outbox.start()
+
+    key = outbox.enqueue(loading)       # at checkout
+    ...
+    outbox.status(key)                  # later: state, result, error
+
+Every entry is keyed by a hash of its loading and system, so enqueueing
+the same loading again returns the same key and sends it once.  A
+request that may have reached Econt without an answer (a timeout, an
+unreadable response, a crashed worker) is never sent again
+automatically: its entries become `unknown` until they are checked and
+either `requeue`d or `resolve`d.
+
+"""
+
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from remoteecont.exceptions import (CircuitOpenError, RateLimitExceeded,
+                                    TransferError)
+from remoteecont.xmlutils import text_type
+
+__all__ = [
+    'ShipmentOutbox',
+    'idempotency_key'
+]
+
+_log = logging.getLogger(__name__)
+
+PENDING = 'pending'
+SENDING = 'sending'
+DONE = 'done'
+FAILED = 'failed'
+UNKNOWN = 'unknown'
+
+# curl errors of requests that never reached the server: proxy, host
+# name resolution and connection failures
+_NOT_SENT_CODES = (5, 6, 7)
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'),
+                      ensure_ascii=False, default=text_type)
+
+
+def idempotency_key(loading, system=None):
+    """
+    Return the key of a loading: a hash of its content and `system`,
+    independent of the order of the dictionary keys.
+
+    """
+    data = _dumps({'loading': loading, 'system': system or {}})
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()[:32]
+
+
+def _not_sent(error):
+    """Whether a failed request certainly did not reach the service."""
+    if isinstance(error, (CircuitOpenError, RateLimitExceeded)):
+        return True
+    return isinstance(error, TransferError) and \
+        error.code in _NOT_SENT_CODES
+
+
+class ShipmentOutbox(object):
+    """
+    Persistent queue of `shipping` loadings, drained in batches.
+
+    Entries go through the states `pending`, `sending` and then `done`
+    (with the result row of the loading), `failed` (with the error
+    returned by the service, or after `max_attempts` requests that were
+    not sent) or `unknown` (sent, but without an answer).
+
+    A batch holds up to `batch_size` due entries with the same
+    `system`.  Requests that could not be sent are retried after
+    `retry_delay * 2 ** (attempts - 1)` seconds, but at most
+    `max_retry_delay`.  Entries left `sending` for more than
+    `lease_timeout` seconds, because their worker or process died,
+    become `unknown`.
+
+    `durable` makes every `enqueue` wait for the data to be synced to
+    disk; otherwise a power failure may lose the last entries, but not
+    corrupt the queue.  Several processes may share the database.
+
+    """
+
+    _SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+  key      TEXT PRIMARY KEY,
+  loading  TEXT NOT NULL,
+  system   TEXT NOT NULL,
+  state    TEXT NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  created  REAL NOT NULL,
+  updated  REAL NOT NULL,
+  due      REAL NOT NULL,
+  result   TEXT,
+  error    TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, due);
+'''
+
+    def __init__(self, econt, path, system=None, batch_size=50,
+                 max_attempts=10, retry_delay=5.0, max_retry_delay=600.0,
+                 lease_timeout=600.0, durable=False, clock=time.time):
+        self.econt = econt
+        self.path = path
+        self.system = system
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.lease_timeout = lease_timeout
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._workers = []
+
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous={}'.format(
+            'FULL' if durable else 'NORMAL'))
+        with self._db:
+            self._db.executescript(self._SCHEMA)
+
+    def close(self):
+        self.stop()
+        self._db.close()
+
+    # the caller's side
+
+    def enqueue(self, loading, system=None, key=None):
+        """
+        Queue `loading` to be sent with `system` (the outbox's `system`
+        by default) and return its key: `key`, or `idempotency_key`.
+        Queueing a key again leaves the existing entry alone.
+
+        """
+        system = system if system is not None else self.system
+        if key is None:
+            key = idempotency_key(loading, system)
+        now = self.clock()
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR IGNORE INTO outbox (key, loading, system, '
+                    'state, created, updated, due) VALUES (?, ?, ?, ?, ?, '
+                    '?, ?)', (key, _dumps(loading), _dumps(system or {}),
+                              PENDING, now, now, now))
+        self._wakeup.set()
+        return key
+
+    def status(self, key):
+        """
+        Return the entry of `key` as a dictionary with its `state`,
+        `attempts`, `result`, `error`, `created` and `updated` time, or
+        None if there is none.
+
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT state, attempts, result, error, created, updated '
+                'FROM outbox WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return {'key': key,
+                'state': row[0],
+                'attempts': row[1],
+                'result': json.loads(row[2]) if row[2] else None,
+                'error': row[3],
+                'created': row[4],
+                'updated': row[5]}
+
+    def wait(self, key, timeout=None, interval=0.1):
+        """
+        Wait until the entry of `key` leaves the queue (is `done`,
+        `failed` or `unknown`) and return its status; return the
+        current status if `timeout` seconds pass first.
+
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            status = self.status(key)
+            if status is None or status['state'] in (DONE, FAILED, UNKNOWN):
+                return status
+            if deadline is not None and time.time() >= deadline:
+                return status
+            time.sleep(interval)
+
+    def counts(self):
+        """Return the number of entries in each state."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT state, COUNT(*) FROM outbox GROUP BY state'
+            ).fetchall()
+        return dict(rows)
+
+    def unknown(self):
+        """Return the keys of the entries whose outcome is unknown."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT key FROM outbox WHERE state = ? ORDER BY created',
+                (UNKNOWN,)).fetchall()
+        return [row[0] for row in rows]
+
+    def requeue(self, key):
+        """
+        Send a `failed` or `unknown` entry again, e.g. after checking
+        that no waybill was created for it, with a new count of
+        attempts.
+
+        """
+        return self._set_state(key, (FAILED, UNKNOWN), PENDING)
+
+    def resolve(self, key, result):
+        """Mark an `unknown` entry `done` with a result found otherwise."""
+        return self._set_state(key, (UNKNOWN,), DONE, result)
+
+    def _set_state(self, key, states, state, result=None):
+        now = self.clock()
+        with self._lock:
+            with self._db:
+                cursor = self._db.execute(
+                    'UPDATE outbox SET state = ?, updated = ?, due = ?, '
+                    'result = COALESCE(?, result), error = NULL{} '
+                    'WHERE key = ? AND state IN ({})'.format(
+                        ', attempts = 0' if state == PENDING else '',
+                        ', '.join('?' * len(states))),
+                    (state, now, now,
+                     _dumps(result) if result is not None else None, key) +
+                    tuple(states))
+        if state == PENDING:
+            self._wakeup.set()
+        return cursor.rowcount == 1
+
+    def purge(self, before):
+        """Delete the `done` entries last updated before `before`."""
+        with self._lock:
+            with self._db:
+                cursor = self._db.execute(
+                    'DELETE FROM outbox WHERE state = ? AND updated < ?',
+                    (DONE, before))
+        return cursor.rowcount
+
+    # the workers' side
+
+    def _claim(self, now):
+        """Take a batch of due entries; return their keys, loadings and system."""
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'UPDATE outbox SET state = ?, updated = ? '
+                    'WHERE state = ? AND updated < ?',
+                    (UNKNOWN, now, SENDING, now - self.lease_timeout))
+                first = self._db.execute(
+                    'SELECT system FROM outbox WHERE state = ? AND due <= ? '
+                    'ORDER BY due LIMIT 1', (PENDING, now)).fetchone()
+                if first is None:
+                    return [], [], None
+                rows = self._db.execute(
+                    'SELECT key, loading FROM outbox WHERE state = ? AND '
+                    'due <= ? AND system = ? ORDER BY due LIMIT ?',
+                    (PENDING, now, first[0], self.batch_size)).fetchall()
+                self._db.executemany(
+                    'UPDATE outbox SET state = ?, updated = ?, '
+                    'attempts = attempts + 1 WHERE key = ?',
+                    [(SENDING, now, key) for key, _ in rows])
+        return ([key for key, _ in rows],
+                [json.loads(loading) for _, loading in rows],
+                json.loads(first[0]))
+
+    def _retry_delay(self, attempts):
+        return min(self.max_retry_delay,
+                   self.retry_delay * 2 ** max(0, attempts - 1))
+
+    def _finish(self, keys, results):
+        now = self.clock()
+        rows = []
+        for key, row in zip(keys, results):
+            if row.get('error'):
+                rows.append((FAILED, now, _dumps(row), row['error'], key))
+            else:
+                rows.append((DONE, now, _dumps(row), None, key))
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    'UPDATE outbox SET state = ?, updated = ?, result = ?, '
+                    'error = ? WHERE key = ?', rows)
+
+    def _fail(self, keys, error):
+        now = self.clock()
+        message = '{}: {}'.format(type(error).__name__, error)
+        with self._lock:
+            with self._db:
+                if not _not_sent(error):
+                    self._db.executemany(
+                        'UPDATE outbox SET state = ?, updated = ?, error = ? '
+                        'WHERE key = ?',
+                        [(UNKNOWN, now, message, key) for key in keys])
+                    return
+                for key in keys:
+                    attempts = self._db.execute(
+                        'SELECT attempts FROM outbox WHERE key = ?',
+                        (key,)).fetchone()[0]
+                    state = FAILED if attempts >= self.max_attempts \
+                        else PENDING
+                    self._db.execute(
+                        'UPDATE outbox SET state = ?, updated = ?, due = ?, '
+                        'error = ? WHERE key = ?',
+                        (state, now, now + self._retry_delay(attempts),
+                         message, key))
+
+    def drain_once(self):
+        """Send one batch of due entries; return its size."""
+        keys, loadings, system = self._claim(self.clock())
+        if not keys:
+            return 0
+
+        try:
+            response = self.econt.shipping(loadings, system)
+        except Exception as e:
+            _log.warning('Failed to send %d shipments: %s', len(keys), e)
+            self._fail(keys, e)
+        else:
+            self._finish(keys, self.econt._shipping_result_rows(
+                len(keys), response))
+        return len(keys)
+
+    def drain(self):
+        """Send batches until no entry is due; return the number sent."""
+        sent = 0
+        while True:
+            count = self.drain_once()
+            if not count:
+                return sent
+            sent += count
+
+    def _run(self, poll_interval):
+        while not self._stop.is_set():
+            try:
+                sent = self.drain_once()
+            except Exception:
+                _log.exception('Outbox worker failed')
+                sent = 0
+            if not sent:
+                # entries queued by other processes are picked up after
+                # `poll_interval` seconds, those of this one at once
+                self._wakeup.wait(poll_interval)
+                self._wakeup.clear()
+
+    def start(self, workers=2, poll_interval=1.0):
+        """Start `workers` threads draining the queue in the background."""
+        self._stop.clear()
+        for _ in range(workers):
+            thread = threading.Thread(target=self._run,
+                                      args=(poll_interval,))
+            thread.daemon = True
+            thread.start()
+            self._workers.append(thread)
+
+    def stop(self, timeout=None):
+        """Stop the workers after their current batch."""
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._workers:
+            thread.join(timeout)
+        self._workers = []
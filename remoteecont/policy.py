@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Retry and circuit breaker policies for the requests of `RemoteEcontXml`.
+
+"""
+
+from __future__ import unicode_literals
+
+import random
+import threading
+import time
+
+from remoteecont.exceptions import (CircuitOpenError, RateLimitExceeded,
+                                    TransferError)
+
+__all__ = [
+    'CircuitBreaker',
+    'RetryPolicy',
+    'TokenBucket'
+]
+
+
+class RetryPolicy(object):
+    """
+    Retry failed requests with exponential backoff and jitter.
+
+    A request is tried at most `attempts` times.  The n-th retry waits
+    `backoff * 2 ** (n - 1)` seconds, but at most `max_backoff`,
+    reduced by a random fraction of up to `jitter` so that clients do
+    not retry in lockstep.  Only exceptions in `retry_on` are retried.
+
+    `RemoteEcontXml` applies the policy to the idempotent requests of
+    the service URL only, never to `shipping`.
+
+    """
+
+    def __init__(self, attempts=3, backoff=0.2, max_backoff=5.0, jitter=0.5,
+                 retry_on=(TransferError,)):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_on = retry_on
+
+    def delays(self):
+        """Yield the waiting time before each retry."""
+        for n in range(self.attempts - 1):
+            delay = min(self.max_backoff, self.backoff * 2 ** n)
+            yield delay * (1 - self.jitter * random.random())
+
+    def should_retry(self, error):
+        return isinstance(error, self.retry_on)
+
+    def call(self, f, *args, **kwargs):
+        delays = self.delays()
+        while True:
+            try:
+                return f(*args, **kwargs)
+            except Exception as e:
+                delay = next(delays, None) if self.should_retry(e) else None
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+
+class CircuitBreaker(object):
+    """
+    Fail fast while the service is down.
+
+    After `failure_threshold` consecutive failed requests the circuit
+    opens and every request raises `CircuitOpenError` without being
+    sent.  After `reset_timeout` seconds a single trial request is let
+    through; the circuit closes again if it succeeds and stays open for
+    another `reset_timeout` otherwise.  A trial that has not reported
+    back within `reset_timeout` seconds, e.g. because its caller gave
+    up on it, is replaced by the next request.
+
+    Any exception raised by a request made through `call` counts as a
+    failure, except those in `ignore`: by default `RateLimitExceeded`,
+    raised before the request is sent, and `ValueError`, raised for
+    invalid arguments.  They are neither a success nor a failure, and
+    a trial request ending with one leaves its place to the next.
+
+    One breaker may be shared by several clients talking to the same
+    service.
+
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0,
+                 ignore=(RateLimitExceeded, ValueError)):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.ignore = ignore
+
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        return self._state
+
+    def allow(self):
+        """Raise `CircuitOpenError` unless a request may be sent now."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            # `_opened_at` is the start of the trial while half-open
+            now = time.time()
+            if now - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._opened_at = now
+                return
+            raise CircuitOpenError(
+                'Circuit open after {} consecutive failures'.format(
+                    self._failures))
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or \
+                    self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.time()
+
+    def record(self, error=None):
+        """
+        Report the outcome of a request let through by `allow`: `error`
+        is the exception that ended it, None if it succeeded.
+
+        """
+        if error is None:
+            self.record_success()
+        elif isinstance(error, self.ignore):
+            with self._lock:
+                if self._state == self.HALF_OPEN:
+                    # the trial did not reach the service; the next
+                    # request takes its place
+                    self._state = self.OPEN
+                    self._opened_at = time.time() - self.reset_timeout
+        else:
+            self.record_failure()
+
+    def call(self, f, *args, **kwargs):
+        self.allow()
+        try:
+            result = f(*args, **kwargs)
+        except Exception as e:
+            self.record(e)
+            raise
+        self.record()
+        return result
+
+
+class TokenBucket(object):
+    """
+    Rate limit of `rate` requests per second on average, with bursts
+    of up to `burst` requests.
+
+    Every request takes a token; tokens are added continuously at
+    `rate` per second, up to `burst`.  Thread-safe.
+
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """Take a token and return 0, or return the time until one is free."""
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, block=True, timeout=None):
+        """
+        Take a token, waiting for one if `block` is true, but at most
+        `timeout` seconds.  Raise `RateLimitExceeded` if no token is
+        available in time.
+
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            if not block or (deadline is not None and
+                             time.time() + wait > deadline):
+                raise RateLimitExceeded(
+                    'Rate limit of {}/s exceeded'.format(self.rate))
+            time.sleep(wait)
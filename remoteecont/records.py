@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Compact record types for the nomenclature responses.
+
+Every record type is a named tuple with the fields known for its
+endpoint plus an `extra` dictionary (or None) holding any fields the
+service returns that are not listed.  Records are built directly from
+the parsed elements, without an intermediate dictionary, e.g.::
+
+    for office in econt.iter_offices(record_type=Office):
+        print(office.office_code, office.name)
+
+"""
+
+from __future__ import unicode_literals
+
+from collections import namedtuple
+
+from remoteecont.xmlutils import element_value
+
+__all__ = [
+    'City',
+    'Office',
+    'Quarter',
+    'RECORD_TYPES',
+    'Street'
+]
+
+
+def _record_type(name, fields):
+    base = namedtuple(name, fields + ('extra',))
+    index = {field: i for i, field in enumerate(fields)}
+    size = len(fields)
+
+    class Record(base):
+        __slots__ = ()
+
+        @classmethod
+        def from_element(cls, el):
+            """Build a record from an `<e>` element."""
+            values = [None] * size
+            extra = None
+            for child in el:
+                tag = child.tag
+                value = element_value(child)
+                i = index.get(tag)
+                if i is None:
+                    if extra is None:
+                        extra = {}
+                    if tag not in extra:
+                        extra[tag] = value
+                    elif extra[tag].__class__ is list:
+                        extra[tag].append(value)
+                    else:
+                        extra[tag] = [extra[tag], value]
+                elif values[i] is None:
+                    values[i] = value
+                elif values[i].__class__ is list:
+                    values[i].append(value)
+                else:
+                    values[i] = [values[i], value]
+            values.append(extra)
+            return cls._make(values)
+
+        @classmethod
+        def from_dict(cls, d):
+            """Build a record from a dictionary returned by `etree2dict`."""
+            if not isinstance(d, dict):
+                d = {}
+            values = [d.get(field) for field in fields]
+            extra = {k: v for k, v in d.items() if k not in index}
+            values.append(extra or None)
+            return cls._make(values)
+
+        def get(self, field, default=None):
+            """Dictionary-like access, including the `extra` fields."""
+            i = index.get(field)
+            if i is not None:
+                value = self[i]
+            elif self.extra is not None:
+                value = self.extra.get(field)
+            else:
+                value = None
+            return default if value is None else value
+
+    # found by name when pickled, e.g. to be sent between processes
+    Record.__name__ = Record.__qualname__ = str(name)
+    return Record
+
+
+City = _record_type('City', (
+    'id', 'post_code', 'type', 'id_zone', 'name', 'name_en', 'region',
+    'id_country', 'id_office', 'updated_time'))
+
+Office = _record_type('Office', (
+    'id', 'name', 'name_en', 'office_code', 'country_code', 'city_id',
+    'city_name', 'city_name_en', 'post_code', 'address', 'address_en',
+    'address_details', 'phone', 'email', 'latitude', 'longitude',
+    'work_begin', 'work_end', 'work_begin_saturday', 'work_end_saturday',
+    'time_priority', 'updated_time'))
+
+Quarter = _record_type('Quarter', (
+    'id', 'name', 'name_en', 'city_post_code', 'id_city', 'updated_time'))
+
+Street = _record_type('Street', (
+    'id', 'name', 'name_en', 'city_post_code', 'id_city', 'updated_time'))
+
+# Record type per request type
+RECORD_TYPES = {
+    'cities': City,
+    'cities_quarters': Quarter,
+    'cities_streets': Street,
+    'offices': Office
+}
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+Compact read-only snapshots of the nomenclatures, shared between
+processes through `mmap`.
+
+A snapshot file holds one sorted table of all distinct strings and,
+for every nomenclature, one fixed-width column of string numbers per
+field.  Opening a snapshot parses only its small directory; records
+are decoded when they are read, and all processes mapping the same
+file share its pages in the page cache::
+
+    write_snapshot('/var/lib/econt.snap', {'offices': econt.offices(),
+                                           'cities': econt.cities()})
+
+    snapshot = Snapshot('/var/lib/econt.snap')
+    snapshot['offices'].by_id('1')
+    ...
+    snapshot.refresh()      # pick up a newer file, if any
+
+`write_snapshot` replaces the file atomically by a rename, so readers
+never see a partial snapshot.
+
+"""
+
+from __future__ import unicode_literals
+
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+__all__ = [
+    'Snapshot',
+    'SnapshotTable',
+    'write_snapshot'
+]
+
+MAGIC = b'ECSNAP01'
+
+# string number of fields a record does not have
+_MISSING = 0xFFFFFFFF
+
+_UINT = struct.Struct('<I')
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _flatten(record, prefix='', out=None):
+    """Flatten nested dictionaries to dotted field names."""
+    if out is None:
+        out = {}
+    if hasattr(record, '_asdict'):
+        # records of `remoteecont.records`
+        record = record._asdict()
+        extra = record.pop('extra', None) or {}
+        record.update(extra)
+    for k, v in record.items():
+        if isinstance(v, dict):
+            _flatten(v, prefix + k + '.', out)
+        else:
+            out[prefix + k] = v
+    return out
+
+
+def _pad(f):
+    f.write(b'\0' * (-f.tell() % 8))
+
+
+def write_snapshot(path, tables):
+    """
+    Write `tables`, a mapping of nomenclature names to iterables of
+    records, as a snapshot file at `path`, replacing it atomically.
+
+    Nested dictionaries become dotted fields and are nested again when
+    read; other values that are not strings (lists, numbers) are kept
+    as JSON.
+
+    """
+    flat = {}
+    strings = set()
+    for name, records in tables.items():
+        rows = []
+        fields = []
+        known = set()
+        encoded = set()
+        for record in records:
+            if not hasattr(record, 'items') and not hasattr(record, '_asdict'):
+                continue
+            row = _flatten(record)
+            for field, value in row.items():
+                if field not in known:
+                    known.add(field)
+                    fields.append(field)
+                if value is None:
+                    row[field] = ''
+                elif not isinstance(value, type('')):
+                    if isinstance(value, bytes):
+                        row[field] = value.decode('utf-8')
+                    else:
+                        row[field] = json.dumps(value)
+                        encoded.add(field)
+            strings.update(row.values())
+            rows.append(row)
+        strings.update(fields)
+        flat[name] = (fields, sorted(encoded), rows)
+
+    strings = sorted(strings)
+    numbers = {s: i for i, s in enumerate(strings)}
+    data = [s.encode('utf-8') for s in strings]
+
+    directory = {'created': time.time(), 'tables': {}}
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            # the directory is written last, at the end of the file
+            f.write(MAGIC)
+            f.write(b'\0' * 8)
+
+            offsets = [0]
+            for s in data:
+                offsets.append(offsets[-1] + len(s))
+            directory['strings'] = {'count': len(strings),
+                                    'offsets': f.tell()}
+            f.write(struct.pack('<{}I'.format(len(offsets)), *offsets))
+            directory['strings']['data'] = f.tell()
+            f.write(b''.join(data))
+            _pad(f)
+
+            for name, (fields, encoded, rows) in flat.items():
+                info = {'rows': len(rows), 'fields': fields,
+                        'json': encoded, 'columns': f.tell(),
+                        'id_index': None}
+                for field in fields:
+                    column = [numbers[row[field]] if field in row
+                              else _MISSING for row in rows]
+                    f.write(struct.pack('<{}I'.format(len(rows)), *column))
+
+                if 'id' in fields:
+                    # row numbers ordered by id, for binary search
+                    info['id_index'] = f.tell()
+                    ids = [numbers.get(row.get('id'), _MISSING)
+                           for row in rows]
+                    order = sorted(range(len(rows)), key=ids.__getitem__)
+                    f.write(struct.pack('<{}I'.format(len(rows)), *order))
+                directory['tables'][name] = info
+
+            position = f.tell()
+            f.write(json.dumps(directory).encode('utf-8'))
+            # keep the size a multiple of the integer width
+            f.write(b' ' * (-f.tell() % 8))
+            f.seek(len(MAGIC))
+            f.write(struct.pack('<Q', position))
+            f.flush()
+            os.fsync(f.fileno())
+        _replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class _UnpackedArray(object):
+    """Indexing of a buffer as unsigned 32-bit little endian integers."""
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+
+    def __getitem__(self, i):
+        return _UINT.unpack_from(self._buffer, i * 4)[0]
+
+
+class _Mapping(object):
+    """One mapped snapshot file."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not a snapshot file: {}'.format(path))
+        position, = struct.unpack_from('<Q', self.mm, len(MAGIC))
+        self.directory = json.loads(self.mm[position:].decode('utf-8'))
+
+        strings = self.directory['strings']
+        self.count = strings['count']
+        self.offsets = strings['offsets'] // 4
+        self.data = strings['data']
+
+        # all arrays are 4-byte aligned little endian; read them in
+        # place where the platform allows
+        try:
+            if sys.byteorder != 'little':
+                raise TypeError
+            self.uint = memoryview(self.mm).cast('I')
+        except (AttributeError, TypeError):
+            self.uint = _UnpackedArray(self.mm)
+
+    def string(self, i):
+        uint = self.uint
+        start = self.data + uint[self.offsets + i]
+        end = self.data + uint[self.offsets + i + 1]
+        return self.mm[start:end].decode('utf-8')
+
+    def number(self, s):
+        """Number of the string `s`, or None if it is not in the table."""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.string(mid) < s:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.string(lo) == s:
+            return lo
+        return None
+
+
+class SnapshotTable(object):
+    """
+    The records of one nomenclature in a snapshot.  Records are
+    decoded to new dictionaries on every read.
+
+    """
+
+    def __init__(self, mapping, name):
+        info = mapping.directory['tables'][name]
+        self.name = name
+        self.fields = info['fields']
+        self._mapping = mapping
+        self._rows = info['rows']
+        self._columns = info['columns']
+        self._id_index = info['id_index']
+        self._json = set(info['json'])
+        self._column = {field: (self._columns + i * self._rows * 4) // 4
+                        for i, field in enumerate(self.fields)}
+
+    def __len__(self):
+        return self._rows
+
+    def __iter__(self):
+        for i in range(self._rows):
+            yield self[i]
+
+    def _number(self, field, i):
+        return self._mapping.uint[self._column[field] + i]
+
+    def _value(self, field, number):
+        value = self._mapping.string(number)
+        return json.loads(value) if field in self._json else value
+
+    def value(self, i, field):
+        """Value of `field` of record `i`, or None if it has none."""
+        number = self._number(field, i)
+        return None if number == _MISSING else self._value(field, number)
+
+    def __getitem__(self, i):
+        if not -self._rows <= i < self._rows:
+            raise IndexError(i)
+        i %= self._rows
+
+        uint = self._mapping.uint
+        record = {}
+        for field in self.fields:
+            number = uint[self._column[field] + i]
+            if number == _MISSING:
+                continue
+            d = record
+            path = field.split('.')
+            for k in path[:-1]:
+                d = d.setdefault(k, {})
+            d[path[-1]] = self._value(field, number)
+        return record
+
+    def column(self, field):
+        """All values of `field`, in record order."""
+        return [self.value(i, field) for i in range(self._rows)]
+
+    def find(self, field, value):
+        """Records with `field` equal to `value`, by comparing numbers."""
+        number = self._mapping.number(value)
+        if number is None or field not in self._column:
+            return []
+        return [self[i] for i in range(self._rows)
+                if self._number(field, i) == number]
+
+    def by_id(self, _id):
+        """The record with id `_id`, or None."""
+        number = self._mapping.number('{}'.format(_id))
+        if number is None or self._id_index is None:
+            return None
+
+        uint = self._mapping.uint
+        index = self._id_index // 4
+
+        def row(k):
+            return uint[index + k]
+
+        lo, hi = 0, self._rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._number('id', row(mid)) < number:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._rows and self._number('id', row(lo)) == number:
+            return self[row(lo)]
+        return None
+
+
+class Snapshot(object):
+    """
+    Read-only view of a snapshot file.  Tables are available by name,
+    e.g. `snapshot['offices']`.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._load()
+
+    def _load(self):
+        self._mapping = _Mapping(self.path)
+        self.tables = {name: SnapshotTable(self._mapping, name)
+                       for name in self._mapping.directory['tables']}
+
+    @property
+    def created(self):
+        return self._mapping.directory['created']
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+    def __contains__(self, name):
+        return name in self.tables
+
+    def refresh(self):
+        """
+        Map the file again if it was replaced since it was opened and
+        return whether it was.  Tables obtained before keep reading the
+        old snapshot.
+
+        """
+        stat = os.stat(self.path)
+        if (stat.st_ino, stat.st_mtime, stat.st_size) == self._mapping.stat:
+            return False
+        self._load()
+        return True
+
+    def close(self):
+        """
+        Drop the mapping; it is unmapped once no table read from it is
+        in use any more.
+
+        """
+        self._mapping = None
+        self.tables = {}
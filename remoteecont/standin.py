@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the Econt XML services, for benchmarks and
+development without access to demo.econt.com.
+
+The server answers every supported request type with XML shaped like
+the responses of the real service, generated deterministically, with
+a configurable number of records and an optional artificial latency::
+
+    server = StandinServer(latency=0.05, records={'cities_streets': 50000})
+    server.start()
+    econt = RemoteEcontXml(server.service_url, server.parcel_url,
+                           'user', 'pass', CurlTransfer)
+    ...
+    server.stop()
+
+"""
+
+from __future__ import unicode_literals
+
+import gzip
+import random
+import re
+import sys
+import threading
+import time
+from io import BytesIO
+from xml.sax.saxutils import escape
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+__all__ = [
+    'StandinServer',
+    'render'
+]
+
+_CITIES = [
+    ('София', 'Sofia', '1000'), ('Пловдив', 'Plovdiv', '4000'),
+    ('Варна', 'Varna', '9000'), ('Бургас', 'Burgas', '8000'),
+    ('Русе', 'Ruse', '7000'), ('Стара Загора', 'Stara Zagora', '6000'),
+    ('Плевен', 'Pleven', '5800'), ('Сливен', 'Sliven', '8800'),
+    ('Добрич', 'Dobrich', '9300'), ('Шумен', 'Shumen', '9700'),
+    ('Перник', 'Pernik', '2300'), ('Хасково', 'Haskovo', '6300'),
+    ('Ямбол', 'Yambol', '8600'), ('Пазарджик', 'Pazardzhik', '4400'),
+    ('Благоевград', 'Blagoevgrad', '2700'),
+    ('Велико Търново', 'Veliko Tarnovo', '5000'),
+]
+
+_STREETS = [
+    ('Витоша', 'Vitosha'), ('Шипка', 'Shipka'), ('Раковски', 'Rakovski'),
+    ('Цар Симеон', 'Tsar Simeon'), ('Граф Игнатиев', 'Graf Ignatiev'),
+    ('Христо Ботев', 'Hristo Botev'), ('Васил Левски', 'Vasil Levski'),
+    ('Александровска', 'Aleksandrovska'), ('Дунав', 'Dunav'),
+    ('Странджа', 'Strandzha'), ('Оборище', 'Oborishte'), ('Марица', 'Maritsa'),
+]
+
+_SHIPMENT_TYPES = ['PACK', 'DOCUMENT', 'PALLET', 'CARGO']
+
+_TARIFF_SUB_CODES = ['OFFICE_OFFICE', 'OFFICE_DOOR', 'DOOR_OFFICE', 'DOOR_DOOR']
+
+# Default number of records per request type
+RECORDS = {
+    'cities': 5000,
+    'cities_quarters': 3000,
+    'cities_regions': 300,
+    'cities_streets': 20000,
+    'cities_zones': 10,
+    'countries': 40,
+    'offices': 1500,
+}
+
+
+def _element(tag, value):
+    if isinstance(value, dict):
+        return '<{0}>{1}</{0}>'.format(
+            tag, ''.join(_element(k, v) for k, v in value.items()))
+    if isinstance(value, list):
+        return ''.join(_element(tag, v) for v in value)
+    return '<{0}>{1}</{0}>'.format(tag, escape('{}'.format(value)))
+
+
+def _city(rnd, i):
+    name, name_en, post_code = _CITIES[i % len(_CITIES)]
+    if i >= len(_CITIES):
+        name, name_en = '{} {}'.format(name, i), '{} {}'.format(name_en, i)
+        post_code = '{}'.format(1000 + (i * 7) % 9000)
+    return {'id': i + 1, 'post_code': post_code, 'type': 'гр.',
+            'id_zone': 1 + i % 5, 'name': name, 'name_en': name_en,
+            'region': 'обл. {}'.format(_CITIES[i % len(_CITIES)][0]),
+            'id_country': 1033, 'id_office': 1 + i % 1500,
+            'updated_time': '2015-0{}-1{} 10:00:00'.format(1 + i % 9, i % 10)}
+
+
+def _office(rnd, i):
+    city = _city(rnd, i % 200)
+    return {'id': i + 1, 'name': '{} - офис {}'.format(city['name'], i),
+            'name_en': '{} - office {}'.format(city['name_en'], i),
+            'office_code': '{}'.format(1000 + i), 'country_code': 'BGR',
+            'city_id': city['id'], 'city_name': city['name'],
+            'city_name_en': city['name_en'], 'post_code': city['post_code'],
+            'address': 'ул. {} {}'.format(_STREETS[i % len(_STREETS)][0], i),
+            'address_details': {'quarter': '', 'street': _STREETS[
+                i % len(_STREETS)][0], 'street_num': i % 120},
+            'phone': '0700 17 {:03d}'.format(i % 1000),
+            'latitude': '{:.6f}'.format(41.3 + rnd.random() * 2.9),
+            'longitude': '{:.6f}'.format(22.4 + rnd.random() * 6.2),
+            'work_begin': '08:30', 'work_end': '19:00',
+            'work_begin_saturday': '09:00', 'work_end_saturday': '13:00',
+            'time_priority': '', 'updated_time': '2015-02-0{} 12:00:00'.format(
+                1 + i % 9)}
+
+
+def _street(rnd, i):
+    name, name_en = _STREETS[i % len(_STREETS)]
+    city = _city(rnd, i % 200)
+    if i >= len(_STREETS):
+        name, name_en = '{} {}'.format(name, i), '{} {}'.format(name_en, i)
+    return {'id': i + 1, 'name': name, 'name_en': name_en,
+            'city_post_code': city['post_code'], 'id_city': city['id'],
+            'updated_time': '2015-03-0{} 08:00:00'.format(1 + i % 9)}
+
+
+def _quarter(rnd, i):
+    record = _street(rnd, i)
+    record['name'] = 'кв. {}'.format(record['name'])
+    return record
+
+
+def _region(rnd, i):
+    city = _city(rnd, i % 200)
+    return {'id': i + 1, 'name': 'Район {}'.format(i), 'code': i % 100,
+            'id_city': city['id'], 'updated_time': '2015-01-01 00:00:00'}
+
+
+def _zone(rnd, i):
+    return {'id': i + 1, 'name': 'Зона {}'.format(i + 1),
+            'national': 1 if i == 0 else 0, 'is_ee': 0,
+            'updated_time': '2015-01-01 00:00:00'}
+
+
+def _country(rnd, i):
+    return {'id': 1000 + i, 'country_name': 'Държава {}'.format(i),
+            'country_name_en': 'Country {}'.format(i),
+            'id_zone': 1 + i % 5}
+
+
+def _tariff_courier(rnd):
+    types = []
+    for shipment_type in _SHIPMENT_TYPES:
+        for sub_code in _TARIFF_SUB_CODES:
+            base = 3 + _TARIFF_SUB_CODES.index(sub_code) * 0.9
+            weights = [{'weight_from': w, 'weight_to': w + 1,
+                        'price': '{:.2f}'.format(base + w * 0.65)}
+                       for w in range(50)]
+            types.append({'shipment_type': shipment_type,
+                          'tariff_sub_code': sub_code,
+                          'weights': {'e': weights}})
+    return {'service_types': {'e': types},
+            'services': {'cd_percent': '1.5', 'cd_min': '1.50',
+                         'oc_percent': '0.6', 'oc_min': '0.60'}}
+
+
+def _tariff_post(rnd):
+    weights = [{'weight_from': '{:.1f}'.format(w * 0.5),
+                'weight_to': '{:.1f}'.format(w * 0.5 + 0.5),
+                'price': '{:.2f}'.format(1.2 + w * 0.35)} for w in range(40)]
+    return {'general_tariff': {'e': weights}}
+
+
+_DELIVERY_STATUSES = [('Приета', 'Accepted'), ('В транзит', 'In transit'),
+                      ('Доставена', 'Delivered')]
+
+
+def _shipment(num, elapsed, step):
+    """
+    Shipment `num` moves on to its next status every one to three
+    times `step` seconds, until it is delivered.
+
+    """
+    if not num.isdigit():
+        return {'loading_num': num, 'error': 'Невалидна товарителница'}
+    duration = step * (1 + int(num) % 3)
+    stage = min(len(_DELIVERY_STATUSES) - 1, int(elapsed // duration))
+    status, status_en = _DELIVERY_STATUSES[stage]
+    return {'loading_num': num, 'is_imported': 0,
+            'short_delivery_status': status,
+            'short_delivery_status_en': status_en,
+            'delivery_date': '2015-05-05' if stage == 2 else '',
+            'tracking': {'row': [
+                {'time': '2015-05-0{} 10:00:00'.format(4 + i), 'event': s,
+                 'name_en': en}
+                for i, (s, en) in enumerate(_DELIVERY_STATUSES[:stage + 1])]},
+            'error': ''}
+
+
+_RECORDS = {
+    'cities': ('cities', _city),
+    'cities_quarters': ('cities_quarters', _quarter),
+    'cities_regions': ('cities_regions', _region),
+    'cities_streets': ('cities_street', _street),
+    'cities_zones': ('zones', _zone),
+    'offices': ('offices', _office),
+}
+
+
+def render(request_type, records=None, seed=0, rows=1, nums=(),
+           elapsed=0.0, step=60.0, city_names=()):
+    """
+    Return the XML body (bytes) of the response to `request_type`.
+
+    `records` overrides the number of records of nomenclature
+    responses, `rows` is the number of loadings of a `shipping`
+    request.  `nums` are the waybills of a `shipments` request, whose
+    statuses advance every `step` seconds of the `elapsed` time.
+    `city_names` limits a `cities` response to the cities with one of
+    these names, in Bulgarian or English and regardless of case, like
+    the `<city_name>` filter of the service.
+
+    """
+    rnd = random.Random(seed)
+
+    if request_type in _RECORDS:
+        key, generate = _RECORDS[request_type]
+        count = RECORDS[request_type] if records is None else records
+        items = [generate(rnd, i) for i in range(count)]
+        if request_type == 'cities' and city_names:
+            wanted = {name.lower() for name in city_names}
+            items = [c for c in items if c['name'].lower() in wanted or
+                     c['name_en'].lower() in wanted]
+        body = _element(key, {'e': items})
+    elif request_type == 'countries':
+        count = RECORDS['countries'] if records is None else records
+        body = _element('e', [_country(rnd, i) for i in range(count)])
+    elif request_type == 'client_info':
+        body = _element('client_info', {
+            'id': 42, 'ein': '121212121', 'name': 'ИТ Партнър ООД',
+            'name_en': 'IT Partner Ltd', 'city': 'София',
+            'address': 'ул. Витоша 1', 'phone': '02 111 222'})
+    elif request_type == 'delivery_days':
+        body = _element('delivery_days', {'e': [
+            {'date': '2015-05-0{}'.format(d)} for d in (4, 5)]})
+    elif request_type == 'tariff_courier':
+        body = ''.join(_element(k, v)
+                       for k, v in _tariff_courier(rnd).items())
+    elif request_type == 'tariff_post':
+        body = _element('general_tariff', _tariff_post(rnd)['general_tariff'])
+    elif request_type == 'shipments':
+        body = _element('shipments', {'e': [_shipment(n, elapsed, step)
+                                            for n in nums]})
+    elif request_type == 'shipping':
+        body = _element('result', {'e': [{
+            'loading_num': '{}'.format(1051600000000 + i),
+            'loading_id': '{}'.format(30000000 + i),
+            'courier_request_id': '', 'delivery_date': '2015-05-05',
+            'loading_price': {'total': '{:.2f}'.format(4 + rnd.random())},
+            'pdf_url': '', 'error': '', 'error_code': ''}
+            for i in range(rows)]})
+    else:
+        body = _element('error', 'Unsupported request_type')
+
+    xml = '<?xml version="1.0" encoding="UTF-8"?>\n<response>{}</response>'
+    return xml.format(body).encode('utf-8')
+
+
+def _gzip(data):
+    out = BytesIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients that time out hang up before the response is sent
+        if not isinstance(sys.exc_info()[1], (IOError, OSError)):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # headers and body are written separately; without this small
+    # responses wait for the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    _REQUEST_TYPE = re.compile(br'<request_type>\s*(\w+)\s*</request_type>')
+    _NUM = re.compile(br'<num>\s*([^<\s]*)\s*</num>')
+    _CITY_NAME = re.compile(br'<city_name>\s*([^<]*?)\s*</city_name>')
+
+    def do_POST(self):
+        standin = self.server.standin
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+
+        match = self._REQUEST_TYPE.search(body)
+        request_type = match.group(1).decode('ascii') if match else ''
+        rows = max(1, body.count(b'<row>'))
+
+        encoding = self.headers.get('Accept-Encoding') or ''
+        gzipped = standin.compression and 'gzip' in encoding
+
+        city_names = [n.decode('utf-8')
+                      for n in self._CITY_NAME.findall(body) if n] \
+            if request_type == 'cities' else []
+        if request_type == 'shipments':
+            nums = [n.decode('utf-8') for n in self._NUM.findall(body)]
+            xml = render(request_type, nums=nums,
+                         elapsed=time.time() - standin.started,
+                         step=standin.shipment_step)
+            if gzipped:
+                xml = _gzip(xml)
+        elif city_names:
+            xml = render(request_type, standin.records.get(request_type),
+                         city_names=city_names)
+            if gzipped:
+                xml = _gzip(xml)
+        else:
+            xml = standin.response(request_type, rows, gzipped)
+        if standin.latency:
+            time.sleep(standin.latency)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=UTF-8')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', '{}'.format(len(xml)))
+        self.end_headers()
+        self.wfile.write(xml)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandinServer(object):
+    """
+    HTTP server replaying generated Econt responses on localhost.
+
+    `latency` is the time in seconds to wait before answering each
+    request, `records` maps request types to the number of records of
+    their responses (see `RECORDS`).  Shipments advance to their next
+    status every one to three times `shipment_step` seconds after the
+    server started.  With `compression`, responses are gzipped for
+    clients that accept it.
+
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, records=None,
+                 shipment_step=60.0, compression=True):
+        self.latency = latency
+        self.compression = compression
+        self.records = dict(RECORDS, **(records or {}))
+        self.shipment_step = shipment_step
+        self.started = time.time()
+
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._server = _ThreadingHTTPServer((host, port), _Handler)
+        self._server.standin = self
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @property
+    def service_url(self):
+        return '{}/e-econt/xml_service_tool.php'.format(self.url)
+
+    @property
+    def parcel_url(self):
+        return '{}/e-econt/xml_parcel_import.php'.format(self.url)
+
+    def response(self, request_type, rows=1, gzipped=False):
+        """Return the (cached) response body for `request_type`."""
+        key = (request_type, rows if request_type == 'shipping' else 0)
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = render(request_type,
+                                          self.records.get(request_type),
+                                          rows=rows)
+            if not gzipped:
+                return self._cache[key]
+            if key + (gzipped,) not in self._cache:
+                self._cache[key + (gzipped,)] = _gzip(self._cache[key])
+            return self._cache[key + (gzipped,)]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
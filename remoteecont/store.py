@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import json
+import sqlite3
+import threading
+
+from remoteecont.exceptions import ResponseError
+from remoteecont.snapshot import write_snapshot
+
+__all__ = [
+    'NomenclatureStore'
+]
+
+
+def _record_dict(record):
+    """
+    Return `remoteecont.records` tuples as dictionaries of the fields
+    they have, like those of the service's responses.
+
+    """
+    if hasattr(record, '_asdict'):
+        d = {k: v for k, v in record._asdict().items() if v is not None}
+        d.update(d.pop('extra', None) or {})
+        return d
+    return record
+
+
+class NomenclatureStore(object):
+    """
+    Local SQLite copy of the Econt nomenclatures.
+
+    The first `sync` of an endpoint loads it completely.  Every
+    following `sync` passes the newest `updated_time` of the records
+    received so far, so the service returns only the records changed
+    since, which are merged into the store by their `id`.  The sync
+    point is taken from the service's own timestamps, so the clocks of
+    this host and the service need not agree.  Endpoints whose records
+    carry no `updated_time` are loaded completely every time.  Reads
+    never hit the remote service.
+
+    An error response raises `ResponseError` and leaves the sync point
+    where it was, so that the next `sync` asks for the same changes.
+
+    `path` is the SQLite database file; the default keeps the store
+    in memory for the lifetime of the object.
+
+    """
+
+    ENDPOINTS = ('cities', 'offices', 'cities_streets', 'cities_zones')
+
+    _SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+  endpoint TEXT NOT NULL,
+  id       TEXT NOT NULL,
+  data     TEXT NOT NULL,
+  PRIMARY KEY (endpoint, id)
+);
+CREATE TABLE IF NOT EXISTS syncs (
+  endpoint     TEXT PRIMARY KEY,
+  updated_time TEXT NOT NULL
+);
+'''
+
+    def __init__(self, econt, path=':memory:'):
+        self._econt = econt
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.executescript(self._SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def last_sync(self, endpoint):
+        """Return the `updated_time` of the last sync, or None."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT updated_time FROM syncs WHERE endpoint = ?',
+                (endpoint,)).fetchone()
+        return row[0] if row else None
+
+    def sync(self, endpoints=None):
+        """
+        Bring the given endpoints (all of `ENDPOINTS` by default) up to
+        date.  Return a dictionary with the number of merged records
+        per endpoint.
+
+        """
+        merged = {}
+        for endpoint in endpoints or self.ENDPOINTS:
+            if endpoint not in self.ENDPOINTS:
+                raise ValueError('Unsupported endpoint: {}'.format(endpoint))
+            merged[endpoint] = self._sync(endpoint)
+        return merged
+
+    def _sync(self, endpoint):
+        last = self.last_sync(endpoint)
+        records = getattr(self._econt, endpoint)(updated_time=last)
+
+        # An empty response comes back as a single empty record, an
+        # error response as a record with just an `error`
+        records = [_record_dict(r) for r in records if r]
+        for record in records:
+            if not isinstance(record, dict) or record.get('id') is None:
+                raise ResponseError('Invalid {} record: {}'.format(
+                    endpoint, record.get('error', record)
+                    if isinstance(record, dict) else record))
+        rows = self._rows(endpoint, records)
+        if not rows:
+            return 0
+
+        # Records changed at the newest time itself are fetched again
+        # by the next sync, which is harmless, rather than missed
+        times = [r['updated_time'] for r in records if r.get('updated_time')]
+        if last is not None:
+            times.append(last)
+        with self._lock:
+            with self._db:
+                self._insert(rows)
+                if times:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO syncs (endpoint, '
+                        'updated_time) VALUES (?, ?)',
+                        (endpoint, max(times)))
+        return len(rows)
+
+    @staticmethod
+    def _rows(endpoint, records):
+        rows = []
+        for record in records:
+            record = _record_dict(record)
+            if isinstance(record, dict) and record.get('id') is not None:
+                rows.append((endpoint, '{}'.format(record['id']),
+                             json.dumps(record)))
+        return rows
+
+    def _insert(self, rows):
+        self._db.executemany(
+            'INSERT OR REPLACE INTO records (endpoint, id, data) '
+            'VALUES (?, ?, ?)', rows)
+
+    def merge(self, endpoint, records):
+        """
+        Merge `records`, dictionaries or `remoteecont.records` tuples,
+        into `endpoint` by their `id`, without marking the endpoint as
+        synced; e.g. as the sink of `remoteecont.ingest.ingest`.
+        Records without an id are skipped.  Return the number of
+        records merged.
+
+        """
+        rows = self._rows(endpoint, records)
+        with self._lock:
+            with self._db:
+                self._insert(rows)
+        return len(rows)
+
+    def get(self, endpoint, _id):
+        """Return the record of `endpoint` with the given id, or None."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT data FROM records WHERE endpoint = ? AND id = ?',
+                (endpoint, '{}'.format(_id))).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def all(self, endpoint):
+        """Return all stored records of `endpoint`."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT data FROM records WHERE endpoint = ?',
+                (endpoint,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def cities(self):
+        return self.all('cities')
+
+    def cities_streets(self):
+        return self.all('cities_streets')
+
+    def cities_zones(self):
+        return self.all('cities_zones')
+
+    def offices(self):
+        return self.all('offices')
+
+    def write_snapshot(self, path, endpoints=None):
+        """
+        Write the stored endpoints (all of `ENDPOINTS` by default) as a
+        `remoteecont.snapshot` file, replacing `path` atomically.  Call
+        after `sync` to publish the new data to the readers.
+
+        """
+        write_snapshot(path, {endpoint: self.all(endpoint)
+                              for endpoint in endpoints or self.ENDPOINTS})
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Offline price calculation from the tariff tables of `tariff_courier`
+and `tariff_post`::
+
+    calculator = TariffCalculator.from_client(econt)
+    calculator.quote(2.5, 'PACK', 'DOOR_DOOR', cd=25.50)['total']
+
+The tables are loaded once; quotes are computed in-process without a
+round trip.  `verify` compares a sample of local quotes against the
+`only_calculate` result of `shipping` to catch tariff changes.
+
+"""
+
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import random
+
+from remoteecont.xmlutils import string_types
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = [
+    'TariffCalculator',
+    'WeightTable'
+]
+
+_CENT = Decimal('0.01')
+_ZERO = Decimal('0')
+
+
+def _decimal(value):
+    if value is None or value == '':
+        return _ZERO
+    if hasattr(value, 'item'):
+        # a NumPy scalar, e.g. from `tariff_columns`
+        value = value.item()
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    try:
+        return Decimal(value)
+    except (InvalidOperation, TypeError):
+        raise ValueError('Invalid number: {!r}'.format(value))
+
+
+def _money(value):
+    return value.quantize(_CENT, rounding=ROUND_HALF_UP)
+
+
+def _money_array(values):
+    """`_money` of a float array: half away from zero, to cents."""
+    # rounding to a micro-cent first drops the binary noise that makes
+    # e.g. 1.005 * 100 come out as 100.49999999999999
+    cents = numpy.round(numpy.abs(values) * 100, 6)
+    return numpy.copysign(numpy.floor(cents + 0.5), values) / 100
+
+
+class WeightTable(object):
+    """
+    Prices by weight bracket.  A weight `w` falls into the first
+    bracket with `weight_from <= w <= weight_to`.
+
+    """
+
+    def __init__(self, rows):
+        rows = sorted((_decimal(r['weight_from']), _decimal(r['weight_to']),
+                       _decimal(r['price'])) for r in rows)
+        self.weight_from = [r[0] for r in rows]
+        self.weight_to = [r[1] for r in rows]
+        self.prices = [r[2] for r in rows]
+        self._arrays = None
+
+    def __len__(self):
+        return len(self.prices)
+
+    def price(self, weight):
+        weight = _decimal(weight)
+        i = bisect_left(self.weight_to, weight)
+        if i == len(self.prices) or weight < self.weight_from[i]:
+            raise ValueError('No tariff for weight {}'.format(weight))
+        return self.prices[i]
+
+    def prices_of(self, weights):
+        """Vectorised `price`: NaN for weights out of the table."""
+        if self._arrays is None:
+            self._arrays = tuple(numpy.array(a, dtype=float) for a in
+                                 (self.weight_from, self.weight_to,
+                                  self.prices + [float('nan')]))
+        weight_from, weight_to, prices = self._arrays
+
+        i = numpy.searchsorted(weight_to, weights, side='left')
+        result = prices[i]
+        inside = i < len(weight_from)
+        result[inside & (weights < weight_from[numpy.minimum(
+            i, len(weight_from) - 1)])] = numpy.nan
+        return result
+
+
+def _service_amount(value):
+    """Amount of the `cd` or `oc` service of a loading."""
+    if isinstance(value, dict):
+        value = value.get('__content__')
+    return _decimal(value)
+
+
+class TariffCalculator(object):
+    """
+    Price shipments from the courier and post tariff tables.
+
+    `service_types` is the result of `tariff_courier()`: one entry per
+    `shipment_type` and `tariff_sub_code` with its `weights` brackets.
+    `services` holds the cash on delivery (`cd_percent`, `cd_min`) and
+    declared value (`oc_percent`, `oc_min`) rates of the same response;
+    without it the `cd` and `oc` services are not priced.
+    `general_tariff` is the result of `tariff_post()`.
+
+    The tariff tables carry no destination zone, so the destination of
+    a shipment enters the price only through its `tariff_sub_code`.
+
+    """
+
+    def __init__(self, service_types=(), services=None, general_tariff=()):
+        self.tables = {}
+        for service_type in service_types:
+            weights = service_type.get('weights') or {}
+            rows = weights.get('e', weights) if isinstance(weights, dict) \
+                else weights
+            if isinstance(rows, dict):
+                rows = [rows]
+            key = (service_type['shipment_type'],
+                   service_type['tariff_sub_code'])
+            self.tables[key] = WeightTable(rows)
+
+        services = services or {}
+        self.rates = {}
+        for service in ('cd', 'oc'):
+            if services.get(service + '_percent') not in (None, ''):
+                self.rates[service] = (
+                    _decimal(services[service + '_percent']) / 100,
+                    _decimal(services.get(service + '_min')))
+
+        self.post = WeightTable(general_tariff) if general_tariff else None
+
+    @classmethod
+    def from_client(cls, econt):
+        """Load the tariff tables through a `RemoteEcontXml` client."""
+        # the service types and the service rates come in one response
+        response = econt._shorthand('tariff_courier', key='')[0]
+        services = econt._extract(response, 'tariff_courier', 'services')
+        return cls(econt._extract(response, 'tariff_courier', 'service_types'),
+                   services[0] if services else None,
+                   econt.tariff_post())
+
+    def _table(self, shipment_type, tariff_sub_code):
+        try:
+            return self.tables[(shipment_type, tariff_sub_code)]
+        except KeyError:
+            raise ValueError('No tariff for {} {}'.format(shipment_type,
+                                                          tariff_sub_code))
+
+    def service_fee(self, service, amount):
+        """Fee of the `cd` or `oc` service for `amount`."""
+        amount = _decimal(amount)
+        if not amount:
+            return _ZERO
+        percent, minimum = self.rates.get(service, (_ZERO, _ZERO))
+        return _money(max(minimum, amount * percent))
+
+    def quote(self, weight, shipment_type='PACK', tariff_sub_code='DOOR_DOOR',
+              cd=None, oc=None):
+        """
+        Return the price of a courier shipment as a dictionary of
+        Decimals: `price` by weight, the `cd` and `oc` fees and `total`.
+
+        Raise `ValueError` if the tables do not cover the shipment.
+
+        """
+        price = _money(self._table(shipment_type, tariff_sub_code)
+                       .price(weight))
+        fees = {service: self.service_fee(service, amount)
+                for service, amount in (('cd', cd), ('oc', oc))}
+        return {'price': price, 'cd': fees['cd'], 'oc': fees['oc'],
+                'total': price + fees['cd'] + fees['oc']}
+
+    def quote_post(self, weight):
+        """Price of a post shipment of `weight` kg."""
+        if self.post is None:
+            raise ValueError('No post tariff loaded')
+        return _money(self.post.price(weight))
+
+    def quote_loading(self, loading):
+        """`quote` for a loading in the format of `shipping`."""
+        shipment = loading.get('shipment', {})
+        services = loading.get('services', {})
+        return self.quote(shipment.get('weight'),
+                          shipment.get('shipment_type') or 'PACK',
+                          shipment.get('tariff_sub_code') or 'DOOR_DOOR',
+                          _service_amount(services.get('cd')),
+                          _service_amount(services.get('oc')))
+
+    def quote_many(self, weights, shipment_type='PACK',
+                   tariff_sub_code='DOOR_DOOR', cd=None, oc=None):
+        """
+        Total prices of many shipments at once.
+
+        Every argument is either a single value for all shipments or a
+        sequence with one value per shipment.  With NumPy installed the
+        result is a float array computed without a Python loop per
+        shipment, with NaN for the shipments the tables do not cover;
+        otherwise it is a list of Decimals, with None for those.
+
+        """
+        if numpy is None:
+            return self._quote_many(weights, shipment_type, tariff_sub_code,
+                                    cd, oc)
+
+        weights = numpy.asarray(weights, dtype=float)
+        n = weights.shape[0]
+        totals = numpy.full(n, numpy.nan)
+
+        if isinstance(shipment_type, string_types) and \
+                isinstance(tariff_sub_code, string_types):
+            if (shipment_type, tariff_sub_code) in self.tables:
+                totals = self.tables[(shipment_type, tariff_sub_code)] \
+                    .prices_of(weights)
+        else:
+            types = numpy.broadcast_to(numpy.asarray(shipment_type), (n,))
+            sub_codes = numpy.broadcast_to(numpy.asarray(tariff_sub_code),
+                                           (n,))
+            for (t, s), table in self.tables.items():
+                group = (types == t) & (sub_codes == s)
+                if group.any():
+                    totals[group] = table.prices_of(weights[group])
+        totals = _money_array(totals)
+
+        for service, amounts in (('cd', cd), ('oc', oc)):
+            if amounts is None or service not in self.rates:
+                continue
+            amounts = numpy.broadcast_to(
+                numpy.asarray(amounts, dtype=float), (n,))
+            percent, minimum = self.rates[service]
+            fees = numpy.maximum(float(minimum), amounts * float(percent))
+            totals = totals + numpy.where(amounts > 0, _money_array(fees), 0)
+
+        return _money_array(totals)
+
+    def _quote_many(self, weights, shipment_type, tariff_sub_code, cd, oc):
+        def column(value):
+            if value is None or isinstance(value, string_types + (int, float,
+                                                                   Decimal)):
+                return [value] * len(weights)
+            return list(value)
+
+        totals = []
+        for args in zip(weights, column(shipment_type),
+                        column(tariff_sub_code), column(cd), column(oc)):
+            try:
+                totals.append(self.quote(*args)['total'])
+            except ValueError:
+                totals.append(None)
+        return totals
+
+    def verify(self, econt, loadings, sample=10, tolerance='0.01',
+               system=None):
+        """
+        Compare local quotes of up to `sample` randomly chosen loadings
+        with the `only_calculate` result of `shipping`, in one request.
+
+        Return a dictionary with the number of `checked` loadings and
+        the `mismatches`: for each loading whose prices differ by more
+        than `tolerance` or cannot be priced locally, a dictionary with
+        the `loading`, the `local` and the `remote` total.
+
+        """
+        loadings = list(loadings)
+        if len(loadings) > sample:
+            loadings = random.sample(loadings, sample)
+
+        system = dict(system or {}, only_calculate=1)
+        results = econt._shipping_result_rows(
+            len(loadings), econt.shipping(loadings, system))
+        tolerance = _decimal(tolerance)
+
+        mismatches = []
+        for loading, result in zip(loadings, results):
+            try:
+                local = self.quote_loading(loading)['total']
+            except ValueError:
+                local = None
+            price = result.get('loading_price') or {}
+            remote = price.get('total') if isinstance(price, dict) else price
+            try:
+                remote = _decimal(remote) if remote not in (None, '') \
+                    else None
+            except ValueError:
+                remote = None
+            if local is None or remote is None or \
+                    abs(local - remote) > tolerance:
+                mismatches.append({'loading': loading, 'local': local,
+                                   'remote': remote})
+
+        return {'checked': len(loadings), 'mismatches': mismatches}
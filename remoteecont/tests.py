@@ -1 +1,1281 @@
-# TODO
+# -*- coding: utf-8 -*-
+"""
+Tests against the local stand-in of the Econt services::
+
+    python -m pytest remoteecont/tests.py
+
+"""
+
+from __future__ import unicode_literals
+
+from decimal import Decimal
+import logging
+import sys
+import threading
+import time
+import zlib
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from remoteecont import (CircuitOpenError, CurlTransfer, HttpTransfer,
+                         InvalidLoading, RateLimitExceeded, RemoteEcontXml, ResponseError,
+                         TransferError)
+from remoteecont.accounts import MultiAccountEcont
+from remoteecont.batching import CityBatcher
+from remoteecont.cache import CachedRemoteEcontXml
+from remoteecont.columns import (MISSING_INT, DictionaryColumn, coordinates,
+                                 nearest, tariff_columns, to_columns,
+                                 to_table, write_npz)
+from remoteecont.outbox import ShipmentOutbox, idempotency_key
+from remoteecont.policy import CircuitBreaker, RetryPolicy
+from remoteecont.index import NomenclatureIndex, distance
+from remoteecont.ingest import ingest_endpoint
+from remoteecont.metrics import (CallEvent, Histogram, LoggingObserver,
+                                 MetricsObserver, MetricsRegistry)
+from remoteecont.records import Office, Street
+from remoteecont.snapshot import Snapshot, write_snapshot
+from remoteecont.standin import StandinServer
+from remoteecont.tariff import TariffCalculator
+from remoteecont.tracking import ShipmentTracker
+from remoteecont.validation import LoadingValidator
+from remoteecont import xmlutils
+from remoteecont.xmlutils import Serializer, dumps, xml2dict
+from remoteecont.store import NomenclatureStore
+from remoteecont.transfer import CurlPool, Transfer
+
+RECORDS = {'cities': 50, 'cities_quarters': 40, 'cities_streets': 200,
+           'countries': 10, 'offices': 30}
+
+# nothing listens on port 1
+DOWN_URL = 'http://127.0.0.1:1/e-econt/xml_service_tool.php'
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = StandinServer(records=RECORDS).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope='module')
+def slow_server():
+    server = StandinServer(latency=0.3, records=RECORDS).start()
+    yield server
+    server.stop()
+
+
+def client(server, cls=RemoteEcontXml, transfer_class=CurlTransfer,
+           **kwargs):
+    return cls(server.service_url, server.parcel_url, 'user', 'pass',
+               transfer_class, **kwargs)
+
+
+@pytest.fixture
+def econt(server):
+    econt = client(server, pool_size=2)
+    yield econt
+    econt.close()
+
+
+class Events(list):
+    """Observer collecting the call events."""
+
+    def __call__(self, event):
+        self.append(event)
+
+
+# transfers and pools
+
+@pytest.mark.parametrize('transfer_class', [CurlTransfer, HttpTransfer])
+def test_transfers(server, transfer_class):
+    events = Events()
+    econt = client(server, transfer_class=transfer_class, pool_size=1,
+                   observers=[events])
+    try:
+        offices = econt.offices()
+        assert len(offices) == RECORDS['offices']
+        assert offices[0]['city_name'] == 'София'
+        assert econt.offices() == offices
+    finally:
+        econt.close()
+
+    event = events[-1]
+    assert event.error is None
+    assert event.response_bytes > event.wire_bytes > 0
+    assert set(event.timings) == {'build', 'transfer', 'parse', 'total'}
+
+
+@pytest.mark.parametrize('transfer_class', [CurlTransfer, HttpTransfer])
+def test_response_chunks(server, transfer_class):
+    econt = client(server, transfer_class=transfer_class)
+    event = CallEvent('offices')
+    chunks = econt._send_xml_service(econt._generic_xml('offices'), event)
+    assert isinstance(chunks, list)
+    assert event.response_bytes == sum(len(c) for c in chunks)
+    data = econt._convert_xml_to_dict(chunks)
+    assert econt._extract(data, 'offices') == econt.offices()
+
+
+def test_cities_filter(econt):
+    varna, = econt.cities('Варна')
+    assert varna['name_en'] == 'Varna'
+    cities = econt.cities(['sofia', 'Пловдив'])
+    assert sorted(c['name'] for c in cities) == ['Пловдив', 'София']
+    assert len(econt.cities()) == RECORDS['cities']
+
+
+def test_curl_pool_reuses_handles():
+    pool = CurlPool(1)
+    curl = pool.acquire()
+    pool.release(curl)
+    assert pool.acquire() is curl
+    pool.release(curl)
+
+    pool.close()
+    with pytest.raises(ValueError):
+        pool.acquire()
+
+
+def test_pooled_client_keeps_its_connection(econt):
+    econt.countries()
+    econt.countries()
+    assert len(econt._pool._idle) == 1
+
+
+class LegacyTransfer(Transfer):
+    """Transfer written for the constructor without arguments."""
+
+    def __init__(self):
+        self._transfer = HttpTransfer()
+
+    def append_str_as_file(self, *args):
+        self._transfer.append_str_as_file(*args)
+
+    def perform(self, url):
+        return self._transfer.perform(url)
+
+    def close(self):
+        self._transfer.close()
+
+
+def test_transfer_without_options(server):
+    events = Events()
+    econt = client(server, transfer_class=LegacyTransfer, observers=[events])
+    assert len(econt.countries()) == RECORDS['countries']
+    assert events[-1].wire_bytes is None
+
+
+@pytest.mark.parametrize('transfer_class', [CurlTransfer, HttpTransfer])
+def test_transfer_error(transfer_class):
+    econt = RemoteEcontXml(DOWN_URL, DOWN_URL, 'user', 'pass', transfer_class)
+    with pytest.raises(TransferError) as info:
+        econt.countries()
+    # curl's CURLE_COULDNT_CONNECT
+    assert info.value.code == 7
+
+
+class EncodedHandler(BaseHTTPRequestHandler):
+    """Answer with `body`, deflated in the format named by the path."""
+
+    body = b'<response><e><id>1</id></e></response>' * 100
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        wbits = {'/zlib': zlib.MAX_WBITS, '/raw': -zlib.MAX_WBITS,
+                 '/gzip': 16 + zlib.MAX_WBITS}[self.path]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+        data = compressor.compress(self.body) + compressor.flush()
+        self.send_response(200)
+        self.send_header('Content-Encoding',
+                         'gzip' if self.path == '/gzip' else 'deflate')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        # a byte at a time, so that the header arrives split
+        for i in range(len(data)):
+            self.wfile.write(data[i:i + 1])
+            self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+class ClosingHandler(BaseHTTPRequestHandler):
+    """Answer keep-alive requests, but close every connection after it."""
+
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    body = b'<response><e>ok</e></response>'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        ClosingHandler.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+def test_http_transfer_retries_closed_connections():
+    httpd = HTTPServer(('127.0.0.1', 0), ClosingHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    pool = HttpTransfer.create_pool(1, 60)
+    url = 'http://127.0.0.1:{}/'.format(httpd.server_port)
+    try:
+        for i in range(3):
+            transfer = HttpTransfer(pool)
+            transfer.append_data('xml', 'x')
+            assert transfer.perform(url) == ClosingHandler.body
+            transfer.close()
+            # the pool kept the connection the server closed
+            assert len(pool._idle[('http', '127.0.0.1', httpd.server_port)]) \
+                == 1
+            time.sleep(0.05)
+        assert ClosingHandler.connections == 3
+    finally:
+        pool.close()
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.mark.parametrize('path', ['/zlib', '/raw', '/gzip'])
+def test_http_transfer_decoding(path):
+    httpd = HTTPServer(('127.0.0.1', 0), EncodedHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        transfer = HttpTransfer(accept_encoding='gzip, deflate')
+        transfer.append_data('xml', 'x')
+        url = 'http://127.0.0.1:{}{}'.format(httpd.server_port, path)
+        assert transfer.perform(url) == EncodedHandler.body
+        assert transfer.info['size_download'] < len(EncodedHandler.body)
+        transfer.close()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+# streaming
+
+def test_streaming(econt):
+    offices = econt.offices()
+    assert list(econt.iter_offices()) == offices
+
+    records = list(econt.iter_offices(record_type=Office))
+    assert [r.office_code for r in records] == \
+        [o['office_code'] for o in offices]
+    assert records[0].get('address_details') == offices[0]['address_details']
+
+    streets = list(econt.iter_cities_streets())
+    assert len(streets) == RECORDS['cities_streets']
+
+
+def test_streaming_events(server):
+    events = Events()
+    econt = client(server, observers=[events])
+    assert len(list(econt.iter_offices())) == RECORDS['offices']
+    event, = events
+    assert event.request_type == 'offices' and event.error is None
+    assert event.response_bytes > 0 and 'transfer' in event.timings
+
+    down = RemoteEcontXml(DOWN_URL, DOWN_URL, 'user', 'pass', CurlTransfer,
+                          observers=[events])
+    with pytest.raises(TransferError):
+        list(down.iter_offices())
+    assert isinstance(events[-1].error, TransferError)
+
+
+@pytest.mark.parametrize('transfer_class', [CurlTransfer, HttpTransfer])
+def test_slow_stream_consumer(transfer_class):
+    server = StandinServer(records={'cities_streets': 20000},
+                           compression=False).start()
+    try:
+        econt = client(server, transfer_class=transfer_class, timeout=0.5)
+        count = 0
+        for _ in econt.iter_cities_streets():
+            if count == 0:
+                # longer than the timeout, while data is waiting
+                time.sleep(1.5)
+            count += 1
+        assert count == 20000
+    finally:
+        server.stop()
+
+
+class BrokenTransfer(Transfer):
+
+    def __init__(self):
+        raise TransferError('Cannot create a transfer')
+
+
+def test_streaming_errors(server):
+    events = Events()
+    breaker = CircuitBreaker(failure_threshold=2)
+    econt = client(server, observers=[events], circuit_breaker=breaker)
+    # the stand-in answers unsupported requests with <error>
+    with pytest.raises(ResponseError):
+        list(econt._stream_shorthand('post_boxes'))
+    assert isinstance(events[-1].error, ResponseError)
+
+    econt = client(server, transfer_class=BrokenTransfer,
+                   observers=[events], circuit_breaker=breaker)
+    with pytest.raises(TransferError):
+        list(econt.iter_offices())
+    assert isinstance(events[-1].error, TransferError)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+# response parsing
+
+@pytest.fixture(params=['stdlib', 'lxml'])
+def backend(request):
+    if request.param == 'lxml':
+        pytest.importorskip('lxml')
+    xmlutils.set_backend(request.param)
+    yield request.param
+    xmlutils.set_backend('stdlib')
+
+
+def test_parse_backends(backend, econt):
+    xml = (b'<response><e><id>1</id><name>\xd0\x92</name></e>'
+           b'<e id="2"><name>B</name></e></response>')
+    expected = {'response': {'e': [
+        {'id': '1', 'name': 'В'},
+        {'__attrib__': {'id': '2'}, 'name': 'B'}]}}
+    for data in (xml, bytearray(xml), memoryview(xml), [xml[:10], xml[10:]],
+                 xml.decode('utf-8')):
+        assert xml2dict(data) == expected
+    assert len(econt.offices()) == RECORDS['offices']
+
+
+def test_records():
+    d = {'id': '1', 'name': 'Витоша', 'id_city': '4', 'unknown': 'x'}
+    street = Street.from_dict(d)
+    assert street.name == 'Витоша' and street.extra == {'unknown': 'x'}
+    assert street.get('unknown') == 'x' and street.get('name_en', '') == ''
+
+    el = xmlutils.etree.fromstring(
+        '<e><id>1</id><name>Витоша</name><id_city>4</id_city>'
+        '<unknown>x</unknown></e>')
+    assert Street.from_element(el) == street
+    assert Street.from_dict(None) == Street(*[None] * len(Street._fields))
+
+
+# request building
+
+def test_serializer_merges_over_defaults():
+    defaults = {'sender': {'city': 'София', 'phone': '', 'name': 'ИТ'},
+                'services': {'cd': {'__attrib__': {'type': 'GET'},
+                                    '__content__': '0'}}}
+    serializer = Serializer('row', defaults)
+    value = {'sender': {'city': 'Варна & <Co>'},
+             'services': {'cd': {'__content__': '12.5'}},
+             'extra': [1, 2]}
+    row = xml2dict(serializer.dumps(value, 'utf-8'))['row']
+
+    assert row['sender'] == {'city': 'Варна & <Co>', 'phone': '',
+                             'name': 'ИТ'}
+    assert row['services']['cd'] == {'__attrib__': {'type': 'GET'},
+                                     '__content__': '12.5'}
+    assert row['extra'] == ['1', '2']
+    # neither the defaults nor the value are modified
+    assert defaults['sender'] == {'city': 'София', 'phone': '', 'name': 'ИТ'}
+    assert value['sender'] == {'city': 'Варна & <Co>'}
+    assert xml2dict(serializer.dumps({}))['row']['sender']['city'] == 'София'
+
+
+def test_dumps_escapes():
+    xml = dumps({'a': {'__attrib__': {'q': 'say "hi"'}, 'b': '1 < 2'}})
+    assert xml2dict(xml) == {'a': {'__attrib__': {'q': 'say "hi"'},
+                                   'b': '1 < 2'}}
+    with pytest.raises(ValueError):
+        dumps({'a': 1, 'b': 2})
+
+
+def test_shipping_xml(econt):
+    xml = econt._shipping_xml([{'receiver': {'name': 'Иван & син'}}],
+                              {'validate': 1})
+    request = xml2dict(xml)['parcels']
+    assert request['system']['validate'] == '1'
+    assert request['loadings']['row']['receiver']['name'] == 'Иван & син'
+
+
+# bulk shipping
+
+class FlakyShipping(RemoteEcontXml):
+    """Fails the requests with a loading marked `fail`."""
+
+    def shipping(self, loadings, system):
+        if any(loading.get('fail') for loading in loadings):
+            raise TransferError('Service down')
+        return super(FlakyShipping, self).shipping(loadings, system)
+
+
+def test_shipping_bulk(server):
+    econt = client(server, FlakyShipping)
+    loadings = [{'shipment': {'weight': i + 1}} for i in range(5)]
+    loadings[2]['fail'] = True
+    rows = econt.shipping_bulk(loadings, chunk_size=2, max_workers=2)
+
+    assert len(rows) == 5
+    assert [bool(row.get('loading_num')) for row in rows] == \
+        [True, True, False, False, True]
+    assert rows[2] == rows[3] == {'error': 'TransferError: Service down'}
+
+
+def test_shipping_result_rows(econt):
+    response = {'result': {'e': {'loading_num': '1'}}}
+    assert econt._shipping_result_rows(2, response) == [
+        {'loading_num': '1'}, {'error': 'Missing result row'}]
+    assert econt._shipping_result_rows(1, None, 'Failed') == \
+        [{'error': 'Failed'}]
+
+
+# metrics
+
+def test_metrics_observer(server):
+    registry = MetricsRegistry()
+    econt = client(server, observers=[MetricsObserver(registry)])
+    econt.countries()
+    econt.countries()
+    with pytest.raises(ResponseError):
+        list(econt._stream_shorthand('post_boxes'))
+
+    observer = MetricsObserver(registry)
+    assert observer.calls.value(request_type='countries', cache='none',
+                                status='ok') == 2
+    assert observer.calls.value(request_type='post_boxes', cache='none',
+                                status='error') == 1
+    assert observer.response_bytes.value(request_type='countries') > \
+        observer.wire_bytes.value(request_type='countries') > 0
+    assert observer.phases.count(request_type='countries',
+                                 phase='total') == 2
+    text = registry.render()
+    assert 'econt_calls_total{cache="none",request_type="countries",' \
+        'status="ok"} 2' in text
+    assert 'econt_phase_seconds_bucket{' in text
+
+
+def test_histogram_quantile():
+    histogram = Histogram('h', '', buckets=(1, 2, 4))
+    for value in (0.5, 1.5, 1.5, 3):
+        histogram.observe(value)
+    assert histogram.count() == 4
+    assert histogram.quantile(0.5) == 1.5
+    assert histogram.quantile(1.0) == 4
+    assert Histogram('e', '').quantile(0.5) is None
+
+
+def test_logging_observer(server, caplog):
+    econt = client(server, observers=[LoggingObserver()])
+    with caplog.at_level(logging.INFO, logger='remoteecont'):
+        econt.countries()
+    record, = caplog.records
+    assert record.econt_event['request_type'] == 'countries'
+    assert record.econt_event['error'] is None
+    assert 'total=' in record.getMessage()
+
+
+# asyncio
+
+requires_aio = pytest.mark.skipif(sys.version_info < (3, 7),
+                                  reason='remoteecont.aio needs Python 3.7')
+
+
+@pytest.fixture
+def aio_econt(server):
+    import asyncio
+    from remoteecont.aio import AsyncRemoteEcontXml
+
+    loop = asyncio.new_event_loop()
+    econt = AsyncRemoteEcontXml(server.service_url, server.parcel_url,
+                                'user', 'pass', pool_size=2)
+    yield loop, econt
+    econt.close()
+    loop.close()
+
+
+def collect(loop, records):
+    out = []
+    while True:
+        try:
+            out.append(loop.run_until_complete(records.__anext__()))
+        except StopAsyncIteration:
+            return out
+
+
+@requires_aio
+def test_async_streaming(aio_econt):
+    loop, econt = aio_econt
+    events = Events()
+    econt.add_observer(events)
+    offices = loop.run_until_complete(econt.offices())
+    assert collect(loop, econt.iter_offices()) == offices
+    assert len(collect(loop, econt.iter_cities_streets(
+        record_type=Street))) == RECORDS['cities_streets']
+    assert events[1].request_type == 'offices' and events[1].error is None
+    assert events[1].response_bytes > 0
+
+    with pytest.raises(ResponseError):
+        collect(loop, econt._stream_shorthand('post_boxes'))
+    assert isinstance(events[-1].error, ResponseError)
+
+
+@requires_aio
+def test_async_sync_only_helpers(aio_econt):
+    loop, econt = aio_econt
+    with pytest.raises(NotImplementedError):
+        econt.batch()
+    with pytest.raises(NotImplementedError):
+        econt.outbox(':memory:')
+
+
+@requires_aio
+def test_async_cancel(slow_server):
+    import asyncio
+    from remoteecont.aio import AsyncRemoteEcontXml
+
+    loop = asyncio.new_event_loop()
+    econt = AsyncRemoteEcontXml(slow_server.service_url,
+                                slow_server.parcel_url, 'user', 'pass')
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            loop.run_until_complete(
+                asyncio.wait_for(econt.countries(), 0.05))
+        assert not econt._pool._futures
+
+        records = econt.iter_offices()
+        loop.run_until_complete(records.__anext__())
+        loop.run_until_complete(records.aclose())
+        assert not econt._pool._futures
+
+        countries = loop.run_until_complete(econt.countries())
+        assert len(countries) == RECORDS['countries']
+    finally:
+        econt.close()
+        loop.close()
+
+
+# caching
+
+def test_cache_hits(server):
+    econt = client(server, CachedRemoteEcontXml)
+    countries = econt.countries()
+    assert econt.countries() is countries
+    assert econt.cache_info()['countries']['hits'] == 1
+
+
+def test_cache_coalesces_concurrent_misses(slow_server):
+    events = Events()
+    econt = client(slow_server, CachedRemoteEcontXml, observers=[events])
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        econt.countries())) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 3
+    assert results[0] == results[1] == results[2]
+    assert [e.cache for e in events].count('miss') == 1
+    assert econt.cache_info()['countries']['coalesced'] == 2
+
+
+# retries and the circuit breaker
+
+def test_retry_policy():
+    calls = []
+
+    def flaky():
+        calls.append(None)
+        if len(calls) < 3:
+            raise TransferError('down', 7)
+        return 'ok'
+
+    policy = RetryPolicy(attempts=3, backoff=0.001)
+    assert policy.call(flaky) == 'ok'
+    assert len(calls) == 3
+
+    del calls[:]
+    with pytest.raises(TransferError):
+        RetryPolicy(attempts=2, backoff=0.001).call(flaky)
+    assert len(calls) == 2
+
+    def invalid():
+        calls.append(None)
+        raise ValueError
+
+    del calls[:]
+    with pytest.raises(ValueError):
+        policy.call(invalid)
+    assert len(calls) == 1
+
+
+def test_client_retries_service_requests(server):
+    events = Events()
+    econt = RemoteEcontXml(DOWN_URL, DOWN_URL, 'user', 'pass', CurlTransfer,
+                           retry=RetryPolicy(attempts=3, backoff=0.001),
+                           observers=[events])
+    with pytest.raises(TransferError):
+        econt.countries()
+    with pytest.raises(TransferError):
+        econt.shipping([{}], {})
+    # the attempts of a call share its event
+    assert [e.request_type for e in events] == ['countries', 'shipping']
+
+
+def test_circuit_breaker_opens_and_recovers(server):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+    down = RemoteEcontXml(DOWN_URL, DOWN_URL, 'user', 'pass', CurlTransfer,
+                          circuit_breaker=breaker)
+    for _ in range(2):
+        with pytest.raises(TransferError):
+            down.countries()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        down.countries()
+
+    # a failed trial opens the circuit again
+    time.sleep(0.1)
+    with pytest.raises(TransferError):
+        down.countries()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # a successful one closes it
+    time.sleep(0.1)
+    up = client(server, circuit_breaker=breaker)
+    assert up.countries()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_circuit_breaker_trials_report_back(server):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    down = RemoteEcontXml(DOWN_URL, DOWN_URL, 'user', 'pass', CurlTransfer,
+                          circuit_breaker=breaker)
+    up = client(server, circuit_breaker=breaker)
+
+    # a stream closed by its caller during the trial
+    with pytest.raises(TransferError):
+        down.countries()
+    time.sleep(0.1)
+    offices = up.iter_offices()
+    next(offices)
+    offices.close()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert up.countries()
+
+    # a stream that fails during the trial
+    with pytest.raises(TransferError):
+        down.countries()
+    time.sleep(0.1)
+    with pytest.raises(TransferError):
+        list(down.iter_offices())
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # an exception other than EcontError
+    time.sleep(0.1)
+
+    def fail():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        breaker.call(fail)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_circuit_breaker_replaces_lost_trials():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    breaker.record_failure()
+    time.sleep(0.1)
+    breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+    # the trial never reported back
+    time.sleep(0.1)
+    breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def raise_(error):
+    raise error
+
+
+def test_circuit_breaker_ignores_requests_not_made():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    for error in (RateLimitExceeded('limit'), ValueError('bad argument')):
+        with pytest.raises(type(error)):
+            breaker.call(raise_, error)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    with pytest.raises(TransferError):
+        breaker.call(raise_, TransferError('down'))
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # a rate limited trial gives its place to the next request
+    time.sleep(0.1)
+    with pytest.raises(RateLimitExceeded):
+        breaker.call(raise_, RateLimitExceeded('limit'))
+    assert breaker.call(lambda: 1) == 1
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_multi_account(server):
+    breaker = CircuitBreaker(failure_threshold=1)
+    accounts = MultiAccountEcont(server.service_url, server.parcel_url,
+                                 CurlTransfer, pool_size=2, rate=0.01,
+                                 burst=2, rate_limit_timeout=0,
+                                 circuit_breaker=breaker)
+    try:
+        first = accounts.add_account('first', 'user1', 'pass1')
+        second = accounts.add_account('second', 'user2', 'pass2', rate=100)
+        assert accounts['first'] is first
+        assert sorted(accounts.accounts()) == ['first', 'second']
+        assert first._pool is second._pool
+
+        assert len(first.countries()) == RECORDS['countries']
+        assert len(list(first.iter_offices())) == RECORDS['offices']
+        with pytest.raises(RateLimitExceeded):
+            first.countries()
+        with pytest.raises(RateLimitExceeded):
+            list(first.iter_offices())
+        assert breaker.state == CircuitBreaker.CLOSED
+
+        # every account has its own limit
+        assert len(second.countries()) == RECORDS['countries']
+
+        accounts.remove_account('second')
+        assert 'second' not in accounts
+        with pytest.raises(KeyError):
+            accounts['second']
+    finally:
+        accounts.close()
+
+
+# batches
+
+def test_batch(slow_server):
+    econt = client(slow_server)
+    start = time.time()
+    with econt.batch() as batch:
+        countries = batch.countries()
+        offices = batch.offices()
+        days = batch.delivery_days()
+    elapsed = time.time() - start
+
+    assert countries.result() == econt.countries()
+    assert len(offices.result()) == RECORDS['offices']
+    assert len(days.result()) == 2
+    # run together rather than one after the other
+    assert elapsed < 3 * slow_server.latency
+
+
+def test_batch_errors(server):
+    econt = RemoteEcontXml(DOWN_URL, DOWN_URL, 'user', 'pass', CurlTransfer)
+    with econt.batch() as batch:
+        countries = batch.countries()
+    assert isinstance(countries.exception(), TransferError)
+    with pytest.raises(TransferError):
+        countries.result()
+
+
+def run_batch(econt, calls):
+    """Call `calls(batch)` in a batch and return the results."""
+    futures = []
+
+    def target():
+        with econt.batch() as batch:
+            futures.extend(calls(batch))
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive(), 'the batch hangs'
+    return [f.result() for f in futures]
+
+
+def test_batch_coalesced_calls(slow_server):
+    econt = client(slow_server, CachedRemoteEcontXml)
+    first, second = run_batch(
+        econt, lambda batch: [batch.countries(), batch.countries()])
+    assert first == second
+    assert len(first) == RECORDS['countries']
+
+
+def test_batch_shipping_bulk(server):
+    econt = client(server)
+    loadings = [{'shipment': {'weight': i + 1}} for i in range(6)]
+    rows, = run_batch(econt, lambda batch: [
+        batch.shipping_bulk(loadings, chunk_size=2)])
+    assert len(rows) == 6
+    assert all(row.get('loading_num') for row in rows)
+
+
+def lookup_cities(batcher, names):
+    """Look the `names` up from one thread each; return the results."""
+    results = [None] * len(names)
+
+    def target(i):
+        try:
+            results[i] = batcher.cities(names[i])
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=target, args=(i,))
+               for i in range(len(names))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert not any(thread.is_alive() for thread in threads)
+    return results
+
+
+def test_city_batcher(server):
+    events = Events()
+    batcher = CityBatcher(client(server, observers=[events]), window=0.5)
+    names = ['Варна', 'varna', 'Sofia', 'Пловдив', 'Nowhere'] * 2
+    results = lookup_cities(batcher, names)
+
+    assert batcher.lookups == len(names)
+    assert batcher.requests == len(events) == 1
+    for name, cities in zip(names, results):
+        assert len(cities) == (name != 'Nowhere')
+    assert results[0][0]['name'] == results[1][0]['name'] == 'Варна'
+    assert results[2][0]['name'] == 'София'
+
+
+def test_city_batcher_max_items(server):
+    events = Events()
+    batcher = CityBatcher(client(server, observers=[events]), window=5,
+                          max_items=2)
+    start = time.time()
+    results = lookup_cities(batcher, ['Варна', 'Sofia', 'Ruse', 'Shumen'])
+    assert time.time() - start < 5
+    assert batcher.requests == len(events) == 2
+    assert [len(cities) for cities in results] == [1, 1, 1, 1]
+
+
+def test_city_batcher_errors():
+    econt = RemoteEcontXml(DOWN_URL, DOWN_URL, 'user', 'pass', CurlTransfer)
+    batcher = CityBatcher(econt, window=0.2)
+    results = lookup_cities(batcher, ['Варна', 'Sofia', 'Ruse'])
+    assert batcher.requests == 1
+    assert all(isinstance(e, TransferError) for e in results)
+
+
+# nomenclature store and snapshots
+
+def test_store_sync(econt):
+    store = NomenclatureStore(econt)
+    assert store.sync(['offices', 'cities']) == {
+        'offices': RECORDS['offices'], 'cities': RECORDS['cities']}
+    assert store.last_sync('offices') is not None
+    assert store.get('offices', 2)['office_code'] == '1001'
+    assert len(store.cities()) == RECORDS['cities']
+
+    with pytest.raises(ValueError):
+        store.sync(['countries'])
+
+
+class FakeNomenclatures(object):
+    """Client answering `offices` with the given responses in turn."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.updated_times = []
+
+    def offices(self, updated_time=None):
+        self.updated_times.append(updated_time)
+        return self.responses.pop(0)
+
+
+def test_store_delta_sync():
+    econt = FakeNomenclatures(
+        [{'id': '1', 'name': 'A', 'updated_time': '2015-01-03 09:00:00'},
+         {'id': '2', 'name': 'B', 'updated_time': '2015-01-02 10:00:00'}],
+        [{'error': 'Database error'}],
+        [''],
+        [{'id': '2', 'name': 'C', 'updated_time': '2015-01-04 08:00:00'}])
+    store = NomenclatureStore(econt)
+
+    assert store.sync(['offices']) == {'offices': 2}
+    # the service's time, not the local one
+    assert store.last_sync('offices') == '2015-01-03 09:00:00'
+
+    with pytest.raises(ResponseError):
+        store.sync(['offices'])
+    assert store.last_sync('offices') == '2015-01-03 09:00:00'
+
+    assert store.sync(['offices']) == {'offices': 0}
+    assert store.last_sync('offices') == '2015-01-03 09:00:00'
+
+    assert store.sync(['offices']) == {'offices': 1}
+    assert store.last_sync('offices') == '2015-01-04 08:00:00'
+    assert store.get('offices', 2)['name'] == 'C'
+    assert econt.updated_times == [None] + ['2015-01-03 09:00:00'] * 3
+
+
+def test_store_merges_records(econt):
+    streets = econt.cities_streets()
+    store = NomenclatureStore(econt)
+    records = list(econt.iter_cities_streets(record_type=Street))
+    records[0] = records[0]._replace(extra={'note': 'x'})
+    assert store.merge('cities_streets', records) == len(streets)
+    assert store.get('cities_streets', streets[0]['id']) == \
+        dict(streets[0], note='x')
+    assert store.get('cities_streets', streets[1]['id']) == streets[1]
+
+    store = NomenclatureStore(econt)
+    count = ingest_endpoint(
+        econt, 'cities_streets',
+        lambda records: store.merge('cities_streets', records),
+        chunk_size=50, max_workers=1, convert=Street.from_element)
+    assert count == len(streets)
+    by_id = lambda r: r['id']
+    assert sorted(store.cities_streets(), key=by_id) == \
+        sorted(streets, key=by_id)
+
+
+def test_snapshot_round_trip(econt, tmpdir):
+    path = str(tmpdir.join('econt.snap'))
+    offices = econt.offices()
+    cities = econt.cities()
+    write_snapshot(path, {'offices': offices, 'cities': cities})
+
+    snapshot = Snapshot(path)
+    assert list(snapshot['offices']) == offices
+    assert snapshot['cities'].by_id(cities[7]['id']) == cities[7]
+    assert snapshot['offices'].by_id('missing') is None
+    assert snapshot['offices'].find('city_name', 'Варна') == \
+        [o for o in offices if o['city_name'] == 'Варна']
+    assert not snapshot.refresh()
+
+    write_snapshot(path, {'offices': offices[:5]})
+    assert snapshot.refresh()
+    assert len(snapshot['offices']) == 5
+    assert 'cities' not in snapshot
+
+
+# local indexes
+
+def test_nearest_offices(econt):
+    offices = econt.offices()
+    without = dict(offices[0], latitude='', longitude='')
+    index = NomenclatureIndex([without] + offices[1:], econt.cities())
+    assert len(index.offices) == len(offices) - 1
+    assert index.office(without['office_code']) is without
+
+    lat, lon = 42.69, 23.32
+    expected = sorted((distance(lat, lon, float(o['latitude']),
+                                float(o['longitude'])), o['id'])
+                      for o in offices[1:])
+    nearest = index.nearest_offices(lat, lon, count=5)
+    assert [o['id'] for _, o in nearest] == [i for _, i in expected[:5]]
+    assert index.nearest_offices(lat, lon, count=50, max_distance=0.001) == []
+
+
+def test_complete_and_match_cities(econt):
+    index = NomenclatureIndex(cities=econt.cities())
+    assert [c['name'] for c in index.complete_cities('варн')][:1] == \
+        ['Варна']
+    assert index.complete_cities('varn') == index.complete_cities('варн')
+    assert [c['name'] for c in index.match_cities('Plovidv')][:1] == \
+        ['Пловдив']
+
+
+# loading validation
+
+@pytest.fixture(scope='module')
+def validator(server):
+    return LoadingValidator.from_client(client(server, CachedRemoteEcontXml))
+
+
+def test_validator_normalizes(server, validator):
+    office = client(server).offices()[0]
+    street = [s for s in client(server).cities_streets()
+              if s['id_city'] == '3'][0]
+    loading = {
+        'sender': {'city': 'varna', 'street': street['name_en'].upper()},
+        'receiver': {'office_code': office['office_code']},
+        'shipment': {'shipment_type': 'pack', 'tariff_sub_code': 'd_o'},
+        'payment': {'side': 'sender', 'method': 'Cash'}}
+    result = validator.validate(loading)
+    assert result, result.problems
+
+    assert result.loading['sender'] == {'city': 'Варна', 'post_code': '9000',
+                                        'street': street['name']}
+    assert result.loading['receiver']['city'] == office['city_name']
+    assert result.loading['shipment'] == {'shipment_type': 'PACK',
+                                          'tariff_sub_code': 'DOOR_OFFICE'}
+    assert result.loading['payment'] == {'side': 'SENDER', 'method': 'CASH'}
+    assert ('sender.city', 'varna', 'Варна') in result.fixes
+    # the loading itself is left intact
+    assert loading['sender']['city'] == 'varna'
+
+
+def test_validator_problems(validator):
+    loading = {'sender': {'city': 'Plovidv'},
+               'receiver': {'city': 'Sofia', 'post_code': '9000'},
+               'shipment': {'shipment_type': 'PAK',
+                            'tariff_sub_code': 'OFFICE_DOOR'}}
+    result = validator.validate(loading)
+    assert not result
+    problems = {p.field: p for p in result.problems}
+    assert problems['sender.city'].suggestions == ['Пловдив']
+    assert problems['receiver.post_code'].suggestions == ['1000']
+    assert problems['shipment.shipment_type'].suggestions[0] == 'PACK'
+    assert 'sender.office_code' in problems
+
+    with pytest.raises(InvalidLoading) as info:
+        validator.check([{'sender': {'city': 'Sofia'}}, loading])
+    assert info.value.args[0].startswith('Loading 1: ')
+
+
+# tariffs
+
+def test_tariff_calculator(server):
+    events = Events()
+    econt = client(server, observers=[events])
+    calculator = TariffCalculator.from_client(econt)
+    assert [e.request_type for e in events] == ['tariff_courier',
+                                                'tariff_post']
+    quote = calculator.quote(2.5, cd=100)
+    assert quote['total'] == quote['price'] + quote['cd'] > 0
+    numpy = pytest.importorskip('numpy')
+    assert calculator.quote(numpy.float64(2.5), cd=numpy.int64(100)) == quote
+
+    with pytest.raises(ValueError):
+        calculator.quote('abc')
+    loading = {'shipment': {'weight': 'abc'}}
+    result = calculator.verify(econt, [loading])
+    assert result['checked'] == 1
+    assert result['mismatches'][0]['local'] is None
+
+
+def test_quote_many_rounds_like_quote():
+    pytest.importorskip('numpy')
+    calculator = TariffCalculator(
+        [{'shipment_type': 'PACK', 'tariff_sub_code': 'DOOR_DOOR',
+          'weights': {'e': [{'weight_from': '0', 'weight_to': '1',
+                             'price': '1.005'},
+                            {'weight_from': '1', 'weight_to': '5',
+                             'price': '4.20'}]}}],
+        {'cd_percent': '1.5', 'cd_min': '1.00'})
+    weights = [0.5, 2, 3, 6]
+    amounts = [103, 70, 0, 10]
+    totals = calculator.quote_many(weights, cd=amounts)
+    expected = [calculator.quote(w, cd=a)['total']
+                for w, a in zip(weights[:3], amounts[:3])]
+    # 1.005 and 1.545 round up, as Decimal's ROUND_HALF_UP does
+    assert [Decimal(repr(float(t))) for t in totals[:3]] == expected == \
+        [Decimal('2.56'), Decimal('5.25'), Decimal('4.20')]
+    assert totals[3] != totals[3]
+
+
+# columns
+
+def test_to_columns(econt):
+    offices = econt.offices()
+    offices[1] = dict(offices[1], id='', city_name='')
+    columns = to_columns(offices)
+
+    assert list(columns['id'][:3]) == [1, MISSING_INT, 3]
+    assert columns['latitude'][0] == float(offices[0]['latitude'])
+    city_names = columns['city_name']
+    assert isinstance(city_names, DictionaryColumn)
+    assert city_names.decode() == [o['city_name'] or None for o in offices]
+    assert list(city_names.mask('София')) == \
+        [o['city_name'] == 'София' for o in offices]
+    assert not any(city_names.mask('Nowhere'))
+    assert columns['address_details.street'][0] == \
+        offices[0]['address_details']['street']
+
+    office = Office.from_dict(offices[0])
+    assert list(to_columns([office], ['office_code', 'city_id'])) == \
+        ['office_code', 'city_id']
+
+
+def test_tariff_columns(server):
+    service_types = client(server).tariff_courier()
+    columns = tariff_columns(service_types)
+    assert list(columns) == ['shipment_type', 'tariff_sub_code',
+                             'weight_from', 'weight_to', 'price']
+    calculator = TariffCalculator(service_types)
+    for i in range(len(columns['price'])):
+        key = (columns['shipment_type'][i], columns['tariff_sub_code'][i])
+        weight = columns['weight_to'][i]
+        assert calculator.tables[key].price(weight) == \
+            Decimal(repr(float(columns['price'][i])))
+
+
+def test_nearest_columns(econt):
+    numpy = pytest.importorskip('numpy')
+    offices = econt.offices()
+    offices[0] = dict(offices[0], latitude='', longitude='')
+    lat, lon = coordinates(offices)
+    assert numpy.isnan(lat[0]) and numpy.isnan(lon[0])
+
+    index = NomenclatureIndex(offices)
+    points = [(42.69, 23.32), (43.21, 27.91), (42.15, 24.75)]
+    km, i = nearest([p[0] for p in points], [p[1] for p in points], lat,
+                    lon, chunk_size=2)
+    for (p_lat, p_lon), d, j in zip(points, km, i):
+        (expected, office), = index.nearest_offices(p_lat, p_lon)
+        assert offices[j] is office
+        assert abs(d - expected) < 1e-6
+
+
+def test_write_columns(econt, tmpdir):
+    numpy = pytest.importorskip('numpy')
+    columns = to_columns(econt.offices())
+    path = str(tmpdir.join('offices.npz'))
+    write_npz(path, columns)
+    with numpy.load(path) as arrays:
+        names = arrays['city_name.values'][arrays['city_name']]
+        assert list(names) == columns['city_name'].decode()
+        assert list(arrays['id']) == list(columns['id'])
+
+    pytest.importorskip('pyarrow')
+    table = to_table(columns)
+    assert table.num_rows == RECORDS['offices']
+    assert table.column('city_name').to_pylist() == \
+        columns['city_name'].decode()
+
+
+# tracking
+
+class FakeShipments(object):
+
+    def __init__(self):
+        self.statuses = {}
+        self.fail = False
+
+    def shipments(self, nums, full_tracking):
+        if self.fail:
+            raise TransferError('down')
+        return [{'loading_num': num,
+                 'short_delivery_status_en': self.statuses.get(num)}
+                for num in nums]
+
+
+def test_tracker_intervals():
+    econt = FakeShipments()
+    clock = [1000.0]
+    tracker = ShipmentTracker(econt, default_interval=0, backoff=2,
+                              clock=lambda: clock[0])
+    tracker.track('1', 'Accepted')
+    econt.statuses['1'] = 'Accepted'
+
+    # an interval of 0 is raised to the minimum, so poll ends
+    assert tracker.poll() == []
+    assert tracker.next_due() == 1000 + tracker.MIN_INTERVAL * 2
+
+    # a failed request keeps the interval
+    clock[0] = tracker.next_due()
+    econt.fail = True
+    assert tracker.poll() == []
+    assert tracker.next_due() == clock[0] + tracker.MIN_INTERVAL * 2
+
+    clock[0] = tracker.next_due()
+    econt.fail = False
+    econt.statuses['1'] = 'Delivered'
+    change, = tracker.poll()
+    assert (change.old, change.new, change.final) == \
+        ('Accepted', 'Delivered', True)
+    assert tracker.requests == 3 and len(tracker) == 0
+
+
+# outbox
+
+def test_outbox_sends_once(econt):
+    outbox = ShipmentOutbox(econt, ':memory:')
+    loading = {'receiver': {'name': 'Иван', 'city': 'Варна'}}
+    key = outbox.enqueue(loading)
+    assert outbox.enqueue(loading) == key
+    assert key == idempotency_key(loading)
+    assert outbox.status(key)['state'] == 'pending'
+
+    assert outbox.drain() == 1
+    status = outbox.status(key)
+    assert status['state'] == 'done'
+    assert status['attempts'] == 1
+    assert status['result']['loading_num']
+    assert outbox.drain() == 0
+    assert outbox.counts() == {'done': 1}
+
+
+@pytest.mark.parametrize('transfer_class', [CurlTransfer, HttpTransfer])
+def test_outbox_retries_requests_not_sent(transfer_class):
+    down = RemoteEcontXml(DOWN_URL, DOWN_URL, 'user', 'pass', transfer_class)
+    outbox = ShipmentOutbox(down, ':memory:', retry_delay=0, max_attempts=2)
+    key = outbox.enqueue({'receiver': {'name': 'Иван'}})
+
+    outbox.drain_once()
+    status = outbox.status(key)
+    assert status['state'] == 'pending'
+    assert 'TransferError' in status['error']
+
+    outbox.drain_once()
+    assert outbox.status(key)['state'] == 'failed'
+    assert outbox.requeue(key)
+    assert outbox.status(key)['state'] == 'pending'
+    assert outbox.status(key)['attempts'] == 0
+
+
+def test_outbox_timeout_is_unknown(slow_server):
+    econt = client(slow_server, timeout=0.05)
+    outbox = ShipmentOutbox(econt, ':memory:')
+    key = outbox.enqueue({'receiver': {'name': 'Иван'}})
+
+    outbox.drain()
+    assert outbox.status(key)['state'] == 'unknown'
+    assert outbox.unknown() == [key]
+    assert not outbox.requeue('missing')
+
+    assert outbox.resolve(key, {'loading_num': '1'})
+    assert outbox.status(key)['state'] == 'done'
+    assert outbox.status(key)['result'] == {'loading_num': '1'}
+
+
+def test_outbox_expired_lease_is_unknown(econt):
+    now = [1000.0]
+    outbox = ShipmentOutbox(econt, ':memory:', lease_timeout=10,
+                            clock=lambda: now[0])
+    key = outbox.enqueue({'receiver': {'name': 'Иван'}})
+    outbox._claim(now[0])
+    assert outbox.status(key)['state'] == 'sending'
+
+    now[0] += 11
+    assert outbox.drain_once() == 0
+    assert outbox.status(key)['state'] == 'unknown'
+
+
+def test_outbox_workers(econt):
+    outbox = ShipmentOutbox(econt, ':memory:', batch_size=5)
+    keys = [outbox.enqueue({'receiver': {'name': 'n{}'.format(i)}})
+            for i in range(12)]
+    outbox.start(workers=2, poll_interval=0.05)
+    try:
+        for key in keys:
+            assert outbox.wait(key, timeout=10)['state'] == 'done'
+    finally:
+        outbox.close()
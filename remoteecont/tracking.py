@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Batched, adaptive polling of the status of many shipments.
+
+`ShipmentTracker` keeps every tracked waybill on a schedule, asks for
+all waybills that are due in `shipments` requests of up to
+`batch_size` numbers and reports only the shipments whose status
+changed::
+
+    tracker = ShipmentTracker(econt, on_change=notify)
+    for num in open_waybills:
+        tracker.track(num)
+    tracker.run(stop)      # or call tracker.poll() from a scheduler
+
+A waybill is polled again after the interval of its status; while the
+status does not change, the interval grows by `backoff` up to
+`max_interval`.  Waybills reaching a final status are dropped.  The
+upstream request volume thus follows the volume of changes rather than
+the number of open shipments.
+
+"""
+
+from __future__ import unicode_literals
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+__all__ = [
+    'ShipmentTracker',
+    'StatusChange'
+]
+
+_log = logging.getLogger(__name__)
+
+
+class StatusChange(object):
+    """The status of shipment `num` changed from `old` to `new`."""
+
+    def __init__(self, num, old, new, shipment):
+        self.num = num
+        self.old = old
+        self.new = new
+        self.shipment = shipment
+        self.final = False
+
+    def __repr__(self):
+        return 'StatusChange({!r}, {!r}, {!r})'.format(self.num, self.old,
+                                                       self.new)
+
+
+def _status(shipment):
+    return shipment.get('short_delivery_status_en') or \
+        shipment.get('short_delivery_status') or None
+
+
+class ShipmentTracker(object):
+    """
+    Poll the status of tracked shipments in batches.
+
+    `intervals` maps statuses to the seconds until the next poll of a
+    shipment in that status, `default_interval` applies to the others.
+    Shipments in one of the `final` statuses (compared case
+    insensitively) are polled no more.  `status` extracts the status
+    from a shipment record.
+
+    `on_change` is called with every `StatusChange`, including the
+    first status seen of a shipment tracked without one.
+
+    Intervals shorter than `MIN_INTERVAL` seconds are raised to it, so
+    that `poll` always ends.
+
+    """
+
+    DEFAULT_FINAL = ('delivered', 'returned', 'refused', 'destroyed')
+
+    MIN_INTERVAL = 1.0
+
+    def __init__(self, econt, batch_size=100, intervals=None,
+                 default_interval=900, max_interval=6 * 3600, backoff=1.5,
+                 final=DEFAULT_FINAL, status=_status, on_change=None,
+                 full_tracking='OFF', clock=time.time):
+        self.econt = econt
+        self.batch_size = batch_size
+        self.intervals = dict(intervals or {})
+        self.default_interval = default_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.final = {f.lower() for f in final}
+        self.status = status
+        self.on_change = on_change
+        self.full_tracking = full_tracking
+        self.clock = clock
+
+        self.requests = 0
+        self.changes = 0
+
+        # num -> [status, interval, due]; the heap holds (due, seq, num)
+        # and entries whose due time is not the current one are stale
+        self._tracked = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tracked)
+
+    def __contains__(self, num):
+        return '{}'.format(num) in self._tracked
+
+    def _interval(self, status):
+        return max(self.MIN_INTERVAL,
+                   self.intervals.get(status, self.default_interval))
+
+    def _schedule(self, num, entry, due):
+        entry[2] = due
+        heapq.heappush(self._heap, (due, next(self._seq), num))
+
+    def track(self, num, status=None, due=None):
+        """
+        Start tracking shipment `num`, whose last known status is
+        `status`, polling it first at `due` (now by default).
+
+        """
+        num = '{}'.format(num)
+        with self._lock:
+            entry = [status, self._interval(status), None]
+            self._tracked[num] = entry
+            self._schedule(num, entry, self.clock() if due is None else due)
+
+    def untrack(self, num):
+        with self._lock:
+            self._tracked.pop('{}'.format(num), None)
+
+    def next_due(self):
+        """Time of the next scheduled poll, or None if nothing is tracked."""
+        with self._lock:
+            while self._heap:
+                due, _, num = self._heap[0]
+                entry = self._tracked.get(num)
+                if entry is not None and entry[2] == due:
+                    return due
+                heapq.heappop(self._heap)
+        return None
+
+    def _take_due(self, now):
+        """Pop up to `batch_size` shipments that are due at `now`."""
+        nums = []
+        with self._lock:
+            while self._heap and len(nums) < self.batch_size:
+                due, _, num = self._heap[0]
+                if due > now:
+                    break
+                heapq.heappop(self._heap)
+                entry = self._tracked.get(num)
+                if entry is not None and entry[2] == due:
+                    entry[2] = None
+                    nums.append(num)
+        return nums
+
+    def poll(self):
+        """
+        Send one request per batch of shipments that are due and return
+        the list of `StatusChange`.  Shipments of a failed request are
+        retried after their current interval.
+
+        """
+        changes = []
+        now = self.clock()
+        while True:
+            nums = self._take_due(now)
+            if not nums:
+                return changes
+            self.requests += 1
+            try:
+                shipments = self.econt.shipments(nums, self.full_tracking)
+            except Exception:
+                _log.exception('Failed to poll %d shipments', len(nums))
+                changes.extend(self._update(nums, [], now, failed=True))
+            else:
+                changes.extend(self._update(nums, shipments, now))
+
+    def _update(self, nums, shipments, now, failed=False):
+        by_num = {}
+        for shipment in shipments:
+            if hasattr(shipment, 'get') and shipment.get('loading_num'):
+                by_num['{}'.format(shipment['loading_num'])] = shipment
+
+        changes = []
+        with self._lock:
+            for num in nums:
+                entry = self._tracked.get(num)
+                if entry is None:
+                    # untracked while the request was running
+                    continue
+
+                if failed:
+                    # nothing was learnt about the shipment
+                    self._schedule(num, entry, now + entry[1])
+                    continue
+
+                shipment = by_num.get(num)
+                status = self.status(shipment) if shipment else None
+                if status is None or status == entry[0]:
+                    entry[1] = max(self.MIN_INTERVAL, min(
+                        self.max_interval, entry[1] * self.backoff))
+                    self._schedule(num, entry, now + entry[1])
+                    continue
+
+                change = StatusChange(num, entry[0], status, shipment)
+                changes.append(change)
+                if status.lower() in self.final:
+                    change.final = True
+                    del self._tracked[num]
+                else:
+                    entry[0] = status
+                    entry[1] = self._interval(status)
+                    self._schedule(num, entry, now + entry[1])
+
+        self.changes += len(changes)
+        if self.on_change is not None:
+            for change in changes:
+                try:
+                    self.on_change(change)
+                except Exception:
+                    _log.exception('Status change handler failed')
+        return changes
+
+    def run(self, stop=None, idle=1.0):
+        """
+        Poll until the `threading.Event` `stop` is set, sleeping until
+        the next shipment is due, but at most `idle` seconds.
+
+        """
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            self.poll()
+            due = self.next_due()
+            wait = idle if due is None else due - self.clock()
+            if wait > 0:
+                stop.wait(min(wait, idle))
@@ -2,20 +2,70 @@
 
 from __future__ import unicode_literals
 
-import pycurl
+from collections import deque
+import binascii
+import math
+import os
+import threading
+import time
+import zlib
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
+from remoteecont.exceptions import TransferError, TransferTimeout
+from remoteecont.xmlutils import text_type
+
+# pycurl and http.client (with socket) are imported by the first pool
+# or transfer that needs them, so that importing the library does not
+# load them
+pycurl = None
+httplib = None
+socket = None
+urlsplit = None
+
+# curl error codes, also given to the errors of `HttpTransfer` so that
+# both transfers report a failure the same way
+_CURLE_COULDNT_RESOLVE_HOST = 6
+_CURLE_COULDNT_CONNECT = 7
+_CURLE_OPERATION_TIMEDOUT = 28
+
+
+def _import_pycurl():
+    global pycurl
+    if pycurl is None:
+        import pycurl
+    return pycurl
+
+
+def _import_httplib():
+    global httplib, socket, urlsplit
+    if httplib is None:
+        import socket
+        try:
+            import http.client as httplib
+            from urllib.parse import urlsplit
+        except ImportError:
+            import httplib
+            from urlparse import urlsplit
+    return httplib
 
 
 class Transfer(object):
     """
     Basic interface for transferring and exchanging data with a remote
     service.
+
+    After a request, `info` is a dictionary of details about the
+    transfer (timings, sizes) that the implementation can report.
+
+    `options` names the keyword arguments of the constructor that
+    `RemoteEcontXml` may pass: `connect_timeout`, `timeout` and
+    `accept_encoding`.  A transfer that lists none of them is created
+    without arguments, or with just the `pool` of `create_pool`.
     """
 
+    info = None
+
+    options = ()
+
     def append_file(self, name, filepath, content_type, filename):
         raise NotImplementedError()
 
@@ -23,33 +73,214 @@ class Transfer(object):
         raise NotImplementedError()
 
     def append_str_as_file(self, name, content, content_type=None, filename=None):
+        """Attach `content`, text or already encoded bytes, as a file."""
         raise NotImplementedError()
 
     def perform(self, url):
+        """
+        Perform a request and return the response body as bytes.  Raise
+        `TransferError` (or `TransferTimeout`) if it fails.
+
+        """
+        raise NotImplementedError
+
+    def perform_chunks(self, url):
+        """
+        Like `perform`, but return the response body as the list of
+        chunks it was received in, which the XML parser takes without
+        joining them.  By default the result of `perform` is the only
+        chunk.
+
+        """
+        return [self.perform(url)]
+
+    def stream(self, url):
+        """
+        Perform a request and return an iterator over the chunks of
+        the response body, yielding them as they arrive.
+
+        """
         raise NotImplementedError
 
     def close(self):
         raise NotImplementedError
 
+    @classmethod
+    def create_pool(cls, size, idle_timeout):
+        """
+        Create a pool of reusable connections suitable for passing to
+        the constructor of this transfer class.  Transfers that do not
+        support pooling return None.
+
+        """
+        return None
+
+
+class CurlPool(object):
+    """
+    Bounded, thread-safe pool of reusable `pycurl.Curl` handles.
+
+    A curl handle keeps its connection cache between requests, so
+    reusing handles avoids the DNS, TCP and TLS setup of a fresh
+    handle.  All handles of the pool additionally share their DNS and
+    SSL session caches through a `pycurl.CurlShare` object.
+
+    At most `size` handles are in use at the same time; `acquire`
+    blocks until a handle is released.  Handles that stayed idle for
+    more than `idle_timeout` seconds are closed instead of reused.
+
+    """
+
+    def __init__(self, size=4, idle_timeout=60):
+        if size < 1:
+            raise ValueError('Pool size should be positive: {}'.format(size))
+
+        _import_pycurl()
+        self.size = size
+        self.idle_timeout = idle_timeout
+
+        self._closed = False
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+        self._share = pycurl.CurlShare()
+        self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+
+    def _new_curl(self):
+        curl = pycurl.Curl()
+        curl.setopt(pycurl.SHARE, self._share)
+        curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+        return curl
+
+    def acquire(self):
+        """Borrow a curl handle, creating a new one if none is idle."""
+        self._slots.acquire()
+        try:
+            now = time.time()
+            with self._lock:
+                if self._closed:
+                    raise ValueError('Cannot acquire from a closed pool')
+                while self._idle:
+                    curl, released = self._idle.pop()
+                    if now - released <= self.idle_timeout:
+                        return curl
+                    curl.close()
+            return self._new_curl()
+        except:
+            self._slots.release()
+            raise
+
+    def release(self, curl):
+        """Return a handle obtained by `acquire` back to the pool."""
+        # reset() keeps the live connections and the share, but not
+        # the rest of the options
+        curl.reset()
+        curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+        with self._lock:
+            if self._closed:
+                curl.close()
+            else:
+                self._idle.append((curl, time.time()))
+        self._slots.release()
+
+    def close(self):
+        """Close all idle handles.  Handles in use are closed on release."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for curl, _ in idle:
+            curl.close()
+
 
 class CurlTransfer(Transfer):
 
-    def __init__(self):
-        self._curl = pycurl.Curl()
+    options = ('connect_timeout', 'timeout', 'accept_encoding')
+
+    # names of the `info` entries and their pycurl constants
+    _INFO = {
+        'namelookup_time': 'NAMELOOKUP_TIME',
+        'connect_time': 'CONNECT_TIME',
+        'appconnect_time': 'APPCONNECT_TIME',
+        'pretransfer_time': 'PRETRANSFER_TIME',
+        'starttransfer_time': 'STARTTRANSFER_TIME',
+        'total_time': 'TOTAL_TIME',
+        'size_upload': 'SIZE_UPLOAD',
+        'size_download': 'SIZE_DOWNLOAD',
+    }
+
+    def __init__(self, pool=None, connect_timeout=None, timeout=None,
+                 accept_encoding=None):
+        """
+        `connect_timeout` and `timeout` (for the whole request) are in
+        seconds; None leaves the curl defaults.  A `stream` may last
+        as long as its consumer takes, so for streams `timeout` limits
+        only the time without any data received.
+
+        `accept_encoding` (e.g. 'gzip, deflate') is advertised to the
+        server; compressed responses are decoded by curl as they
+        arrive, so `perform` and `stream` always return decoded data,
+        while `info['size_download']` is the size received.
+
+        """
+        _import_pycurl()
+        self._pool = pool
+        self._curl = pool.acquire() if pool is not None else pycurl.Curl()
         self._data = []
+        self._connect_timeout = connect_timeout
+        self._timeout = timeout
+        self._accept_encoding = accept_encoding
+
+    @classmethod
+    def create_pool(cls, size, idle_timeout):
+        return CurlPool(size, idle_timeout)
+
+    def _setup(self, url, write, stream=False):
+        # self._curl.setopt(pycurl.HTTPHEADER, ['Expect:'])
+        # self._curl.setopt(pycurl.VERBOSE, 1)
+
+        self._curl.setopt(pycurl.URL, url)
+        self._curl.setopt(pycurl.HTTPPOST, self._data)
+        self._curl.setopt(pycurl.WRITEFUNCTION, write)
+        if self._connect_timeout is not None:
+            self._curl.setopt(pycurl.CONNECTTIMEOUT_MS,
+                              int(self._connect_timeout * 1000))
+        if self._timeout is not None and stream:
+            # fail when no data arrives for `timeout` seconds (curl
+            # counts whole seconds)
+            self._curl.setopt(pycurl.LOW_SPEED_LIMIT, 1)
+            self._curl.setopt(pycurl.LOW_SPEED_TIME,
+                              max(1, int(math.ceil(self._timeout))))
+        elif self._timeout is not None:
+            self._curl.setopt(pycurl.TIMEOUT_MS, int(self._timeout * 1000))
+        if self._accept_encoding is not None:
+            self._curl.setopt(pycurl.ENCODING, self._accept_encoding)
+
+    def _error(self, errno, message):
+        if errno == pycurl.E_OPERATION_TIMEDOUT:
+            return TransferTimeout(message, errno)
+        return TransferError(message, errno)
+
+    def _check_status(self):
+        status = self._curl.getinfo(pycurl.RESPONSE_CODE)
+        if status >= 400:
+            raise TransferError('HTTP status {}'.format(status), status)
+
+    def _collect_info(self):
+        self.info = {name: self._curl.getinfo(getattr(pycurl, option))
+                     for name, option in self._INFO.items()}
 
-    # Suppress `used built-in function 'map'`
-    # pylint: disable=W0141
     def _prepare_data(self, data):
         """
         Simple method that converts all unicode strings in a nested
         sequence structure to byte strings.
         """
         if isinstance(data, list):
-            return map(self._prepare_data, data)
+            return [self._prepare_data(e) for e in data]
         elif isinstance(data, tuple):
-            return tuple(map(self._prepare_data, data))
-        elif isinstance(data, unicode):
+            return tuple(self._prepare_data(e) for e in data)
+        elif isinstance(data, text_type):
             return data.encode('utf-8')
         else:
             return data
@@ -57,8 +288,12 @@ class CurlTransfer(Transfer):
     def append_file(self, name, filepath, content_type, filename):
         raise NotImplementedError()
 
+    # the form data is encoded as it is appended, so that it is ready
+    # for curl by the time of the request
+
     def append_data(self, name, value):
-        self._data.append((name, (pycurl.FORM_CONTENTS, value)))
+        self._data.append(self._prepare_data(
+            (name, (pycurl.FORM_CONTENTS, value))))
 
     def append_str_as_file(self, name, content,
                            content_type='text/plain; charset=UTF-8',
@@ -70,26 +305,428 @@ class CurlTransfer(Transfer):
              (pycurl.FORM_CONTENTS, content,
               pycurl.FORM_CONTENTTYPE, content_type))
 
-        self._data.append(t)
+        self._data.append(self._prepare_data(t))
 
     def perform(self, url):
         """
         Perform a request.  Argument `url` should be a byte string.
         """
-        out = StringIO()
+        out = self.perform_chunks(url)
+        # most responses arrive in a single chunk, which is returned
+        # as it is
+        return out[0] if len(out) == 1 else b''.join(out)
 
-        # self._curl.setopt(pycurl.HTTPHEADER, ['Expect:'])
-        # self._curl.setopt(pycurl.VERBOSE, 1)
-
-        self._curl.setopt(pycurl.URL, url)
-        self._curl.setopt(pycurl.HTTPPOST, self._prepare_data(self._data))
-        self._curl.setopt(pycurl.WRITEFUNCTION, out.write)
+    def perform_chunks(self, url):
+        out = []
+        self._setup(url, out.append)
 
         try:
             self._curl.perform()
-            return out.getvalue()
-        except pycurl.error:
-            return ''
+        except pycurl.error as e:
+            raise self._error(*e.args)
+        finally:
+            self._collect_info()
+
+        self._check_status()
+        return out
+
+    def stream(self, url):
+        """
+        Perform a request and yield the response body chunk by chunk,
+        as curl receives it.  Argument `url` should be a byte string.
+
+        The transfer is driven by a `pycurl.CurlMulti`, so the first
+        chunks are available before the download has finished.  If
+        the transfer fails, `TransferError` is raised from the
+        iteration.
+
+        """
+        chunks = deque()
+        self._setup(url, chunks.append, stream=True)
+
+        multi = pycurl.CurlMulti()
+        multi.add_handle(self._curl)
+        try:
+            checked = False
+            active = 1
+            while active:
+                ret, active = multi.perform()
+                if ret == pycurl.E_CALL_MULTI_PERFORM:
+                    continue
+                if chunks and not checked:
+                    self._check_status()
+                    checked = True
+                while chunks:
+                    yield chunks.popleft()
+                if active:
+                    multi.select(1.0)
+
+            _, _, failed = multi.info_read()
+            self._collect_info()
+            if failed:
+                _, errno, message = failed[0]
+                raise self._error(errno, message)
+            self._check_status()
+            while chunks:
+                yield chunks.popleft()
+        finally:
+            multi.remove_handle(self._curl)
+            multi.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.release(self._curl)
+        else:
+            self._curl.close()
+
+
+class HttpPool(object):
+    """
+    Bounded, thread-safe pool of persistent `http.client` connections.
+
+    Idle connections are kept per scheme, host and port, so a request
+    to a host already talked to skips the TCP and TLS setup.  At most
+    `size` connections are in use at the same time; `acquire` blocks
+    until one is released.  Connections that stayed idle for more than
+    `idle_timeout` seconds are closed instead of reused.
+
+    """
+
+    def __init__(self, size=4, idle_timeout=60):
+        if size < 1:
+            raise ValueError('Pool size should be positive: {}'.format(size))
+
+        _import_httplib()
+        self.size = size
+        self.idle_timeout = idle_timeout
+
+        self._closed = False
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self, origin):
+        """
+        Borrow an idle connection to `origin`, a (scheme, host, port)
+        tuple.  Return None, still taking a slot, if there is none; the
+        caller then connects itself and hands the connection to
+        `release`.
+
+        """
+        self._slots.acquire()
+        now = time.time()
+        with self._lock:
+            if self._closed:
+                self._slots.release()
+                raise ValueError('Cannot acquire from a closed pool')
+            idle = self._idle.get(origin)
+            while idle:
+                conn, released = idle.pop()
+                if now - released <= self.idle_timeout:
+                    return conn
+                conn.close()
+        return None
+
+    def release(self, origin, conn):
+        """
+        Give back the slot taken by `acquire`, keeping `conn` for reuse
+        unless it is None.
+
+        """
+        if conn is not None:
+            with self._lock:
+                if self._closed:
+                    conn.close()
+                else:
+                    self._idle.setdefault(origin, []).append(
+                        (conn, time.time()))
+        self._slots.release()
+
+    def close(self):
+        """Close all idle connections.  Those in use are closed on release."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+
+class _DeflateDecoder(object):
+    """
+    Decoder of `deflate` responses, which some servers send as raw
+    deflate data instead of the zlib format: the data is decoded as
+    zlib and, if its header does not check, again as raw deflate.
+
+    """
+
+    def __init__(self):
+        self._decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        # the data received until the header has been checked
+        self._head = b''
+
+    def decompress(self, data):
+        if self._head is None:
+            return self._decoder.decompress(data)
+
+        self._head += data
+        try:
+            out = self._decoder.decompress(data)
+        except zlib.error:
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            data, self._head = self._head, None
+            return self._decoder.decompress(data)
+        if len(self._head) >= 2:
+            self._head = None
+        return out
+
+    def flush(self):
+        return self._decoder.flush()
+
+
+class HttpTransfer(Transfer):
+    """
+    Transfer on the standard library `http.client`, for installations
+    without pycurl.
+
+    Requests are sent as `multipart/form-data` over a persistent
+    connection; with a `pool` (see `create_pool`) the connection is
+    kept for later transfers to the same host.  A request on a reused
+    connection that the server has meanwhile closed is sent once more
+    on a new connection.
+
+    """
+
+    _CHUNK_SIZE = 64 * 1024
+
+    options = ('connect_timeout', 'timeout', 'accept_encoding')
+
+    def __init__(self, pool=None, connect_timeout=None, timeout=None,
+                 accept_encoding=None):
+        """
+        `connect_timeout` is in seconds; `timeout` applies to every
+        read or write on the socket and is also checked between the
+        chunks of the response, so a slowly trickling response fails
+        soon after it expires.  A `stream` may last as long as its
+        consumer takes, so only the reads are limited.  None waits
+        indefinitely.
+
+        `accept_encoding` (e.g. 'gzip, deflate') is advertised to the
+        server; gzip and deflate responses are decoded as they arrive,
+        while `info['size_download']` is the size received.
+
+        """
+        _import_httplib()
+        self._pool = pool
+        self._parts = []
+        self._connect_timeout = connect_timeout
+        self._timeout = timeout
+        self._accept_encoding = accept_encoding
+
+        self._origin = None
+        self._conn = None
+        self._slot = False
+
+    @classmethod
+    def create_pool(cls, size, idle_timeout):
+        return HttpPool(size, idle_timeout)
+
+    def append_file(self, name, filepath, content_type, filename):
+        raise NotImplementedError()
+
+    @staticmethod
+    def _encode(value):
+        return value.encode('utf-8') if isinstance(value, text_type) \
+            else value
+
+    def append_data(self, name, value):
+        header = 'Content-Disposition: form-data; name="{}"'.format(name)
+        self._parts.append((header.encode('utf-8'), self._encode(value)))
+
+    def append_str_as_file(self, name, content,
+                           content_type='text/plain; charset=UTF-8',
+                           filename=None):
+        if filename is None:
+            filename = '%s.txt' % name
+
+        header = ('Content-Disposition: form-data; name="{}"; '
+                  'filename="{}"\r\nContent-Type: {}').format(
+                      name, filename, content_type)
+        self._parts.append((header.encode('utf-8'), self._encode(content)))
+
+    def _body(self):
+        boundary = binascii.hexlify(os.urandom(16))
+        body = []
+        for header, content in self._parts:
+            body.extend((b'--', boundary, b'\r\n', header, b'\r\n\r\n',
+                         content, b'\r\n'))
+        body.extend((b'--', boundary, b'--\r\n'))
+        content_type = 'multipart/form-data; boundary=' + \
+            boundary.decode('ascii')
+        return b''.join(body), content_type
+
+    def _connect(self):
+        scheme, host, port = self._origin
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port,
+                                           timeout=self._connect_timeout)
+        elif scheme == 'http':
+            conn = httplib.HTTPConnection(host, port,
+                                          timeout=self._connect_timeout)
+        else:
+            raise TransferError('Unsupported URL scheme: {}'.format(scheme))
+        conn.connect()
+        conn.sock.settimeout(self._timeout)
+        return conn
+
+    def _open(self):
+        """`_connect`, with the curl codes of requests never sent."""
+        try:
+            return self._connect()
+        except socket.timeout as e:
+            self._release(False)
+            raise TransferTimeout('Connection timed out: {}'.format(e),
+                                  _CURLE_OPERATION_TIMEDOUT)
+        except socket.gaierror as e:
+            self._release(False)
+            raise TransferError('{}: {}'.format(type(e).__name__, e),
+                                _CURLE_COULDNT_RESOLVE_HOST)
+        except (httplib.HTTPException, socket.error) as e:
+            self._release(False)
+            raise TransferError('{}: {}'.format(type(e).__name__, e),
+                                _CURLE_COULDNT_CONNECT)
+
+    def _release(self, reuse):
+        conn, self._conn = self._conn, None
+        if conn is not None and not reuse:
+            conn.close()
+            conn = None
+        if self._slot:
+            self._slot = False
+            self._pool.release(self._origin, conn)
+        elif conn is not None:
+            conn.close()
+
+    def _request(self, url):
+        """Send the request and return the response, with its headers read."""
+        if isinstance(url, bytes):
+            url = url.decode('utf-8')
+        parts = urlsplit(url)
+        self._origin = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        body, content_type = self._body()
+        headers = {'Content-Type': content_type}
+        if self._accept_encoding is not None:
+            headers['Accept-Encoding'] = self._accept_encoding
+
+        self.info = {'size_upload': len(body), 'size_download': 0}
+        self._started = time.time()
+
+        if self._pool is not None:
+            self._conn = self._pool.acquire(self._origin)
+            self._slot = True
+        while True:
+            reused = self._conn is not None
+            if not reused:
+                self._conn = self._open()
+            try:
+                self._conn.request('POST', path, body, headers)
+                response = self._conn.getresponse()
+                break
+            except socket.timeout as e:
+                self._release(False)
+                raise TransferTimeout('Request timed out: {}'.format(e))
+            except (httplib.HTTPException, socket.error) as e:
+                # a pooled connection may have been closed by the server
+                # since its last request
+                if not reused:
+                    self._release(False)
+                    raise TransferError('{}: {}'.format(type(e).__name__, e))
+                self._conn.close()
+                self._conn = None
+
+        self.info['starttransfer_time'] = time.time() - self._started
+        if response.status >= 400:
+            response.read()
+            self._release(not response.will_close)
+            raise TransferError('HTTP status {}'.format(response.status),
+                                response.status)
+        return response
+
+    def _decoder(self, response):
+        encoding = (response.getheader('Content-Encoding') or '').lower()
+        if encoding in ('gzip', 'x-gzip'):
+            # detects both the gzip and the zlib header
+            return zlib.decompressobj(32 + zlib.MAX_WBITS)
+        if encoding == 'deflate':
+            return _DeflateDecoder()
+        return None
+
+    def _read(self, response, stream=False):
+        """Yield the decoded chunks of the response body."""
+        decoder = self._decoder(response)
+        read = getattr(response, 'read1', response.read)
+        deadline = None
+        if self._timeout is not None and not stream:
+            deadline = self._started + self._timeout
+
+        complete = False
+        try:
+            while True:
+                try:
+                    chunk = read(self._CHUNK_SIZE)
+                except socket.timeout as e:
+                    raise TransferTimeout('Request timed out: {}'.format(e))
+                except (httplib.HTTPException, socket.error) as e:
+                    raise TransferError('{}: {}'.format(type(e).__name__, e))
+                if not chunk:
+                    break
+                self.info['size_download'] += len(chunk)
+                if decoder is not None:
+                    try:
+                        chunk = decoder.decompress(chunk)
+                    except zlib.error as e:
+                        raise TransferError('Invalid compressed response: '
+                                            '{}'.format(e))
+                if chunk:
+                    yield chunk
+                if deadline is not None and time.time() > deadline:
+                    raise TransferTimeout('Request timed out after {} '
+                                          'seconds'.format(self._timeout))
+            if decoder is not None:
+                chunk = decoder.flush()
+                if chunk:
+                    yield chunk
+            complete = True
+        finally:
+            self.info['total_time'] = time.time() - self._started
+            # read1 does not mark a response of known length as closed,
+            # which the connection requires before its next request
+            response.close()
+            self._release(complete and not response.will_close)
+
+    def perform(self, url):
+        """
+        Perform a request.  Argument `url` may be a byte string.
+        """
+        out = self.perform_chunks(url)
+        return out[0] if len(out) == 1 else b''.join(out)
+
+    def perform_chunks(self, url):
+        return list(self._read(self._request(url)))
+
+    def stream(self, url):
+        """
+        Perform a request and yield the response body chunk by chunk,
+        decoded, as it is received.  If the transfer fails,
+        `TransferError` is raised from the iteration.
+
+        """
+        for chunk in self._read(self._request(url), stream=True):
+            yield chunk
 
     def close(self):
-        self._curl.close()
+        self._release(False)
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Local validation of `shipping` loadings against the nomenclatures.
+
+The addresses of the sender and the receiver are checked against the
+cities, quarters, streets and offices, and the enumerated fields
+against the values the service accepts, before the loadings are sent::
+
+    validator = LoadingValidator.from_client(econt)
+    result = validator.validate(loading)
+    if not result:
+        print(result.problems)     # with suggestions
+    econt.shipping([result.loading], system)
+
+    # or raise InvalidLoading for the first bad loading
+    econt.shipping(validator.check(loadings), system)
+
+Names are matched in Cyrillic or Latin regardless of case and
+punctuation, with fuzzy suggestions for unknown ones.  Matched values
+are replaced by their canonical spelling in `result.loading`.
+
+"""
+
+from __future__ import unicode_literals
+
+import difflib
+
+from remoteecont.exceptions import InvalidLoading
+from remoteecont.index import NomenclatureIndex, normalize
+from remoteecont.xmlutils import string_types, text_type
+
+__all__ = [
+    'LoadingValidator',
+    'Problem',
+    'ValidationResult'
+]
+
+SHIPMENT_TYPES = ('PACK', 'DOCUMENT', 'PALLET', 'CARGO', 'DOCUMENTPALLET')
+
+TARIFF_SUB_CODES = ('DOOR_DOOR', 'DOOR_OFFICE', 'OFFICE_DOOR', 'OFFICE_OFFICE')
+
+PAYMENT_SIDES = ('SENDER', 'RECEIVER', 'OTHER')
+
+PAYMENT_METHODS = ('CASH', 'CREDIT', 'BONUS', 'VOUCHER')
+
+# short forms of the tariff sub codes
+_TARIFF_ALIASES = {
+    'D_D': 'DOOR_DOOR',
+    'D_O': 'DOOR_OFFICE',
+    'O_D': 'OFFICE_DOOR',
+    'O_O': 'OFFICE_OFFICE',
+}
+
+_ENUMS = (
+    ('shipment', 'shipment_type', SHIPMENT_TYPES),
+    ('shipment', 'tariff_sub_code', TARIFF_SUB_CODES),
+    ('payment', 'side', PAYMENT_SIDES),
+    ('payment', 'method', PAYMENT_METHODS),
+)
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if not isinstance(value, string_types):
+        value = text_type(value)
+    return value.strip()
+
+
+class Problem(object):
+    """
+    Field `field` (e.g. 'receiver.city') of a loading is wrong;
+    `suggestions` are values that would probably be right.
+
+    """
+
+    def __init__(self, field, message, value=None, suggestions=()):
+        self.field = field
+        self.message = message
+        self.value = value
+        self.suggestions = list(suggestions)
+
+    def __repr__(self):
+        return 'Problem({!r}, {!r}, {!r}, {!r})'.format(
+            self.field, self.message, self.value, self.suggestions)
+
+    def __str__(self):
+        text = '{}: {}'.format(self.field, self.message)
+        if self.suggestions:
+            text += ' (did you mean {}?)'.format(
+                ', '.join(self.suggestions))
+        return text
+
+
+class ValidationResult(object):
+    """
+    `loading` is a copy of the validated loading with the normalized
+    values, `problems` the list of `Problem` and `fixes` the list of
+    `(field, old, new)` normalizations made.  The result is true if
+    there are no problems.
+
+    """
+
+    def __init__(self, loading, problems, fixes):
+        self.loading = loading
+        self.problems = problems
+        self.fixes = fixes
+
+    def __bool__(self):
+        return not self.problems
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return 'ValidationResult(problems={!r}, fixes={!r})'.format(
+            self.problems, self.fixes)
+
+
+class _Check(object):
+    """State of the validation of one loading."""
+
+    def __init__(self, loading, fix):
+        self.loading = dict(loading)
+        self.fix = fix
+        self.problems = []
+        self.fixes = []
+
+    def part(self, name):
+        part = self.loading.get(name)
+        if not hasattr(part, 'get'):
+            return {}
+        if self.fix:
+            part = self.loading[name] = dict(part)
+        return part
+
+    def problem(self, part, field, message, value=None, suggestions=()):
+        self.problems.append(Problem('{}.{}'.format(part, field), message,
+                                     value, suggestions))
+
+    def set(self, part_name, part, field, value):
+        old = part.get(field)
+        if self.fix and _text(old) != value:
+            part[field] = value
+            self.fixes.append(('{}.{}'.format(part_name, field), old, value))
+
+
+class LoadingValidator(object):
+    """
+    Validate `shipping` loadings against a `NomenclatureIndex` of the
+    offices, cities, streets and quarters.
+
+    For the sender and the receiver:
+
+    * `office_code` must be a known office, in the given city;
+    * `city` must be a known city, or is looked up by `post_code`;
+    * `post_code` must be the post code of the city, and is required
+      if several cities have the name;
+    * `quarter` and `street`, if given, must be known in the city,
+      provided that the city's quarters or streets are in the index.
+
+    `shipment_type`, `tariff_sub_code`, and the payment `side` and
+    `method` must be among the values of the `shipping` defaults,
+    regardless of case, and an OFFICE tariff sub code needs the office
+    code of its side.  Empty fields are left to the service.
+
+    With `fix`, matched values are replaced by their canonical form:
+    the city name, its post code, the street name, the upper case enum
+    value.  Unknown values get up to `suggestions` fuzzy matches with a
+    `difflib` similarity ratio of at least `cutoff`.
+
+    """
+
+    def __init__(self, index, fix=True, suggestions=3, cutoff=0.75):
+        self.index = index
+        self.fix = fix
+        self.suggestions = suggestions
+        self.cutoff = cutoff
+
+    @classmethod
+    def from_client(cls, econt, **kwargs):
+        """
+        Build the index from the nomenclatures of `econt`, a
+        `RemoteEcontXml` (preferably cached) or a `NomenclatureStore`.
+
+        """
+        quarters = getattr(econt, 'cities_quarters', None)
+        index = NomenclatureIndex(econt.offices(), econt.cities(),
+                                  econt.cities_streets(),
+                                  quarters=quarters() if quarters else ())
+        return cls(index, **kwargs)
+
+    def validate(self, loading):
+        """Validate one loading and return a `ValidationResult`."""
+        check = _Check(loading, self.fix)
+        for name in ('sender', 'receiver'):
+            self._party(check, name)
+        self._enums(check)
+        return ValidationResult(check.loading, check.problems, check.fixes)
+
+    def validate_many(self, loadings):
+        return [self.validate(loading) for loading in loadings]
+
+    def check(self, loadings):
+        """
+        Validate `loadings` (one or a list) and return the normalized
+        ones; raise `InvalidLoading` for the first loading with
+        problems.
+
+        """
+        single = hasattr(loadings, 'get')
+        result = []
+        for i, loading in enumerate([loadings] if single else loadings):
+            validated = self.validate(loading)
+            if not validated:
+                raise InvalidLoading(
+                    'Loading {}: {}'.format(
+                        i, '; '.join(text_type(p) for p in validated.problems)),
+                    validated.problems)
+            result.append(validated.loading)
+        return result[0] if single else result
+
+    # addresses
+
+    def _names(self, records, field='name'):
+        names = []
+        for record in records:
+            name = record.get(field)
+            if name and name not in names:
+                names.append(name)
+        return names
+
+    def _party(self, check, name):
+        part = check.part(name)
+        if not part:
+            return
+
+        office = self._office(check, name, part)
+        city = self._city(check, name, part, office)
+        if city is None:
+            return
+
+        city_id = city.get('id')
+        for field, find, match, in_city in (
+                ('quarter', self.index.find_quarter,
+                 self.index.match_quarters, self.index.quarters_in_city),
+                ('street', self.index.find_street,
+                 self.index.match_streets, self.index.streets_in_city)):
+            value = _text(part.get(field))
+            if not value or not in_city(city_id):
+                continue
+            found = find(value, city_id)
+            if found:
+                check.set(name, part, field, found[0].get('name'))
+                continue
+            check.problem(name, field, 'Unknown {} in {}'.format(
+                field, city.get('name')), value, self._names(
+                    match(value, city_id, self.suggestions, self.cutoff)))
+
+    def _office(self, check, name, part):
+        code = _text(part.get('office_code'))
+        if not code:
+            return None
+        office = self.index.office(code)
+        if office is None:
+            check.problem(name, 'office_code', 'Unknown office', code)
+        return office
+
+    def _city(self, check, name, part, office):
+        """Check the city and post code; return the city or None."""
+        city_name = _text(part.get('city'))
+        post_code = _text(part.get('post_code'))
+
+        if office is not None:
+            office_cities = {normalize(office.get('city_name')),
+                             normalize(office.get('city_name_en'))}
+            if city_name and normalize(city_name) not in office_cities:
+                check.problem(name, 'office_code',
+                              'Office is not in {}'.format(city_name),
+                              part.get('office_code'),
+                              [office.get('city_name')])
+                return None
+            city = self.index.city(office.get('city_id'))
+            if city is None:
+                # the office's city is not indexed; take its word
+                if not city_name:
+                    check.set(name, part, 'city', office.get('city_name'))
+                if not post_code and office.get('post_code'):
+                    check.set(name, part, 'post_code',
+                              '{}'.format(office.get('post_code')))
+                return None
+            candidates = [city]
+        elif city_name:
+            candidates = self.index.cities_by_name(city_name)
+            if not candidates:
+                check.problem(name, 'city', 'Unknown city', city_name,
+                              self._names(self.index.match_cities(
+                                  city_name, self.suggestions, self.cutoff)))
+                return None
+        elif post_code:
+            candidates = self.index.cities_by_post_code(post_code)
+            if not candidates:
+                check.problem(name, 'post_code', 'Unknown post code',
+                              post_code)
+                return None
+        else:
+            check.problem(name, 'city', 'City or office code is required')
+            return None
+
+        if post_code:
+            matching = [c for c in candidates
+                        if '{}'.format(c.get('post_code')) == post_code]
+            if not matching:
+                check.problem(name, 'post_code', 'Post code is not of {}'
+                              .format(candidates[0].get('name')), post_code,
+                              self._names(candidates, 'post_code'))
+                return None
+            candidates = matching
+
+        if len(candidates) > 1 and not city_name:
+            check.problem(name, 'city', 'Several cities have post code {}'
+                          .format(post_code), None, self._names(candidates))
+            return None
+        post_codes = self._names(candidates, 'post_code')
+        if len(post_codes) > 1:
+            check.problem(name, 'post_code', 'Several cities are called {}'
+                          .format(city_name), post_code, post_codes)
+            return None
+
+        city = candidates[0]
+        check.set(name, part, 'city', city.get('name'))
+        if city.get('post_code'):
+            check.set(name, part, 'post_code',
+                      '{}'.format(city.get('post_code')))
+        return city
+
+    # enumerations
+
+    def _enums(self, check):
+        for part_name, field, values in _ENUMS:
+            part = check.part(part_name)
+            value = _text(part.get(field))
+            if not value:
+                continue
+            upper = value.upper()
+            if field == 'tariff_sub_code':
+                upper = _TARIFF_ALIASES.get(upper, upper)
+            if upper in values:
+                check.set(part_name, part, field, upper)
+                continue
+            check.problem(part_name, field, 'Should be one of {}'.format(
+                ', '.join(values)), value, difflib.get_close_matches(
+                    upper, values, self.suggestions, 0.6))
+
+        shipment = check.loading.get('shipment')
+        tariff = _text(shipment.get('tariff_sub_code')).upper() \
+            if hasattr(shipment, 'get') else ''
+        tariff = _TARIFF_ALIASES.get(tariff, tariff)
+        if tariff in TARIFF_SUB_CODES:
+            for name, side in zip(('sender', 'receiver'),
+                                  tariff.split('_')):
+                part = check.loading.get(name)
+                if side == 'OFFICE' and hasattr(part, 'get') and \
+                        not _text(part.get('office_code')):
+                    check.problem(name, 'office_code',
+                                  'Required by tariff {}'.format(tariff))
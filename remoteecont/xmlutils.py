@@ -2,10 +2,100 @@
 
 from __future__ import unicode_literals
 
-from collections import Mapping
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from collections import deque
 from xml.etree import ElementTree as etree
 
-from django.utils import six
+try:
+    string_types = (basestring,)
+    text_type = unicode
+except NameError:
+    string_types = (str,)
+    text_type = str
+
+# imported by `set_backend`, when selected
+lxml_etree = None
+
+# Parser used by `xml2dict`, either 'stdlib' or 'lxml'.  lxml parses
+# faster, but walking its tree from Python is slower than walking the
+# C elements of the standard library, which makes the stdlib the
+# faster choice overall for `xml2dict`.
+BACKEND = 'stdlib'
+
+
+def set_backend(name):
+    """Select the parser backend of `xml2dict`: 'lxml' or 'stdlib'."""
+    global BACKEND, lxml_etree
+    if name not in ('lxml', 'stdlib'):
+        raise ValueError('Unknown XML backend: {}'.format(name))
+    if name == 'lxml' and lxml_etree is None:
+        try:
+            from lxml import etree as lxml_etree
+        except ImportError:
+            raise ValueError('lxml is not installed')
+    BACKEND = name
+
+
+# xml.sax.saxutils would do, but importing it pulls in urllib
+
+def escape(data):
+    """Escape `&`, `<` and `>` in character data."""
+    return data.replace('&', '&amp;').replace('>', '&gt;').replace('<', '&lt;')
+
+
+def quoteattr(data):
+    """Escape and quote an attribute value like `xml.sax.saxutils`."""
+    data = escape(data).replace('\n', '&#10;').replace('\r', '&#13;') \
+        .replace('\t', '&#9;')
+    if '"' in data:
+        if "'" in data:
+            data = '"{}"'.format(data.replace('"', '&quot;'))
+        else:
+            data = "'{}'".format(data)
+    else:
+        data = '"{}"'.format(data)
+    return data
+
+
+def element_value(el):
+    """
+    Convert a single element to the value `etree2dict` stores for it:
+    a string for leaves without attributes, a dictionary otherwise.
+
+    """
+    text = el.text
+    text = text.strip() if text else ''
+    attrib = el.attrib
+
+    if not len(el):
+        # leaf, the most common case by far
+        if not attrib:
+            return text
+        val = {'__attrib__': dict(attrib)}
+        if text:
+            val['__content__'] = text
+        return val
+
+    val = {'__content__': text} if text else {}
+    if attrib:
+        val['__attrib__'] = dict(attrib)
+
+    for child in el:
+        tag = child.tag
+        child_val = element_value(child)
+        if tag not in val:
+            val[tag] = child_val
+        else:
+            prev = val[tag]
+            if prev.__class__ is list:
+                prev.append(child_val)
+            else:
+                val[tag] = [prev, child_val]
+
+    return val
 
 
 def etree2dict(root, d=None):
@@ -32,21 +122,7 @@ def etree2dict(root, d=None):
     if d is None:
         d = {}
 
-    # content
-    text = root.text.strip() if root.text is not None else ''
-    val = {'__content__': text} if text else {}
-
-    # attributes
-    if len(root.attrib) > 0:
-        val['__attrib__'] = root.attrib.copy()
-
-    for child in root:
-        etree2dict(child, val)
-
-    if len(val) == 0:
-        val = ''
-    elif len(val) == 1:
-        val = val.get('__content__', val)
+    val = element_value(root)
 
     if root.tag not in d:
         d[root.tag] = val
@@ -58,20 +134,168 @@ def etree2dict(root, d=None):
     return d
 
 
+def parse(xml, encoding='utf-8'):
+    """
+    Parse an XML document with the selected backend; return the root.
+    `xml` is bytes, a `bytearray` or `memoryview`, or a list of byte
+    chunks, which are fed to the parser without being joined.
+
+    """
+    chunks = xml if isinstance(xml, (list, tuple)) else (xml,)
+
+    if BACKEND == 'lxml':
+        parser = lxml_etree.XMLParser(encoding=encoding, huge_tree=True,
+                                      remove_comments=True, remove_pis=True)
+        # lxml takes nothing but bytes and text
+        chunks = [c if isinstance(c, bytes) else bytes(c) for c in chunks]
+    else:
+        parser = etree.XMLParser(encoding=encoding)
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
+
+
 def xml2dict(xml, encoding='utf-8'):
-    if not xml or not isinstance(xml, six.string_types):
+    """
+    Convert an XML document, text or anything `parse` accepts, to a
+    dictionary.
+
+    """
+    if not xml or not isinstance(xml, (bytes, bytearray, memoryview, list,
+                                       tuple) + string_types):
         raise TypeError
-    if isinstance(xml, six.text_type):
+    if isinstance(xml, text_type):
         xml = xml.encode(encoding)
 
-    parser = etree.XMLParser(encoding=encoding)
-    parser.feed(xml)
-    root = parser.close()
-    return etree2dict(root)
+    return etree2dict(parse(xml, encoding))
+
+
+class _RecordTarget(object):
+    """
+    Parser target that builds elements only inside `tag` records.
+
+    Everything outside of a record (the response envelope) is
+    dropped, except for the text of an `<error>` element, kept in
+    `error`.  Completed top-level records are queued in `records`
+    detached from any parent, so memory use does not grow with the
+    number of records once they are consumed.
+
+    """
+
+    def __init__(self, tag):
+        self.records = deque()
+        self.error = None
+        self._tag = tag
+        self._stack = []
+        self._text = []
+        self._error = None
+
+    def _flush(self):
+        if self._text:
+            text = ''.join(self._text)
+            self._text = []
+            el = self._stack[-1]
+            if len(el):
+                el[-1].tail = (el[-1].tail or '') + text
+            else:
+                el.text = (el.text or '') + text
+
+    def start(self, tag, attrib):
+        if self._stack:
+            self._flush()
+            el = etree.SubElement(self._stack[-1], tag, attrib)
+        elif tag == self._tag:
+            el = etree.Element(tag, attrib)
+        else:
+            if tag == 'error':
+                self._error = []
+            return
+        self._stack.append(el)
+
+    def data(self, data):
+        if self._stack:
+            self._text.append(data)
+        elif self._error is not None:
+            self._error.append(data)
+
+    def end(self, tag):
+        if self._stack:
+            self._flush()
+            el = self._stack.pop()
+            if not self._stack:
+                self.records.append(el)
+        elif tag == 'error' and self._error is not None:
+            self.error = ''.join(self._error).strip()
+            self._error = None
+
+    def close(self):
+        return None
+
+
+class _RecordParser(object):
+    """
+    Incremental parser behind `iterrecords`: `feed` it byte chunks and
+    then `close` it; both yield the records completed so far.  `error`
+    is the text of the `<error>` of the response envelope, if any.
+
+    """
+
+    def __init__(self, tag='e', encoding='utf-8', convert=element_value):
+        target = _RecordTarget(tag)
+        self._target = target
+        self._parser = etree.XMLParser(target=target, encoding=encoding)
+        self._records = target.records
+        self._convert = convert
+        self._fed = False
+
+    def feed(self, chunk):
+        if chunk:
+            self._parser.feed(chunk)
+            self._fed = True
+        return self._take()
+
+    def close(self):
+        if self._fed:
+            self._parser.close()
+        return self._take()
+
+    @property
+    def error(self):
+        return self._target.error
+
+    def _take(self):
+        records = self._records
+        while records:
+            el = records.popleft()
+            yield self._convert(el)
+            el.clear()
+
+
+def iterrecords(chunks, tag='e', encoding='utf-8', convert=element_value):
+    """
+    Incrementally parse an XML document given as an iterable of byte
+    chunks and yield every top-level `tag` element, converted with
+    `convert` (the same way `etree2dict` converts it by default), as
+    soon as it has been parsed.
+
+    Nested `tag` elements stay a part of their enclosing record.
+
+    """
+    parser = _RecordParser(tag, encoding, convert)
+    for chunk in chunks:
+        for record in parser.feed(chunk):
+            yield record
+    for record in parser.close():
+        yield record
+
+
+_SPECIAL = ('__attrib__', '__content__')
+
+_MISSING = object()
 
 
 def dict2etree(d):
-    """This MODIFIES the dictionary `d`.
+    """Convert a dictionary to an ElementTree; `d` is left intact.
 
     """
     if len(d) != 1:
@@ -85,21 +309,24 @@ def dict2etree(d):
                     root = inner({key: i}, root)
                 continue
 
+            if key in _SPECIAL:
+                continue
+
             if root is None:
                 el = root = etree.Element(key)
             else:
                 el = etree.SubElement(root, key)
 
-            if isinstance(d[key], six.string_types):
+            if isinstance(d[key], string_types):
                 el.text = d[key]
 
             elif isinstance(d[key], Mapping):
-                el.attrib = d[key].pop('__attrib__', {}).copy()
-                el.text = d[key].pop('__content__', '')
+                el.attrib = dict(d[key].get('__attrib__', {}))
+                el.text = d[key].get('__content__', '')
                 inner(d[key], el)
 
             else:
-                el.text = six.text_type(d[key])
+                el.text = text_type(d[key])
 
         return root
 
@@ -111,3 +338,123 @@ def dict2xml(d, encoding='utf-8', response_encoding='utf-8'):
     xml = etree.tostring(root, encoding=encoding)
     xml = xml.decode(response_encoding)
     return xml
+
+
+def _text(value):
+    if not isinstance(value, string_types):
+        value = text_type(value)
+    return escape(value)
+
+
+def _start_tag(tag, attrib):
+    if not attrib:
+        return '<{}>'.format(tag)
+    return '<{}{}>'.format(tag, ''.join(
+        ' {}={}'.format(k, quoteattr(text_type(v)))
+        for k, v in attrib.items()))
+
+
+def _write(out, tag, value):
+    """Append the XML of `{tag: value}` to the list `out`."""
+    if isinstance(value, list):
+        for e in value:
+            _write(out, tag, e)
+    elif isinstance(value, Mapping):
+        out.append(_start_tag(tag, value.get('__attrib__')))
+        out.append(_text(value.get('__content__', '')))
+        for k, v in value.items():
+            if k not in _SPECIAL:
+                _write(out, k, v)
+        out.append('</{}>'.format(tag))
+    else:
+        out.append('<{0}>{1}</{0}>'.format(tag, _text(value)))
+
+
+def dumps(d):
+    """
+    Serialise a dictionary to XML text the way `dict2xml` does, but
+    directly, without building an ElementTree and without modifying
+    `d`.
+
+    """
+    if len(d) != 1:
+        raise ValueError('One root to rule them all... please? {}'.format(d))
+    out = []
+    for tag, value in d.items():
+        _write(out, tag, value)
+    return ''.join(out)
+
+
+class _Node(object):
+    """Precompiled element of a `Serializer` defaults tree."""
+
+    __slots__ = ('tag', 'xml', 'attrib', 'content', 'children', 'keys')
+
+    def __init__(self, tag, default):
+        self.tag = tag
+
+        out = []
+        _write(out, tag, default)
+        self.xml = ''.join(out)
+
+        if isinstance(default, Mapping):
+            self.attrib = dict(default.get('__attrib__', {}))
+            self.content = default.get('__content__', '')
+            self.children = [_Node(k, v) for k, v in default.items()
+                             if k not in _SPECIAL]
+            self.keys = frozenset(default)
+        else:
+            self.children = None
+
+    def write(self, out, value=_MISSING):
+        if value is _MISSING:
+            out.append(self.xml)
+            return
+
+        if self.children is None or not isinstance(value, Mapping):
+            _write(out, self.tag, value)
+            return
+
+        attrib = self.attrib
+        if '__attrib__' in value:
+            attrib = dict(attrib)
+            attrib.update(value['__attrib__'])
+
+        out.append(_start_tag(self.tag, attrib))
+        out.append(_text(value.get('__content__', self.content)))
+
+        for child in self.children:
+            child.write(out, value.get(child.tag, _MISSING))
+        for k, v in value.items():
+            if k not in self.keys:
+                _write(out, k, v)
+
+        out.append('</{}>'.format(self.tag))
+
+
+class Serializer(object):
+    """
+    Precompiled XML serializer for dictionaries that are deep merged
+    over a fixed dictionary of defaults.
+
+    Values missing from the serialised dictionary are taken from
+    `defaults` at any depth, so a partial section only overrides the
+    keys it contains.  The defaults are rendered once, when the
+    serializer is created, and neither they nor the serialised values
+    are ever copied or modified.
+
+    """
+
+    def __init__(self, tag, defaults):
+        self._root = _Node(tag, defaults)
+
+    def write(self, out, value):
+        """Append the XML of `value` to the list of strings `out`."""
+        self._root.write(out, value)
+
+    def dumps(self, value, encoding=None):
+        """Return the XML of `value`, as bytes if `encoding` is given."""
+        out = []
+        self._root.write(out, value)
+        xml = ''.join(out)
+        return xml.encode(encoding) if encoding else xml